@@ -0,0 +1,4 @@
+/* Automatically generated; do not edit
+   C defines from build-time checks */
+int USING_GCC_SSE2 = 1;
+int HAVE_OPENMP = 1;
@@ -53,7 +53,7 @@ cdef class BootDirectionGetter(BaseDirectionGetter):
                               sh_order=sh_order)
         return klass(boot_gen, max_angle, sphere, max_attempts, **kwargs)
 
-    cdef int get_direction_c(self, double* point, double* direction):
+    cdef int get_direction_c(self, double* point, double* direction) nogil:
         """Attempt direction getting on a few bootstrap samples.
 
         Returns
@@ -62,13 +62,19 @@ cdef class BootDirectionGetter(BaseDirectionGetter):
             Returns 0 `direction` was updated with a new tracking direction, or
             1 otherwise.
         """
-        cdef:
-            double[:] pmf,
-            np.ndarray[np.float_t, ndim=2] peaks
+        cdef int status
+
+        # The bootstrap samples and their peaks are computed in Python
+        with gil:
+            status = self._get_boot_direction(point, direction)
+        return status
+
+    cdef int _get_boot_direction(self, double* point, double* direction):
+        cdef np.ndarray[np.float_t, ndim=2] peaks
 
         for _ in range(self.max_attempts):
-            pmf = self._get_pmf(point)
-            peaks = self._get_peak_directions(pmf)
+            self._get_pmf(point)
+            peaks = self._get_peak_directions(self.pmf_gen.pmf)
             if len(peaks) > 0:
                 return closest_peak(peaks, direction, self.cos_similarity)
         return 1
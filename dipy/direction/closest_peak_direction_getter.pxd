@@ -20,9 +20,9 @@ cdef class BaseDirectionGetter(DirectionGetter):
         self,
         double[::1] point)
 
-    cdef _get_pmf(
+    cdef double* _get_pmf(
         self,
-        double* point)
+        double* point) nogil
 
     cpdef int get_direction(
         self,
@@ -32,7 +32,7 @@ cdef class BaseDirectionGetter(DirectionGetter):
     cdef int get_direction_c(
         self,
         double* point,
-        double* direction)
+        double* direction) nogil
 
 
 cdef class PmfGenDirectionGetter(BaseDirectionGetter):
@@ -91,19 +91,25 @@ cdef class BaseDirectionGetter(DirectionGetter):
             directions should be unique.
 
         """
-        cdef double[:] pmf = self._get_pmf(&point[0])
-        return self._get_peak_directions(pmf)
+        self._get_pmf(&point[0])
+        return self._get_peak_directions(self.pmf_gen.pmf)
 
-    cdef _get_pmf(self, double* point):
+    cdef double* _get_pmf(self, double* point) nogil:
+        """Compute the pmf at `point`, with the values below the threshold set
+        to zero, and return a pointer to its first element."""
         cdef:
             size_t _len, i
-            double[:] pmf
-            double absolute_pmf_threshold
+            double* pmf
+            double absolute_pmf_threshold, max_pmf
 
         pmf = self.pmf_gen.get_pmf_c(point)
-        _len = pmf.shape[0]
+        _len = self.pmf_gen.pmf.shape[0]
 
-        absolute_pmf_threshold = self.pmf_threshold*np.max(pmf)
+        max_pmf = pmf[0]
+        for i in range(1, _len):
+            if pmf[i] > max_pmf:
+                max_pmf = pmf[i]
+        absolute_pmf_threshold = self.pmf_threshold * max_pmf
         for i in range(_len):
             if pmf[i] < absolute_pmf_threshold:
                 pmf[i] = 0.0
@@ -154,7 +160,8 @@ cdef class PmfGenDirectionGetter(BaseDirectionGetter):
 
     @classmethod
     def from_shcoeff(klass, shcoeff, max_angle, sphere=default_sphere,
-                     pmf_threshold=0.1, basis_type=None, **kwargs):
+                     pmf_threshold=0.1, basis_type=None, pmf_cache=None,
+                     pmf_cache_size=4096, pmf_cache_file=None, **kwargs):
         """Probabilistic direction getter from a distribution of directions
         on the sphere
 
@@ -178,6 +185,19 @@ cdef class PmfGenDirectionGetter(BaseDirectionGetter):
         basis_type : name of basis
             The basis that ``shcoeff`` are associated with.
             ``dipy.reconst.shm.real_sym_sh_basis`` is used by default.
+        pmf_cache : None, 'precompute' or 'lazy'
+            Whether to interpolate the distributions of the voxels, evaluated
+            on ``sphere`` once, instead of evaluating the interpolated
+            ``shcoeff`` at each step. With 'precompute', the distributions of
+            all the voxels with nonzero ``shcoeff`` are evaluated at once.
+            With 'lazy', they are evaluated when first needed and the
+            ``pmf_cache_size`` most recently used are kept. The distributions
+            are stored in float32.
+        pmf_cache_size : int
+            The number of voxels whose distributions are kept with 'lazy'.
+        pmf_cache_file : str
+            The file in which the distributions are memory-mapped with
+            'precompute'. By default, they are kept in memory.
         relative_peak_threshold : float in [0., 1.]
             Used for extracting initial tracking directions. Passed to
             peak_directions.
@@ -191,7 +211,8 @@ cdef class PmfGenDirectionGetter(BaseDirectionGetter):
 
         """
         pmf_gen = SHCoeffPmfGen(np.asarray(shcoeff,dtype=float), sphere,
-                                basis_type)
+                                basis_type, pmf_cache, pmf_cache_size,
+                                pmf_cache_file)
         return klass(pmf_gen, max_angle, sphere, pmf_threshold, **kwargs)
 
 
@@ -200,20 +221,28 @@ cdef class ClosestPeakDirectionGetter(PmfGenDirectionGetter):
     direction.
     """
 
-    cdef int get_direction_c(self, double* point, double* direction):
+    cdef int get_direction_c(self, double* point, double* direction) nogil:
         """
         Returns
         -------
         0 : if ``direction`` is updated
         1 : if no new direction is founded
         """
-        cdef:
-            double[:] pmf
-            np.ndarray[np.float_t, ndim=2] peaks
+        cdef int status
+
+        self._get_pmf(point)
+        # The peaks are extracted in Python
+        with gil:
+            status = _closest_peak_direction(self, direction)
+        return status
+
 
-        pmf = self._get_pmf(point)
+cdef int _closest_peak_direction(BaseDirectionGetter dg, double* direction):
+    """Update direction with the closest peak of the pmf last computed by
+    ``dg``."""
+    cdef np.ndarray[np.float_t, ndim=2] peaks
 
-        peaks = self._get_peak_directions(pmf)
-        if len(peaks) == 0:
-            return 1
-        return closest_peak(peaks, direction, self.cos_similarity)
+    peaks = dg._get_peak_directions(dg.pmf_gen.pmf)
+    if len(peaks) == 0:
+        return 1
+    return closest_peak(peaks, direction, dg.cos_similarity)
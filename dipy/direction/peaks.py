@@ -1,26 +1,33 @@
 from __future__ import division, print_function, absolute_import
 
+import atexit
 from multiprocessing import cpu_count, Pool
-from itertools import repeat
-from os import path
+from os import close, remove
+import pickle
+from tempfile import mkstemp
 from warnings import warn
 
 from dipy.utils.six.moves import xrange
 
-from nibabel.tmpdirs import InTemporaryDirectory
-
 import numpy as np
 import scipy.optimize as opt
 
 from dipy.reconst.odf import gfa
 from dipy.reconst.recspeed import (local_maxima, remove_similar_vertices,
-                                   search_descending)
+                                   search_descending, search_peaks)
 from dipy.core.sphere import Sphere
 from dipy.data import default_sphere
-from dipy.core.ndindex import ndindex
 from dipy.reconst.shm import sh_to_sf_matrix
 from dipy.reconst.peak_direction_getter import PeaksAndMetricsDirectionGetter
 
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # Python < 3.8
+    shared_memory = None
+
+# Number of voxels whose peaks are extracted at once by peaks_from_model
+_BLOCK_SIZE = 1024
+
 
 def peak_directions_nl(sphere_eval, relative_peak_threshold=.25,
                        min_separation_angle=25, sphere=default_sphere,
@@ -158,6 +165,55 @@ def peak_directions(odf, sphere, relative_peak_threshold=.5,
     return directions, values, indices
 
 
+def peak_directions_batch(odfs, sphere, relative_peak_threshold=.5,
+                          min_separation_angle=25, npeaks=5,
+                          num_threads=None):
+    """Get the directions of the peaks of many odfs.
+
+    Same as :func:`peak_directions`, applied to each odf in parallel and
+    keeping at most `npeaks` peaks.
+
+    Parameters
+    ----------
+    odfs : (..., N) ndarray
+        The odfs evaluated on the N vertices of `sphere`.
+    sphere : Sphere
+        The Sphere providing discrete directions for evaluation.
+    relative_peak_threshold : float in [0., 1.]
+        Only peaks greater than ``min + relative_peak_threshold * scale`` are
+        kept, where ``min = max(0, odf.min())`` and
+        ``scale = odf.max() - min``.
+    min_separation_angle : float in [0, 90]
+        The minimum distance between directions. If two peaks are too close
+        only the larger of the two is returned.
+    npeaks : int
+        Maximum number of peaks of each odf (default 5).
+    num_threads : int, optional
+        Number of threads. If None (default) then all available threads
+        will be used.
+
+    Returns
+    -------
+    directions : (..., npeaks, 3) ndarray
+        The directions of the peaks of each odf, zero padded.
+    values : (..., npeaks) ndarray
+        The peak values, in descending order, zero padded.
+    indices : (..., npeaks) ndarray
+        The peak indices of the directions on the sphere, padded with -1.
+    """
+    odfs = np.asarray(odfs, dtype=float)
+    shape = odfs.shape[:-1]
+    values, indices = search_peaks(
+        np.ascontiguousarray(odfs.reshape((-1, odfs.shape[-1]))),
+        np.ascontiguousarray(sphere.vertices, dtype=float),
+        np.ascontiguousarray(sphere.edges, dtype=np.uint16),
+        relative_peak_threshold, min_separation_angle, npeaks, num_threads)
+    directions = sphere.vertices[indices] * (indices >= 0)[..., None]
+    return (directions.reshape(shape + (npeaks, 3)),
+            values.reshape(shape + (npeaks,)),
+            indices.reshape(shape + (npeaks,)))
+
+
 def _pam_from_attrs(klass, sphere, peak_indices, peak_values, peak_dirs,
                     gfa, qa, shm_coeff, B, odf):
     """
@@ -221,6 +277,113 @@ class PeaksAndMetrics(PeaksAndMetricsDirectionGetter):
                                                    self.odf)
 
 
+class _SharedBuffer(object):
+    """A block of memory shared by the main process and the pool workers.
+
+    The block is a ``multiprocessing.shared_memory`` segment when available,
+    and a memory mapped temporary file otherwise. It is created by the main
+    process (``nbytes`` given) and attached by the workers (``name`` and
+    ``in_shm`` of the created block given).
+    """
+
+    def __init__(self, nbytes=None, name=None, in_shm=None):
+        create = name is None
+        if create:
+            in_shm = shared_memory is not None
+        self.in_shm = in_shm
+        if in_shm:
+            if create:
+                self._shm = shared_memory.SharedMemory(create=True,
+                                                       size=max(nbytes, 1))
+            else:
+                self._shm = shared_memory.SharedMemory(name=name)
+            self.name = self._shm.name
+            self.buf = np.frombuffer(self._shm.buf, dtype=np.uint8)
+        else:
+            self._shm = None
+            if create:
+                fd, name = mkstemp(suffix='.dat')
+                close(fd)
+            self.name = name
+            self.buf = np.memmap(name, dtype=np.uint8,
+                                 mode='w+' if create else 'r+',
+                                 shape=(max(nbytes, 1),) if create else None)
+
+    def array(self, offset, shape, dtype):
+        """An array of the block, starting at byte `offset`."""
+        return np.ndarray(shape, dtype=dtype, buffer=self.buf, offset=offset)
+
+    def close(self):
+        """Release the block in this process. All the arrays of the block
+        must have been deleted."""
+        self.buf = None
+        if self._shm is not None:
+            self._shm.close()
+
+    def unlink(self):
+        """Free the block, once it has been closed in all processes."""
+        if self._shm is not None:
+            self._shm.unlink()
+        else:
+            remove(self.name)
+
+
+# Pool of processes reused by all the calls to peaks_from_model(...,
+# parallel=True), created by ``_get_pool``
+_pool = None
+_pool_size = None
+
+# The job (model and peak extraction parameters) of the last call, cached by
+# each worker of the pool as ``(shared block name, job)``
+_worker_job = None
+
+
+def _get_pool(nbr_processes):
+    global _pool, _pool_size
+    if _pool is None or _pool_size != nbr_processes:
+        _close_pool()
+        _pool = Pool(nbr_processes)
+        _pool_size = nbr_processes
+    return _pool
+
+
+def _close_pool():
+    global _pool, _pool_size
+    if _pool is not None:
+        _pool.terminate()
+        _pool.join()
+    _pool = None
+    _pool_size = None
+
+
+atexit.register(_close_pool)
+
+
+def _peaks_layout(data, npeaks, n_shm_coeff, n_odf, offset):
+    """The (offset, shape, dtype) of the input and output arrays of
+    peaks_from_model in a shared block, each starting at a 64 bytes
+    boundary after `offset`."""
+    n = data.shape[0]
+    arrays = [('data', data.shape, data.dtype),
+              ('mask', (n,), np.dtype(bool)),
+              ('gfa', (n,), np.dtype(float)),
+              ('qa', (n, npeaks), np.dtype(float)),
+              ('peak_dirs', (n, npeaks, 3), np.dtype(float)),
+              ('peak_values', (n, npeaks), np.dtype(float)),
+              ('peak_indices', (n, npeaks), np.dtype(int))]
+    if n_shm_coeff:
+        arrays.append(('shm_coeff', (n, n_shm_coeff), np.dtype(float)))
+    if n_odf:
+        arrays.append(('odf', (n, n_odf), np.dtype(float)))
+
+    layout = {}
+    for key, shape, dtype in arrays:
+        offset = -(-offset // 64) * 64
+        layout[key] = (offset, shape, dtype)
+        offset += int(np.prod(shape)) * dtype.itemsize
+    return layout, offset
+
+
 def _peaks_from_model_parallel(model, data, sphere, relative_peak_threshold,
                                min_separation_angle, mask, return_odf,
                                return_sh, gfa_thr, normalize_peaks, sh_order,
@@ -248,146 +411,176 @@ def _peaks_from_model_parallel(model, data, sphere, relative_peak_threshold,
                                 sh_order, sh_basis_type, npeaks,
                                 parallel=False)
 
-    shape = list(data.shape)
-    data = np.reshape(data, (-1, shape[-1]))
+    shape = data.shape[:-1]
+    data = np.reshape(data, (-1, data.shape[-1]))
     n = data.shape[0]
     nbr_chunks = nbr_processes ** 2
-    chunk_size = int(np.ceil(n / nbr_chunks))
-    indices = list(zip(np.arange(0, n, chunk_size),
-                       np.arange(0, n, chunk_size) + chunk_size))
-
-    with InTemporaryDirectory() as tmpdir:
-
-        data_file_name = path.join(tmpdir, 'data.npy')
-        np.save(data_file_name, data)
-        if mask is not None:
-            mask = mask.flatten()
-            mask_file_name = path.join(tmpdir, 'mask.npy')
-            np.save(mask_file_name, mask)
-        else:
-            mask_file_name = None
-
-        pool = Pool(nbr_processes)
-
-        pam_res = pool.map(_peaks_from_model_parallel_sub,
-                           zip(repeat((data_file_name, mask_file_name)),
-                               indices,
-                               repeat(model),
-                               repeat(sphere),
-                               repeat(relative_peak_threshold),
-                               repeat(min_separation_angle),
-                               repeat(return_odf),
-                               repeat(return_sh),
-                               repeat(gfa_thr),
-                               repeat(normalize_peaks),
-                               repeat(sh_order),
-                               repeat(sh_basis_type),
-                               repeat(npeaks),
-                               repeat(B),
-                               repeat(invB)))
-        pool.close()
-
-        pam = PeaksAndMetrics()
-        pam.sphere = sphere
-        # use memmap to reduce the memory usage
-        pam.gfa = np.memmap(path.join(tmpdir, 'gfa.npy'),
-                            dtype=pam_res[0].gfa.dtype,
-                            mode='w+',
-                            shape=(data.shape[0]))
-
-        pam.peak_dirs = np.memmap(path.join(tmpdir, 'peak_dirs.npy'),
-                                  dtype=pam_res[0].peak_dirs.dtype,
-                                  mode='w+',
-                                  shape=(data.shape[0], npeaks, 3))
-        pam.peak_values = np.memmap(path.join(tmpdir, 'peak_values.npy'),
-                                    dtype=pam_res[0].peak_values.dtype,
-                                    mode='w+',
-                                    shape=(data.shape[0], npeaks))
-        pam.peak_indices = np.memmap(path.join(tmpdir, 'peak_indices.npy'),
-                                     dtype=pam_res[0].peak_indices.dtype,
-                                     mode='w+',
-                                     shape=(data.shape[0], npeaks))
-        pam.qa = np.memmap(path.join(tmpdir, 'qa.npy'),
-                           dtype=pam_res[0].qa.dtype,
-                           mode='w+',
-                           shape=(data.shape[0], npeaks))
-        if return_sh:
-            nbr_shm_coeff = (sh_order + 2) * (sh_order + 1) // 2
-            pam.shm_coeff = np.memmap(path.join(tmpdir, 'shm.npy'),
-                                      dtype=pam_res[0].shm_coeff.dtype,
-                                      mode='w+',
-                                      shape=(data.shape[0], nbr_shm_coeff))
-            pam.B = pam_res[0].B
-        else:
-            pam.shm_coeff = None
-            pam.invB = None
-        if return_odf:
-            pam.odf = np.memmap(path.join(tmpdir, 'odf.npy'),
-                                dtype=pam_res[0].odf.dtype,
-                                mode='w+',
-                                shape=(data.shape[0], len(sphere.vertices)))
-        else:
-            pam.odf = None
-
-        # copy subprocesses pam to a single pam (memmaps)
-        for i, (start_pos, end_pos) in enumerate(indices):
-            pam.gfa[start_pos: end_pos] = pam_res[i].gfa
-            pam.peak_dirs[start_pos: end_pos] = pam_res[i].peak_dirs
-            pam.peak_values[start_pos: end_pos] = pam_res[i].peak_values
-            pam.peak_indices[start_pos: end_pos] = pam_res[i].peak_indices
-            pam.qa[start_pos: end_pos] = pam_res[i].qa
-            if return_sh:
-                pam.shm_coeff[start_pos: end_pos] = pam_res[i].shm_coeff
-            if return_odf:
-                pam.odf[start_pos: end_pos] = pam_res[i].odf
-
-        # load memmaps to arrays and reshape the metric
-        shape[-1] = -1
-        pam.gfa = np.reshape(np.array(pam.gfa), shape[:-1])
-        pam.peak_dirs = np.reshape(np.array(pam.peak_dirs), shape + [3])
-        pam.peak_values = np.reshape(np.array(pam.peak_values), shape)
-        pam.peak_indices = np.reshape(np.array(pam.peak_indices), shape)
-        pam.qa = np.reshape(np.array(pam.qa), shape)
-        if return_sh:
-            pam.shm_coeff = np.reshape(np.array(pam.shm_coeff), shape)
-        if return_odf:
-            pam.odf = np.reshape(np.array(pam.odf), shape)
-
-        # Make sure all worker processes have exited before leaving context
-        # manager in order to prevent temporary file deletion errors in windows
-        pool.join()
-
-    return pam
+    chunk_size = max(int(np.ceil(n / nbr_chunks)), 1)
+
+    # The model and parameters are pickled once at the start of the shared
+    # block, and unpickled once by each worker
+    job = pickle.dumps((model, dict(sphere=sphere,
+                                    relative_peak_threshold=(
+                                        relative_peak_threshold),
+                                    min_separation_angle=min_separation_angle,
+                                    gfa_thr=gfa_thr,
+                                    normalize_peaks=normalize_peaks,
+                                    invB=invB if return_sh else None)),
+                       protocol=pickle.HIGHEST_PROTOCOL)
+    n_shm_coeff = (sh_order + 2) * (sh_order + 1) // 2 if return_sh else 0
+    n_odf = len(sphere.vertices) if return_odf else 0
+    layout, nbytes = _peaks_layout(data, npeaks, n_shm_coeff, n_odf,
+                                   len(job))
+
+    block = _SharedBuffer(nbytes=nbytes)
+    shared = None
+    try:
+        block.buf[:len(job)] = np.frombuffer(job, dtype=np.uint8)
+        shared = dict((key, block.array(*spec))
+                      for key, spec in layout.items())
+        shared['data'][:] = data
+        shared['mask'][:] = True if mask is None else mask.ravel()
+        for key in shared:
+            if key not in ('data', 'mask'):
+                shared[key].fill(0)
+        shared['peak_indices'].fill(-1)
+
+        tasks = [(block.name, block.in_shm, len(job), layout, start,
+                  start + chunk_size)
+                 for start in range(0, n, chunk_size)]
+        global_max = max([-np.inf] + _get_pool(nbr_processes).map(
+            _peaks_from_model_parallel_sub, tasks))
+
+        out = dict((key, np.array(shared[key])) for key in shared
+                   if key not in ('data', 'mask'))
+    finally:
+        shared = None
+        block.close()
+        block.unlink()
+
+    out['qa'] /= global_max
+    for key in out:
+        out[key] = np.reshape(out[key], shape + out[key].shape[1:])
+
+    return _pam_from_attrs(PeaksAndMetrics,
+                           sphere,
+                           out['peak_indices'],
+                           out['peak_values'],
+                           out['peak_dirs'],
+                           out['gfa'],
+                           out['qa'],
+                           out.get('shm_coeff'),
+                           B if return_sh else None,
+                           out.get('odf'))
 
 
 def _peaks_from_model_parallel_sub(args):
-    (data_file_name, mask_file_name) = args[0]
-    (start_pos, end_pos) = args[1]
-    model = args[2]
-    sphere = args[3]
-    relative_peak_threshold = args[4]
-    min_separation_angle = args[5]
-    return_odf = args[6]
-    return_sh = args[7]
-    gfa_thr = args[8]
-    normalize_peaks = args[9]
-    sh_order = args[10]
-    sh_basis_type = args[11]
-    npeaks = args[12]
-    B = args[13]
-    invB = args[14]
-
-    data = np.load(data_file_name, mmap_mode='r')[start_pos:end_pos]
-    if mask_file_name is not None:
-        mask = np.load(mask_file_name, mmap_mode='r')[start_pos:end_pos]
-    else:
-        mask = None
-
-    return peaks_from_model(model, data, sphere, relative_peak_threshold,
-                            min_separation_angle, mask, return_odf,
-                            return_sh, gfa_thr, normalize_peaks,
-                            sh_order, sh_basis_type, npeaks, B, invB,
-                            parallel=False, nbr_processes=None)
+    global _worker_job
+    name, in_shm, job_nbytes, layout, start, end = args
+
+    block = _SharedBuffer(name=name, in_shm=in_shm)
+    arrays = None
+    try:
+        if _worker_job is None or _worker_job[0] != name:
+            _worker_job = (name, pickle.loads(block.buf[:job_nbytes].tobytes()))
+        model, kwargs = _worker_job[1]
+
+        arrays = dict((key, block.array(*spec)[start:end])
+                      for key, spec in layout.items())
+        data = arrays.pop('data')
+        mask = arrays.pop('mask')
+        # the workers already run in parallel
+        return _fit_peaks(model, data, mask, out=arrays, num_threads=1,
+                          **kwargs)
+    finally:
+        data = mask = arrays = None
+        block.close()
+
+
+def _fit_peaks(model, data, mask, sphere, relative_peak_threshold,
+               min_separation_angle, gfa_thr, normalize_peaks, invB, out,
+               num_threads=None):
+    """Fit `model` to the masked voxels of `data` and extract their peaks.
+
+    The ODFs are evaluated voxel by voxel, and their peaks are extracted by
+    blocks of `_BLOCK_SIZE` voxels with `peak_directions_batch`.
+
+    Parameters
+    ----------
+    data : array (n, N)
+        The signal of n voxels.
+    mask : array (n,)
+        The voxels to fit.
+    invB : ndarray or None
+        The SF to SH matrix, None if the SH coefficients are not needed.
+    out : dict
+        The (n, ...) arrays ``gfa``, ``qa``, ``peak_dirs``, ``peak_values``,
+        ``peak_indices`` and, optionally, ``shm_coeff`` and ``odf`` where the
+        results are written.
+    num_threads : int, optional
+        Number of threads used to extract the peaks. If None (default) then
+        all available threads will be used.
+
+    Returns
+    -------
+    global_max : float
+        The maximum ODF value of the peaks. `qa` is not normalized by it.
+    """
+    gfa_array = out['gfa']
+    qa_array = out['qa']
+    peak_dirs = out['peak_dirs']
+    peak_values = out['peak_values']
+    peak_indices = out['peak_indices']
+    npeaks = peak_values.shape[-1]
+    vertices = np.ascontiguousarray(sphere.vertices, dtype=float)
+    edges = np.ascontiguousarray(sphere.edges, dtype=np.uint16)
+
+    global_max = -np.inf
+    voxels = np.flatnonzero(mask)
+    odfs = None
+    for start in range(0, len(voxels), _BLOCK_SIZE):
+        block = voxels[start:start + _BLOCK_SIZE]
+        for i, idx in enumerate(block):
+            odf = model.fit(data[idx]).odf(sphere)
+            if odfs is None:
+                odfs = np.empty((min(_BLOCK_SIZE, len(voxels)), len(odf)))
+            odfs[i] = odf
+        odf = odfs[:len(block)]
+
+        if invB is not None:
+            out['shm_coeff'][block] = np.dot(odf, invB)
+
+        if 'odf' in out:
+            out['odf'][block] = odf
+
+        gfa_array[block] = gfa(odf)
+        low_gfa = gfa_array[block] < gfa_thr
+        if low_gfa.any():
+            global_max = max(global_max, odf[low_gfa].max())
+            block = block[~low_gfa]
+            odf = odf[~low_gfa]
+
+        # Get peaks of odfs
+        pk, ind = search_peaks(odf, vertices, edges, relative_peak_threshold,
+                               min_separation_angle, npeaks, num_threads)
+
+        # Calculate peak metrics
+        found = ind >= 0
+        if found[:, 0].any():
+            global_max = max(global_max, pk[found[:, 0], 0].max())
+
+        qa_array[block] = np.where(found, pk - odf.min(-1)[:, None], 0)
+        peak_dirs[block] = vertices[ind] * found[..., None]
+        peak_indices[block] = ind
+        peak_values[block] = pk
+
+        if normalize_peaks:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                pk = np.where(found, pk / pk[:, :1], 0)
+            peak_values[block] = pk
+            peak_dirs[block] *= pk[..., None]
+
+    return global_max
 
 
 def peaks_from_model(model, data, sphere, relative_peak_threshold,
@@ -438,9 +631,12 @@ def peaks_from_model(model, data, sphere, relative_peak_threshold,
         Inverse of B.
     parallel: bool
         If True, use multiprocessing to compute peaks and metric
-        (default False). Temporary files are saved in the default temporary
-        directory of the system. It can be changed using ``import tempfile``
-        and ``tempfile.tempdir = '/path/to/tempdir'``.
+        (default False). The data and the results are shared with the
+        subprocesses through shared memory, and the pool of subprocesses is
+        reused by the following calls. On Python < 3.8, a temporary file is
+        saved in the default temporary directory of the system instead. It
+        can be changed using ``import tempfile`` and
+        ``tempfile.tempdir = '/path/to/tempdir'``.
     nbr_processes: int
         If `parallel` is True, the number of subprocesses to use
         (default multiprocessing.cpu_count()).
@@ -455,6 +651,10 @@ def peaks_from_model(model, data, sphere, relative_peak_threshold,
         B, invB = sh_to_sf_matrix(
             sphere, sh_order, sh_basis_type, return_inv=True)
 
+    shape = data.shape[:-1]
+    if mask is not None and mask.shape != shape:
+        raise ValueError("Mask is not the same shape as data.")
+
     if parallel:
         # It is mandatory to provide B and invB to the parallel function.
         # Otherwise, a call to np.linalg.pinv is made in a subprocess and
@@ -475,78 +675,40 @@ def peaks_from_model(model, data, sphere, relative_peak_threshold,
                                           invB,
                                           nbr_processes)
 
-    shape = data.shape[:-1]
     if mask is None:
         mask = np.ones(shape, dtype='bool')
-    else:
-        if mask.shape != shape:
-            raise ValueError("Mask is not the same shape as data.")
-
-    gfa_array = np.zeros(shape)
-    qa_array = np.zeros((shape + (npeaks,)))
-
-    peak_dirs = np.zeros((shape + (npeaks, 3)))
-    peak_values = np.zeros((shape + (npeaks,)))
-    peak_indices = np.zeros((shape + (npeaks,)), dtype='int')
-    peak_indices.fill(-1)
 
+    n = int(np.prod(shape))
+    out = {'gfa': np.zeros(n),
+           'qa': np.zeros((n, npeaks)),
+           'peak_dirs': np.zeros((n, npeaks, 3)),
+           'peak_values': np.zeros((n, npeaks)),
+           'peak_indices': np.full((n, npeaks), -1, dtype='int')}
     if return_sh:
         n_shm_coeff = (sh_order + 2) * (sh_order + 1) // 2
-        shm_coeff = np.zeros((shape + (n_shm_coeff,)))
-
+        out['shm_coeff'] = np.zeros((n, n_shm_coeff))
     if return_odf:
-        odf_array = np.zeros((shape + (len(sphere.vertices),)))
-
-    global_max = -np.inf
-    for idx in ndindex(shape):
-        if not mask[idx]:
-            continue
-
-        odf = model.fit(data[idx]).odf(sphere)
-
-        if return_sh:
-            shm_coeff[idx] = np.dot(odf, invB)
-
-        if return_odf:
-            odf_array[idx] = odf
-
-        gfa_array[idx] = gfa(odf)
-        if gfa_array[idx] < gfa_thr:
-            global_max = max(global_max, odf.max())
-            continue
-
-        # Get peaks of odf
-        direction, pk, ind = peak_directions(odf, sphere,
-                                             relative_peak_threshold,
-                                             min_separation_angle)
-
-        # Calculate peak metrics
-        if pk.shape[0] != 0:
-            global_max = max(global_max, pk[0])
-
-            n = min(npeaks, pk.shape[0])
-            qa_array[idx][:n] = pk[:n] - odf.min()
-
-            peak_dirs[idx][:n] = direction[:n]
-            peak_indices[idx][:n] = ind[:n]
-            peak_values[idx][:n] = pk[:n]
-
-            if normalize_peaks:
-                peak_values[idx][:n] /= pk[0]
-                peak_dirs[idx] *= peak_values[idx][:, None]
+        out['odf'] = np.zeros((n, len(sphere.vertices)))
 
-    qa_array /= global_max
+    global_max = _fit_peaks(model, np.reshape(data, (n, data.shape[-1])),
+                            np.reshape(mask, n), sphere,
+                            relative_peak_threshold, min_separation_angle,
+                            gfa_thr, normalize_peaks,
+                            invB if return_sh else None, out)
+    out['qa'] /= global_max
+    for key in out:
+        out[key] = np.reshape(out[key], shape + out[key].shape[1:])
 
     return _pam_from_attrs(PeaksAndMetrics,
                            sphere,
-                           peak_indices,
-                           peak_values,
-                           peak_dirs,
-                           gfa_array,
-                           qa_array,
-                           shm_coeff if return_sh else None,
+                           out['peak_indices'],
+                           out['peak_values'],
+                           out['peak_dirs'],
+                           out['gfa'],
+                           out['qa'],
+                           out.get('shm_coeff'),
                            B if return_sh else None,
-                           odf_array if return_odf else None)
+                           out.get('odf'))
 
 
 def reshape_peaks_for_visualization(peaks):
@@ -4,10 +4,25 @@ cdef class PmfGen:
     cdef:
         double[:] pmf
         double[:, :, :, :] data
+        # The cache of the pmfs of the voxels (see ``_init_pmf_cache``)
+        int pmf_cache
+        float[:, :, :, ::1] pmf_volume
+        float[:, ::1] cached_pmfs
+        np.npy_intp[::1] cache_slots
+        np.npy_intp[::1] cache_voxels
+        np.npy_intp[::1] cache_prev
+        np.npy_intp[::1] cache_next
+        np.npy_intp cache_head
+        np.npy_intp cache_used
 
     cpdef double[:] get_pmf(self, double[::1] point)
-    cdef double[:] get_pmf_c(self, double* point)
-    cdef void __clear_pmf(self)
+    cdef double* get_pmf_c(self, double* point) nogil
+    cdef void __clear_pmf(self) nogil
+    cdef double* _interpolate_voxel_pmfs(self, double* point) nogil
+    cdef float* _voxel_pmf(self, np.npy_intp i, np.npy_intp j,
+                           np.npy_intp k) nogil
+    cdef void _compute_voxel_pmf(self, np.npy_intp i, np.npy_intp j,
+                                 np.npy_intp k, float* out) nogil
     pass
 
 
@@ -17,7 +32,7 @@ cdef class SimplePmfGen(PmfGen):
 
 cdef class SHCoeffPmfGen(PmfGen):
     cdef:
-        double[:, :] B
+        double[:, ::1] B
         object sphere
         double[:] coeff
     pass
@@ -35,5 +50,5 @@ cdef class BootPmfGen(PmfGen):
 
 
     cpdef double[:] get_pmf_no_boot(self, double[::1] point)
-    cdef double[:] get_pmf_no_boot_c(self, double* point)
+    cdef double* get_pmf_no_boot_c(self, double* point) nogil
     pass
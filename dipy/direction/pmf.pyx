@@ -6,6 +6,7 @@ from warnings import warn
 
 import numpy as np
 cimport numpy as np
+from libc.math cimport floor
 
 from dipy.core.geometry import cart2sphere
 from dipy.reconst import shm
@@ -13,19 +14,95 @@ from dipy.reconst import shm
 from dipy.tracking.local.interpolation cimport trilinear_interpolate4d_c
 
 
+cdef enum:
+    NO_PMF_CACHE = 0
+    PRECOMPUTED_PMFS = 1
+    LAZY_PMFS = 2
+
+_PMF_CACHES = {None: NO_PMF_CACHE, 'precompute': PRECOMPUTED_PMFS,
+               'lazy': LAZY_PMFS}
+
+# The number of voxels whose pmfs are computed at once
+_PMF_CHUNK_SIZE = 2 ** 12
+
+
 cdef class PmfGen:
 
     def __init__(self,
                  double[:, :, :, :] data):
         self.data = np.asarray(data,  dtype=float)
+        self.pmf_cache = NO_PMF_CACHE
+
+    def _init_pmf_cache(self, pmf_cache, cache_size, cache_file, n_pmf):
+        """Set up the cache of the pmfs of the voxels.
+
+        When the pmfs are cached, the pmf at a point is interpolated from the
+        pmfs of the neighboring voxels, stored in float32, instead of being
+        computed from the interpolated data.
+
+        Parameters
+        ----------
+        pmf_cache : None, 'precompute' or 'lazy'
+            With 'precompute', the pmfs of all the voxels are computed at
+            once. With 'lazy', they are computed the first time they are
+            needed, and the `cache_size` most recently used are kept. In both
+            modes, the pmf of a voxel whose data are all zero is zero.
+        cache_size : int
+            The number of voxels whose pmfs are kept with 'lazy'.
+        cache_file : str or None
+            With 'precompute', the file in which the pmfs are memory-mapped,
+            or None to keep them in memory.
+        n_pmf : int
+            The length of the pmfs.
+
+        Notes
+        -----
+        The subclasses calling this method define ``_voxel_pmfs``, which
+        gives the pmfs of voxels from their data, of shape
+        (N, data.shape[3]).
+        """
+        cdef np.npy_intp nbr_voxels
+        try:
+            self.pmf_cache = _PMF_CACHES[pmf_cache]
+        except (KeyError, TypeError):
+            raise ValueError("pmf_cache should be None, 'precompute' or "
+                             "'lazy', not %r." % (pmf_cache, ))
+        data = np.asarray(self.data)
+        shape = data.shape[:3]
+        if self.pmf_cache == PRECOMPUTED_PMFS:
+            if cache_file is None:
+                volume = np.zeros(shape + (n_pmf, ), dtype=np.float32)
+            else:
+                volume = np.memmap(cache_file, dtype=np.float32, mode='w+',
+                                   shape=shape + (n_pmf, ))
+            voxels = np.flatnonzero(np.any(data != 0, axis=-1))
+            for start in range(0, len(voxels), _PMF_CHUNK_SIZE):
+                index = np.unravel_index(
+                    voxels[start:start + _PMF_CHUNK_SIZE], shape)
+                volume[index] = self._voxel_pmfs(data[index])
+            self.pmf_volume = volume
+        elif self.pmf_cache == LAZY_PMFS:
+            if cache_size < 1:
+                raise ValueError("cache_size should be at least 1.")
+            nbr_voxels = shape[0] * shape[1] * shape[2]
+            self.cached_pmfs = np.empty((cache_size, n_pmf), dtype=np.float32)
+            self.cache_slots = np.full(nbr_voxels, -1, dtype=np.intp)
+            self.cache_voxels = np.empty(cache_size, dtype=np.intp)
+            self.cache_prev = np.empty(cache_size, dtype=np.intp)
+            self.cache_next = np.empty(cache_size, dtype=np.intp)
+            self.cache_head = -1
+            self.cache_used = 0
 
     cpdef double[:] get_pmf(self, double[::1] point):
-        return self.get_pmf_c(&point[0])
+        self.get_pmf_c(&point[0])
+        return self.pmf
 
-    cdef double[:] get_pmf_c(self, double* point):
+    cdef double* get_pmf_c(self, double* point) nogil:
+        """Compute the pmf at `point` in ``self.pmf``, and return a pointer to
+        its first element."""
         pass
 
-    cdef void __clear_pmf(self):
+    cdef void __clear_pmf(self) nogil:
         cdef:
             size_t len_pmf = self.pmf.shape[0]
             size_t i
@@ -33,6 +110,120 @@ cdef class PmfGen:
         for i in range(len_pmf):
             self.pmf[i] = 0.0
 
+    cdef double* _interpolate_voxel_pmfs(self, double* point) nogil:
+        """Interpolate trilinearly the cached pmfs of the voxels around
+        `point` into ``self.pmf``, and return a pointer to its first
+        element."""
+        cdef:
+            np.npy_intp flr, L
+            np.npy_intp len_pmf = self.pmf.shape[0]
+            np.npy_intp index[3][2]
+            double weight[3][2]
+            double rem, w
+            float* voxel_pmf
+            int i, j, k
+
+        self.__clear_pmf()
+        for i in range(3):
+            if point[i] < -.5 or point[i] >= (self.data.shape[i] - .5):
+                return &self.pmf[0]
+            flr = <np.npy_intp> floor(point[i])
+            rem = point[i] - flr
+            index[i][0] = flr + (flr == -1)
+            index[i][1] = flr + (flr != (self.data.shape[i] - 1))
+            weight[i][0] = 1 - rem
+            weight[i][1] = rem
+
+        for i in range(2):
+            for j in range(2):
+                for k in range(2):
+                    w = weight[0][i] * weight[1][j] * weight[2][k]
+                    if w == 0:
+                        continue
+                    voxel_pmf = self._voxel_pmf(index[0][i], index[1][j],
+                                                index[2][k])
+                    for L in range(len_pmf):
+                        self.pmf[L] += w * voxel_pmf[L]
+        return &self.pmf[0]
+
+    cdef float* _voxel_pmf(self, np.npy_intp i, np.npy_intp j,
+                           np.npy_intp k) nogil:
+        """The cached pmf of the voxel (i, j, k)."""
+        cdef np.npy_intp voxel, slot, L
+
+        if self.pmf_cache == PRECOMPUTED_PMFS:
+            return &self.pmf_volume[i, j, k, 0]
+
+        # The slots of the lazy cache form a circular list, from the most
+        # recently used pmf (the head) to the least recently used one
+        voxel = (i * self.data.shape[1] + j) * self.data.shape[2] + k
+        slot = self.cache_slots[voxel]
+        if slot == self.cache_head and slot != -1:
+            return &self.cached_pmfs[slot, 0]
+        if slot != -1:
+            _cache_unlink(self, slot)
+        else:
+            if self.cache_used < self.cached_pmfs.shape[0]:
+                slot = self.cache_used
+                self.cache_used += 1
+            else:
+                slot = self.cache_prev[self.cache_head]
+                self.cache_slots[self.cache_voxels[slot]] = -1
+                _cache_unlink(self, slot)
+            self.cache_voxels[slot] = voxel
+            self.cache_slots[voxel] = slot
+            if _is_zero_voxel(self, i, j, k):
+                for L in range(self.cached_pmfs.shape[1]):
+                    self.cached_pmfs[slot, L] = 0
+            else:
+                self._compute_voxel_pmf(i, j, k, &self.cached_pmfs[slot, 0])
+        _cache_push_front(self, slot)
+        return &self.cached_pmfs[slot, 0]
+
+    cdef void _compute_voxel_pmf(self, np.npy_intp i, np.npy_intp j,
+                                 np.npy_intp k, float* out) nogil:
+        """Compute the pmf of the voxel (i, j, k) into `out`."""
+        pass
+
+
+cdef inline int _is_zero_voxel(PmfGen pmf_gen, np.npy_intp i, np.npy_intp j,
+                               np.npy_intp k) nogil:
+    cdef np.npy_intp L
+
+    for L in range(pmf_gen.data.shape[3]):
+        if pmf_gen.data[i, j, k, L] != 0:
+            return 0
+    return 1
+
+
+cdef inline void _cache_unlink(PmfGen pmf_gen, np.npy_intp slot) nogil:
+    cdef np.npy_intp prev = pmf_gen.cache_prev[slot]
+    cdef np.npy_intp next = pmf_gen.cache_next[slot]
+
+    if next == slot:
+        pmf_gen.cache_head = -1
+        return
+    pmf_gen.cache_next[prev] = next
+    pmf_gen.cache_prev[next] = prev
+    if pmf_gen.cache_head == slot:
+        pmf_gen.cache_head = next
+
+
+cdef inline void _cache_push_front(PmfGen pmf_gen, np.npy_intp slot) nogil:
+    cdef np.npy_intp head = pmf_gen.cache_head
+    cdef np.npy_intp tail
+
+    if head == -1:
+        pmf_gen.cache_prev[slot] = slot
+        pmf_gen.cache_next[slot] = slot
+    else:
+        tail = pmf_gen.cache_prev[head]
+        pmf_gen.cache_prev[slot] = tail
+        pmf_gen.cache_next[slot] = head
+        pmf_gen.cache_next[tail] = slot
+        pmf_gen.cache_prev[head] = slot
+    pmf_gen.cache_head = slot
+
 
 cdef class SimplePmfGen(PmfGen):
 
@@ -43,10 +234,10 @@ cdef class SimplePmfGen(PmfGen):
         if np.min(pmf_array) < 0:
             raise ValueError("pmf should not have negative values.")
 
-    cdef double[:] get_pmf_c(self, double* point):
+    cdef double* get_pmf_c(self, double* point) nogil:
         if trilinear_interpolate4d_c(self.data, point, self.pmf) != 0:
             self.__clear_pmf()
-        return self.pmf
+        return &self.pmf[0]
 
 
 cdef class SHCoeffPmfGen(PmfGen):
@@ -54,7 +245,10 @@ cdef class SHCoeffPmfGen(PmfGen):
     def __init__(self,
                  double[:, :, :, :] shcoeff_array,
                  object sphere,
-                 object basis_type):
+                 object basis_type,
+                 object pmf_cache=None,
+                 int cache_size=4096,
+                 object cache_file=None):
         cdef:
             int sh_order
 
@@ -66,17 +260,38 @@ cdef class SHCoeffPmfGen(PmfGen):
             basis = shm.sph_harm_lookup[basis_type]
         except KeyError:
             raise ValueError("%s is not a known basis type." % basis_type)
-        self.B, _, _ = basis(sh_order, sphere.theta, sphere.phi)
+        B, _, _ = basis(sh_order, sphere.theta, sphere.phi)
+        self.B = np.ascontiguousarray(B)
         self.coeff = np.empty(shcoeff_array.shape[3])
         self.pmf = np.empty(self.B.shape[0])
+        self._init_pmf_cache(pmf_cache, cache_size, cache_file,
+                             self.B.shape[0])
+
+    def _voxel_pmfs(self, voxel_data):
+        """The pmfs of voxels given their data, of shape (N, data.shape[3])"""
+        return np.dot(voxel_data, np.asarray(self.B).T)
+
+    cdef void _compute_voxel_pmf(self, np.npy_intp i, np.npy_intp j,
+                                 np.npy_intp k, float* out) nogil:
+        cdef:
+            size_t m, n
+            double _sum
+
+        for m in range(self.B.shape[0]):
+            _sum = 0
+            for n in range(self.B.shape[1]):
+                _sum += self.B[m, n] * self.data[i, j, k, n]
+            out[m] = <float> _sum
 
-    cdef double[:] get_pmf_c(self, double* point):
+    cdef double* get_pmf_c(self, double* point) nogil:
         cdef:
             size_t i, j
             size_t len_pmf = self.pmf.shape[0]
             size_t len_B = self.B.shape[1]
             double _sum
 
+        if self.pmf_cache != NO_PMF_CACHE:
+            return self._interpolate_voxel_pmfs(point)
         if trilinear_interpolate4d_c(self.data, point, self.coeff) != 0:
             self.__clear_pmf()
         else:
@@ -85,7 +300,7 @@ cdef class SHCoeffPmfGen(PmfGen):
                 for j in range(len_B):
                     _sum += self.B[i, j] * self.coeff[j]
                 self.pmf[i] = _sum
-        return self.pmf
+        return &self.pmf[0]
 
 
 cdef class BootPmfGen(PmfGen):
@@ -95,7 +310,10 @@ cdef class BootPmfGen(PmfGen):
                  object model,
                  object sphere,
                  int sh_order=0,
-                 double tol=1e-2):
+                 double tol=1e-2,
+                 object pmf_cache=None,
+                 int cache_size=4096,
+                 object cache_file=None):
         cdef:
             double b_range
             np.ndarray x, y, z, r
@@ -124,26 +342,49 @@ cdef class BootPmfGen(PmfGen):
         self.model = model
         self.sphere = sphere
         self.pmf = np.empty(len(sphere.theta))
+        # The bootstrap samples are random, only the pmfs computed without
+        # bootstrap are cached
+        self._init_pmf_cache(pmf_cache, cache_size, cache_file,
+                             len(sphere.theta))
+
+    def _voxel_pmfs(self, voxel_data):
+        """The pmfs of voxels given their data, of shape (N, data.shape[3])"""
+        return self.model.fit(voxel_data).odf(self.sphere)
 
+    cdef void _compute_voxel_pmf(self, np.npy_intp i, np.npy_intp j,
+                                 np.npy_intp k, float* out) nogil:
+        cdef np.npy_intp L
 
-    cdef double[:] get_pmf_c(self, double* point):
+        with gil:
+            pmf = self._voxel_pmfs(np.asarray(self.data[i, j, k])[None])[0]
+            for L in range(self.cached_pmfs.shape[1]):
+                out[L] = pmf[L]
+
+    cdef double* get_pmf_c(self, double* point) nogil:
         """Produces an ODF from a SH bootstrap sample"""
-        if trilinear_interpolate4d_c(self.data, point, self.vox_data) != 0:
-            self.__clear_pmf()
-        else:
-            self.vox_data[self.dwi_mask] = shm.bootstrap_data_voxel(
-                self.vox_data[self.dwi_mask], self.H, self.R)
-            self.pmf = self.model.fit(self.vox_data).odf(self.sphere)
-        return self.pmf
+        with gil:
+            if trilinear_interpolate4d_c(self.data, point,
+                                         self.vox_data) != 0:
+                self.__clear_pmf()
+            else:
+                self.vox_data[self.dwi_mask] = shm.bootstrap_data_voxel(
+                    self.vox_data[self.dwi_mask], self.H, self.R)
+                self.pmf = self.model.fit(self.vox_data).odf(self.sphere)
+        return &self.pmf[0]
 
 
     cpdef double[:] get_pmf_no_boot(self, double[::1] point):
-        return self.get_pmf_no_boot_c(&point[0])
+        self.get_pmf_no_boot_c(&point[0])
+        return self.pmf
 
 
-    cdef double[:] get_pmf_no_boot_c(self, double* point):
-        if trilinear_interpolate4d_c(self.data, point, self.vox_data) != 0:
-            self.__clear_pmf()
-        else:
-            self.pmf = self.model.fit(self.vox_data).odf(self.sphere)
-        return self.pmf
+    cdef double* get_pmf_no_boot_c(self, double* point) nogil:
+        if self.pmf_cache != NO_PMF_CACHE:
+            return self._interpolate_voxel_pmfs(point)
+        with gil:
+            if trilinear_interpolate4d_c(self.data, point,
+                                         self.vox_data) != 0:
+                self.__clear_pmf()
+            else:
+                self.pmf = self.model.fit(self.vox_data).odf(self.sphere)
+        return &self.pmf[0]
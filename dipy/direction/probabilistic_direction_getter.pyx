@@ -7,15 +7,25 @@ Implementation of a probabilistic direction getter based on sampling from
 discrete distribution (pmf) at each step of the tracking.
 """
 
-from random import random
-
 import numpy as np
 cimport numpy as np
 
 from dipy.direction.closest_peak_direction_getter cimport PmfGenDirectionGetter
 from dipy.direction.peaks import peak_directions, default_sphere
 from dipy.direction.pmf cimport PmfGen, SimplePmfGen, SHCoeffPmfGen
-from dipy.utils.fast_numpy cimport cumsum, where_to_insert
+from dipy.utils.fast_numpy cimport cumsum, where_to_insert, random
+
+
+cdef extern from "dpy_math.h" nogil:
+    double fabs(double x)
+
+
+cdef inline int _same_axis(double* vertex, double* direction) nogil:
+    """Whether ``direction`` is equal to ``vertex`` or to its opposite."""
+    return ((vertex[0] == direction[0] and vertex[1] == direction[1] and
+             vertex[2] == direction[2]) or
+            (vertex[0] == -direction[0] and vertex[1] == -direction[1] and
+             vertex[2] == -direction[2]))
 
 
 cdef class ProbabilisticDirectionGetter(PmfGenDirectionGetter):
@@ -29,8 +39,9 @@ cdef class ProbabilisticDirectionGetter(PmfGenDirectionGetter):
     set to 0 and the result is normalized.
     """
     cdef:
-        double[:, :] vertices
-        dict _adj_matrix
+        double[:, ::1] vertices
+        np.uint8_t[:, ::1] _adj_matrix
+        int _last_index
 
     def __init__(self, pmf_gen, max_angle, sphere=None, pmf_threshold=0.1,
                  **kwargs):
@@ -64,22 +75,49 @@ cdef class ProbabilisticDirectionGetter(PmfGenDirectionGetter):
         PmfGenDirectionGetter.__init__(self, pmf_gen, max_angle, sphere,
                                        pmf_threshold, **kwargs)
         # The vertices need to be in a contiguous array
-        self.vertices = self.sphere.vertices.copy()
+        self.vertices = np.array(self.sphere.vertices, dtype=float,
+                                 order='C')
         self._set_adjacency_matrix(sphere, self.cos_similarity)
+        self._last_index = 0
 
     def _set_adjacency_matrix(self, sphere, cos_similarity):
-        """Creates a dictionary where each key is a direction from sphere and
-        each value is a boolean array indicating which directions are less than
-        max_angle degrees from the key"""
+        """Creates a table where row ``i`` is a boolean array indicating which
+        directions of sphere are less than max_angle degrees from the
+        direction ``i`` (or from its opposite)"""
         matrix = np.dot(sphere.vertices, sphere.vertices.T)
-        matrix = (abs(matrix) >= cos_similarity).astype('uint8')
-        keys = [tuple(v) for v in sphere.vertices]
-        adj_matrix = dict(zip(keys, matrix))
-        keys = [tuple(-v) for v in sphere.vertices]
-        adj_matrix.update(zip(keys, matrix))
-        self._adj_matrix = adj_matrix
-
-    cdef int get_direction_c(self, double* point, double* direction):
+        self._adj_matrix = np.ascontiguousarray(
+            abs(matrix) >= cos_similarity, dtype=np.uint8)
+
+    cdef int _direction_index(self, double* direction) nogil:
+        """The index of the vertex equal to ``direction`` or to its opposite.
+
+        Tracking directions are vertices of the sphere (or their opposites),
+        so the vertex is usually the one chosen at the previous step. If
+        ``direction`` is not a vertex, the index of the closest one is
+        returned.
+        """
+        cdef:
+            int i, closest_i = 0
+            int n_vertices = self.vertices.shape[0]
+            double _dot, closest_dot = -1
+
+        i = self._last_index
+        if _same_axis(&self.vertices[i, 0], direction):
+            return i
+        for i in range(n_vertices):
+            if _same_axis(&self.vertices[i, 0], direction):
+                self._last_index = i
+                return i
+        for i in range(n_vertices):
+            _dot = fabs(self.vertices[i, 0] * direction[0]
+                        + self.vertices[i, 1] * direction[1]
+                        + self.vertices[i, 2] * direction[2])
+            if _dot > closest_dot:
+                closest_dot = _dot
+                closest_i = i
+        return closest_i
+
+    cdef int get_direction_c(self, double* point, double* direction) nogil:
         """Samples a pmf to updates ``direction`` array with a new direction.
 
         Parameters
@@ -98,29 +136,30 @@ cdef class ProbabilisticDirectionGetter(PmfGenDirectionGetter):
         """
         cdef:
             size_t i, idx, _len
-            double[:] newdir, pmf
+            double* newdir
+            double* pmf
             double last_cdf, random_sample
-            np.uint8_t[:] bool_array
+            np.uint8_t* bool_array
 
         pmf = self._get_pmf(point)
-        _len = pmf.shape[0]
+        _len = self.pmf_gen.pmf.shape[0]
 
-        bool_array = self._adj_matrix[
-            (direction[0], direction[1], direction[2])]
+        bool_array = &self._adj_matrix[self._direction_index(direction), 0]
 
         for i in range(_len):
             if bool_array[i] == 0:
                 pmf[i] = 0.0
-        cumsum(&pmf[0], &pmf[0], _len)
+        cumsum(pmf, pmf, _len)
         last_cdf = pmf[_len - 1]
 
         if last_cdf == 0:
             return 1
 
-        random_sample = random() * last_cdf
-        idx = where_to_insert(&pmf[0], random_sample, _len)
+        random_sample = random(&self.rng_state) * last_cdf
+        idx = where_to_insert(pmf, random_sample, _len)
 
-        newdir = self.vertices[idx, :]
+        self._last_index = idx
+        newdir = &self.vertices[idx, 0]
         # Update direction and return 0 for error
         if direction[0] * newdir[0] \
          + direction[1] * newdir[1] \
@@ -146,7 +185,7 @@ cdef class DeterministicMaximumDirectionGetter(ProbabilisticDirectionGetter):
         ProbabilisticDirectionGetter.__init__(self, pmf_gen, max_angle, sphere,
                                               pmf_threshold, **kwargs)
 
-    cdef int get_direction_c(self, double* point, double* direction):
+    cdef int get_direction_c(self, double* point, double* direction) nogil:
         """Find direction with the highest pmf to updates ``direction`` array
         with a new direction.
         Parameters
@@ -162,16 +201,16 @@ cdef class DeterministicMaximumDirectionGetter(ProbabilisticDirectionGetter):
             1 otherwise.
         """
         cdef:
-            size_t _len, max_idx
-            double[:] newdir, pmf
+            size_t i, _len, max_idx
+            double* newdir
+            double* pmf
             double max_value
-            np.uint8_t[:] bool_array
+            np.uint8_t* bool_array
 
         pmf = self._get_pmf(point)
-        _len = pmf.shape[0]
+        _len = self.pmf_gen.pmf.shape[0]
 
-        bool_array = self._adj_matrix[
-            (direction[0], direction[1], direction[2])]
+        bool_array = &self._adj_matrix[self._direction_index(direction), 0]
 
         max_idx = 0
         max_value = 0.0
@@ -183,7 +222,8 @@ cdef class DeterministicMaximumDirectionGetter(ProbabilisticDirectionGetter):
         if max_value <= 0:
             return 1
 
-        newdir = self.vertices[max_idx]
+        self._last_index = max_idx
+        newdir = &self.vertices[max_idx, 0]
         # Update direction
         if direction[0] * newdir[0] \
          + direction[1] * newdir[1] \
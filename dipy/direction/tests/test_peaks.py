@@ -5,11 +5,13 @@ from io import BytesIO
 
 from numpy.testing import (assert_array_equal, assert_array_almost_equal,
                            assert_almost_equal, run_module_suite,
-                           assert_equal, assert_)
+                           assert_equal, assert_, assert_raises)
 from dipy.reconst.odf import (OdfFit, OdfModel, gfa)
 
+import dipy.direction.peaks as peaks_module
 from dipy.direction.peaks import (peaks_from_model,
                                   peak_directions,
+                                  peak_directions_batch,
                                   peak_directions_nl,
                                   reshape_peaks_for_visualization)
 
@@ -354,6 +356,37 @@ def test_peak_directions_thorough():
     assert_equal(len(values) > 10, True)
 
 
+def test_peak_directions_batch():
+    sphere = get_sphere('repulsion724')
+    rng = np.random.RandomState(0)
+    odfs = rng.randn(100, len(sphere.vertices)).cumsum(-1)
+    odfs[:10] = multi_tensor_odf(sphere.vertices,
+                                 np.array([[0.0015, 0.0003, 0.0003]] * 2),
+                                 [(0, 0), (60, 0)], [50, 50])
+    odfs[10:20] = np.round(odfs[10:20])
+    odfs[20:30] = -np.abs(odfs[20:30])
+    odfs[30:40] = 1.
+    odfs = odfs.reshape((10, 10, -1))
+
+    for thr, angle, npeaks in [(.5, 25, 5), (0., 10, 3), (.25, 60, 8)]:
+        directions, values, indices = peak_directions_batch(
+            odfs, sphere, thr, angle, npeaks)
+        assert_equal(directions.shape, (10, 10, npeaks, 3))
+        assert_equal(values.shape, (10, 10, npeaks))
+        for idx in np.ndindex(odfs.shape[:-1]):
+            d, v, ind = peak_directions(odfs[idx], sphere, thr, angle)
+            n = min(npeaks, len(v))
+            assert_array_equal(indices[idx][:n], ind[:n])
+            assert_array_equal(indices[idx][n:], -1)
+            assert_array_equal(values[idx][:n], v[:n])
+            assert_array_equal(values[idx][n:], 0)
+            assert_array_equal(directions[idx][:n], d[:n])
+            assert_array_equal(directions[idx][n:], 0)
+
+    odfs[3, 3, 3] = np.nan
+    assert_raises(ValueError, peak_directions_batch, odfs, sphere)
+
+
 def test_difference_with_minmax():
 
     # Show difference with and without minmax normalization
@@ -585,6 +618,44 @@ def test_peaksFromModelParallel():
             assert_array_almost_equal(pam.odf, pam_single.odf)
 
 
+def test_peaksFromModelParallel_shared():
+    _, fbvals, fbvecs = get_data('small_64D')
+    gtab = gradient_table(np.load(fbvals), np.load(fbvecs))
+    mevals = np.array(([0.0015, 0.0003, 0.0003],
+                       [0.0015, 0.0003, 0.0003]))
+    # voxels with different ODF amplitudes, fitted in different chunks
+    data = np.array([multi_tensor(gtab, mevals, S0, angles=[(0, 0), (a, 0)],
+                                  fractions=[50, 50], snr=None)[0]
+                     for S0, a in zip(np.linspace(50, 200, 12),
+                                      np.linspace(30, 90, 12))])
+    data = data.reshape((3, 4, 1, -1))
+    mask = np.ones(data.shape[:-1], dtype=bool)
+    mask[1, 2, 0] = False
+
+    from dipy.reconst.shm import CsaOdfModel
+    model = CsaOdfModel(gtab, 4)
+    sphere = get_sphere('repulsion100')
+    pam_single = peaks_from_model(model, data, sphere, .5, 25, mask=mask,
+                                  return_odf=True, return_sh=True)
+
+    shared_memory = peaks_module.shared_memory
+    try:
+        for shm in [shared_memory, None]:
+            # None falls back to a memory mapped temporary file
+            peaks_module.shared_memory = shm
+            for _ in range(2):
+                pam = peaks_from_model(model, data, sphere, .5, 25, mask=mask,
+                                       return_odf=True, return_sh=True,
+                                       parallel=True, nbr_processes=2)
+                for attr in ['gfa', 'qa', 'peak_values', 'peak_dirs',
+                             'peak_indices', 'shm_coeff', 'odf']:
+                    assert_array_almost_equal(getattr(pam, attr),
+                                              getattr(pam_single, attr))
+    finally:
+        peaks_module.shared_memory = shared_memory
+    assert_equal(pam.peak_indices[1, 2, 0], -1)
+
+
 def test_peaks_shm_coeff():
 
     SNR = 100
@@ -1,5 +1,8 @@
+import os
+
 import numpy as np
 import numpy.testing as npt
+from nibabel.tmpdirs import InTemporaryDirectory
 
 from dipy.core.gradients import gradient_table
 from dipy.core.sphere import HemiSphere, unit_octahedron
@@ -24,6 +27,33 @@ def test_pmf_from_sh():
                            np.zeros(len(sphere.vertices)))
 
 
+def test_pmf_from_sh_cache():
+    sphere = HemiSphere.from_sphere(unit_octahedron)
+    rng = np.random.RandomState(0)
+    shcoeff = rng.randn(4, 3, 2, 28)
+    shcoeff[0] = 0
+    points = rng.uniform(-1, 4, (200, 3))
+    pmfgen = SHCoeffPmfGen(shcoeff, sphere, None)
+    expected = [np.array(pmfgen.get_pmf(p)) for p in points]
+
+    with InTemporaryDirectory():
+        for kwargs in [{'pmf_cache': 'precompute'},
+                       {'pmf_cache': 'precompute', 'cache_file': 'pmf.dat'},
+                       {'pmf_cache': 'lazy', 'cache_size': 1},
+                       {'pmf_cache': 'lazy', 'cache_size': 5},
+                       {'pmf_cache': 'lazy'}]:
+            cached_pmfgen = SHCoeffPmfGen(shcoeff, sphere, None, **kwargs)
+            for p, pmf in zip(points, expected):
+                npt.assert_allclose(cached_pmfgen.get_pmf(p), pmf, rtol=1e-5,
+                                    atol=1e-6)
+        npt.assert_(os.path.exists('pmf.dat'))
+
+    npt.assert_raises(ValueError, SHCoeffPmfGen, shcoeff, sphere, None,
+                      pmf_cache='all')
+    npt.assert_raises(ValueError, SHCoeffPmfGen, shcoeff, sphere, None,
+                      pmf_cache='lazy', cache_size=0)
+
+
 def test_pmf_from_array():
     sphere = HemiSphere.from_sphere(unit_octahedron)
     pmfgen = SimplePmfGen(np.ones([2, 2, 2, len(sphere.vertices)]))
@@ -65,6 +95,27 @@ def test_boot_pmf():
     npt.assert_equal(len(hsph_updated.vertices), no_boot_pmf.shape[0])
     npt.assert_array_almost_equal(no_boot_pmf, model_pmf)
 
+    # The pmfs without bootstrap can be cached
+    for pmf_cache in ['precompute', 'lazy']:
+        boot_pmf_gen = BootPmfGen(data, model=tensor_model,
+                                  sphere=hsph_updated, pmf_cache=pmf_cache)
+        npt.assert_array_almost_equal(boot_pmf_gen.get_pmf_no_boot(point),
+                                      model_pmf, decimal=5)
+
+    # Both caches give a zero pmf in the voxels whose data are all zero,
+    # although the model fitted to zeros does not
+    data[0] = 0
+    points = np.random.RandomState(0).uniform(-.5, 2.5, (50, 3))
+    pmfs = {}
+    for pmf_cache in ['precompute', 'lazy']:
+        boot_pmf_gen = BootPmfGen(data, model=tensor_model,
+                                  sphere=hsph_updated, pmf_cache=pmf_cache)
+        npt.assert_array_equal(
+            boot_pmf_gen.get_pmf_no_boot(np.array([0., 1., 1.])), 0)
+        pmfs[pmf_cache] = [np.array(boot_pmf_gen.get_pmf_no_boot(p))
+                           for p in points]
+    npt.assert_array_almost_equal(pmfs['precompute'], pmfs['lazy'])
+
     # test model sherical harminic order different than bootstrap order
     csd_model = ConstrainedSphericalDeconvModel(gtab, None, sh_order=6)
 
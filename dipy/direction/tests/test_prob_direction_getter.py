@@ -86,3 +86,50 @@ def test_DeterministicMaximumDirectionGetter():
                                                       unit_octahedron)
     state = dg.get_direction(point, dir)
     npt.assert_equal(state, 1)
+
+
+def test_direction_off_the_sphere():
+    # Directions which are not vertices of the sphere are matched to the
+    # closest vertex to find the allowed next directions
+    N = unit_octahedron.theta.shape[0]
+    pmf = np.zeros((3, 3, 3, N))
+    pmf[..., 0] = 1
+    point = np.ones(3)
+    for cls in [ProbabilisticDirectionGetter,
+                DeterministicMaximumDirectionGetter]:
+        dg = cls.from_pmf(pmf, 30, unit_octahedron)
+        dir = -unit_octahedron.vertices[0] + [0, .1, 0]
+        dir /= np.linalg.norm(dir)
+        state = dg.get_direction(point, dir)
+        npt.assert_equal(state, 0)
+        npt.assert_array_equal(dir, -unit_octahedron.vertices[0])
+        # The next direction is at more than 30 degrees from the previous one
+        dir = unit_octahedron.vertices[2].copy()
+        npt.assert_equal(dg.get_direction(point, dir), 1)
+
+
+def test_ProbabilisticDirectionGetter_seed_random():
+    # Each direction getter samples its own random generator, so the sampled
+    # directions only depend on its seed
+    N = unit_octahedron.theta.shape[0]
+    pmf = np.ones((3, 3, 3, N))
+    point = np.ones(3)
+
+    def sample(dg, n=50):
+        dirs = []
+        for _ in range(n):
+            dir = unit_octahedron.vertices[0].copy()
+            npt.assert_equal(dg.get_direction(point, dir), 0)
+            dirs.append(dir)
+        return np.array(dirs)
+
+    dg1 = ProbabilisticDirectionGetter.from_pmf(pmf, 90, unit_octahedron)
+    dg2 = ProbabilisticDirectionGetter.from_pmf(pmf, 90, unit_octahedron)
+    dg1.seed_random(1234)
+    dg2.seed_random(1234)
+    dirs = sample(dg1)
+    npt.assert_array_equal(sample(dg2), dirs)
+    # All the directions are sampled
+    npt.assert_equal(len(np.unique(abs(dirs).argmax(axis=1))), 3)
+    dg2.seed_random(2 ** 64 - 1)
+    npt.assert_(np.any(sample(dg2) != dirs))
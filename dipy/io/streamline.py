@@ -1,5 +1,9 @@
+import numpy as np
 import nibabel as nib
 from nibabel.streamlines import Field
+from nibabel.streamlines.tck import TckFile
+from nibabel.streamlines.trk import (TrkFile, header_2_dtype,
+                                     get_affine_rasmm_to_trackvis)
 from nibabel.orientations import aff2axcodes
 
 
@@ -52,3 +56,145 @@ def load_trk(filename):
     """
     trk_file = nib.streamlines.load(filename)
     return trk_file.streamlines, trk_file.header
+
+
+class StreamlineWriter(object):
+    """ Writes streamlines to a tractogram file (*.trk or *.tck) in batches
+
+    The streamlines are appended to the file as they are given, so that
+    tractograms of any size can be written from a generator (for instance a
+    `LocalTracking` object) without keeping them in memory. The number of
+    streamlines in the header is updated when the writer is closed.
+
+    Parameters
+    ----------
+    fname : str
+        output tractogram filename, with a .trk or .tck extension
+    affine_to_rasmm : array_like (4, 4), optional
+        The mapping from the streamline points to RAS+ and mm space. By
+        default, the points are in RAS+ and mm space already.
+    header : dict, optional
+        Metadata associated to the tractogram file, as the header of the
+        corresponding nibabel file class (default: None)
+    batch_size : int, optional
+        The number of streamlines written to the file at once (default: 10000)
+
+    Examples
+    --------
+    >>> from nibabel.tmpdirs import InTemporaryDirectory
+    >>> streamlines = (np.random.rand(n, 3) for n in range(2, 12))
+    >>> with InTemporaryDirectory():
+    ...     with StreamlineWriter('tractogram.trk') as writer:
+    ...         writer.write(streamlines)
+    ...     writer.nb_streamlines
+    10
+    """
+
+    def __init__(self, fname, affine_to_rasmm=None, header=None,
+                 batch_size=10000):
+        if batch_size < 1:
+            raise ValueError("batch_size must be positive")
+        tractogram_file = nib.streamlines.detect_format(fname)
+        if tractogram_file not in (TrkFile, TckFile):
+            raise ValueError("Unknown tractogram format of the file "
+                             "{0}".format(fname))
+        if affine_to_rasmm is None:
+            affine_to_rasmm = np.eye(4)
+        self.fname = fname
+        self.batch_size = batch_size
+        self.nb_streamlines = 0
+        self._is_trk = tractogram_file is TrkFile
+
+        # Let nibabel write the header of an empty tractogram, the streamlines
+        # are appended to it
+        empty = nib.streamlines.Tractogram(affine_to_rasmm=np.eye(4))
+        nib.streamlines.save(tractogram_file(empty, header=header), fname)
+        if self._is_trk:
+            header = nib.streamlines.load(fname, lazy_load=True).header
+            affine = np.dot(get_affine_rasmm_to_trackvis(header),
+                            affine_to_rasmm)
+        else:
+            affine = np.asarray(affine_to_rasmm)
+        self._lin_T = affine[:3, :3].T.copy()
+        self._offset = affine[:3, 3].copy()
+
+        self._file = open(fname, 'r+b')
+        if self._is_trk:
+            self._count_offset = header_2_dtype.fields['nb_streamlines'][1]
+            self._file.seek(0, 2)
+        else:
+            # The count has a fixed width in the header, and the streamlines
+            # overwrite the end of file delimiter
+            self._file.seek(-TckFile.EOF_DELIMITER.astype('<f4').nbytes, 2)
+            data_offset = self._file.tell()
+            self._file.seek(0)
+            header = self._file.read(data_offset)
+            self._count_offset = header.index(b'count: ') + len(b'count: ')
+            self._file.seek(data_offset)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, streamlines):
+        """ Appends streamlines to the file
+
+        Parameters
+        ----------
+        streamlines : list of 2D arrays, generator or ArraySequence
+            Each 2D array represents a sequence of 3D points (points, 3).
+        """
+        if self._file is None:
+            raise ValueError("The writer of {0} is closed".format(self.fname))
+        batch = []
+        for streamline in streamlines:
+            batch.append(streamline)
+            if len(batch) == self.batch_size:
+                self._write_batch(batch)
+                batch = []
+        if batch:
+            self._write_batch(batch)
+
+    def _write_batch(self, batch):
+        lengths = np.array([len(s) for s in batch], dtype=np.intp)
+        points = np.concatenate([np.asarray(s).reshape(-1, 3) for s in batch])
+        points = np.dot(points, self._lin_T) + self._offset
+
+        if self._is_trk:
+            # Each streamline is its number of points then its points
+            sizes = 3 * lengths + 1
+            out = np.empty(sizes.sum(), dtype='<f4')
+            starts = np.cumsum(sizes) - sizes
+            is_point = np.ones(len(out), dtype=bool)
+            is_point[starts] = False
+            out[is_point] = points.ravel()
+            out.view('<i4')[starts] = lengths
+        else:
+            # Each streamline is its points then a delimiter
+            out = np.empty((len(points) + len(lengths), 3), dtype='<f4')
+            ends = np.cumsum(lengths + 1) - 1
+            is_point = np.ones(len(out), dtype=bool)
+            is_point[ends] = False
+            out[is_point] = points
+            out[ends] = TckFile.FIBER_DELIMITER
+        self._file.write(out.tobytes())
+        self.nb_streamlines += len(batch)
+
+    def close(self):
+        """ Updates the header and closes the file """
+        if self._file is None:
+            return
+        f = self._file
+        self._file = None
+        try:
+            if self._is_trk:
+                count = np.array(self.nb_streamlines, dtype='<i4').tobytes()
+            else:
+                f.write(TckFile.EOF_DELIMITER.astype('<f4').tobytes())
+                count = '{0:010}'.format(self.nb_streamlines).encode()
+            f.seek(self._count_offset)
+            f.write(count)
+        finally:
+            f.close()
@@ -4,8 +4,9 @@ import os
 import numpy as np
 import numpy.testing as npt
 import nibabel as nib
+from nibabel.streamlines import Field
 from nibabel.tmpdirs import InTemporaryDirectory
-from dipy.io.streamline import save_trk, load_trk
+from dipy.io.streamline import save_trk, load_trk, StreamlineWriter
 from dipy.io.trackvis import save_trk as trackvis_save_trk
 
 streamline = np.array([[82.20181274,  91.36505891,  43.15737152],
@@ -161,6 +162,43 @@ def test_io_streamline():
             npt.assert_allclose(arr1, arr2)
 
 
+def test_streamline_writer():
+    affine = np.diag([2., 3., 1., 1.])
+    affine[:3, 3] = [10., -5., 1.]
+    header = {Field.VOXEL_TO_RASMM: np.diag([-2, 2, 2, 1]),
+              Field.VOXEL_SIZES: (2, 2, 2), Field.DIMENSIONS: (50, 50, 50)}
+    with InTemporaryDirectory():
+        for fname, hdr in [('test.trk', header), ('test.tck', None)]:
+            with StreamlineWriter(fname, affine_to_rasmm=affine, header=hdr,
+                                  batch_size=4) as writer:
+                writer.write(iter(streamlines))
+                writer.write(streamlines[:3])
+            npt.assert_equal(writer.nb_streamlines, len(streamlines) + 3)
+            npt.assert_raises(ValueError, writer.write, streamlines)
+
+            expected = nib.streamlines.Tractogram(streamlines +
+                                                  streamlines[:3],
+                                                  affine_to_rasmm=affine)
+            nib.streamlines.save(expected, 'expected' + fname[-4:],
+                                 header=hdr)
+            tfile = nib.streamlines.load(fname)
+            expected = nib.streamlines.load('expected' + fname[-4:])
+            npt.assert_equal(tfile.header[Field.NB_STREAMLINES],
+                             len(streamlines) + 3)
+            npt.assert_equal(len(tfile.streamlines), len(expected.streamlines))
+            for arr1, arr2 in zip(tfile.streamlines, expected.streamlines):
+                npt.assert_array_equal(arr1, arr2)
+
+        # An empty tractogram
+        with StreamlineWriter('empty.trk') as writer:
+            writer.write([])
+        npt.assert_equal(len(nib.streamlines.load('empty.trk').streamlines), 0)
+
+        npt.assert_raises(ValueError, StreamlineWriter, 'test.txt')
+        npt.assert_raises(ValueError, StreamlineWriter, 'test.trk',
+                          batch_size=0)
+
+
 def test_trackvis():
     with InTemporaryDirectory():
         fname = 'trackvis_test.trk'
@@ -0,0 +1,135 @@
+"""Levenberg-Marquardt helpers shared by the batched fits of several models"""
+from __future__ import division, print_function, absolute_import
+
+import numpy as np
+
+from dipy.utils.arrfuncs import NUMPY_LESS_1_8
+
+
+def solve_stacked(a, b):
+    """Solve a stack of linear systems, with nan for the singular ones.
+
+    Parameters
+    ----------
+    a : array (n, p, p)
+        Matrices of the linear systems.
+    b : array (n, p)
+        Right hand sides of the linear systems.
+    """
+    if not NUMPY_LESS_1_8:
+        try:
+            return np.linalg.solve(a, b[..., None])[..., 0]
+        except np.linalg.LinAlgError:
+            pass
+        # Only solve the regular systems together, the singular ones have an
+        # exactly zero determinant (a zero pivot of the LU factorization)
+        x = np.empty(b.shape)
+        regular = np.linalg.det(a) != 0
+        x[~regular] = np.nan
+        try:
+            x[regular] = np.linalg.solve(a[regular],
+                                         b[regular][..., None])[..., 0]
+            return x
+        except np.linalg.LinAlgError:
+            pass
+    x = np.empty_like(b)
+    for i in range(len(a)):
+        try:
+            x[i] = np.linalg.solve(a[i], b[i])
+        except np.linalg.LinAlgError:
+            x[i] = np.nan
+    return x
+
+
+def bounded_lm(func, x0, data, lower, upper, max_iter=1000, ftol=1e-15,
+               xtol=1e-15, x_scale=None):
+    """Batched Levenberg-Marquardt least squares fit with bounds.
+
+    The normal equations of all voxels are solved together, each voxel with
+    its own damping factor, and the updated parameters are projected on the
+    bounds. Voxels are removed from the iterations as they converge.
+
+    Parameters
+    ----------
+    func : callable
+        ``func(x, voxels)`` returns the (n, g) signals predicted by the (n, p)
+        parameters `x` of the voxels indexed by `voxels`, and their (n, g, p)
+        Jacobian.
+    x0 : array (n, p)
+        Initial parameters, within the bounds.
+    data : array (n, g)
+        The measured signals.
+    lower, upper : array (p,)
+        Bounds of the parameters.
+    max_iter : int
+        Maximum number of iterations.
+    ftol, xtol : float
+        Tolerances on the relative reduction of the cost and on the relative
+        change of the parameters.
+    x_scale : array (p,), optional
+        Characteristic scales of the parameters. The damping is then the same
+        for all the parameters divided by `x_scale`, as with the `x_scale`
+        of ``scipy.optimize.least_squares``. By default, the damping of each
+        parameter is proportional to the diagonal of the normal equations
+        (Marquardt's scaling).
+
+    Returns
+    -------
+    x : array (n, p)
+        The fitted parameters.
+    """
+    x = np.array(x0, dtype=float)
+    n, p = x.shape
+    diag = np.arange(p)
+    lm_lambda = np.ones(n) * 1e-3
+    if x_scale is not None:
+        scale2 = np.asarray(x_scale, dtype=float) ** 2
+    active = np.arange(n)
+    with np.errstate(over='ignore', under='ignore', invalid='ignore'):
+        pred, jac = func(x, active)
+        cost = np.sum((data - pred) ** 2, axis=-1)
+        for _ in range(max_iter):
+            if active.size == 0:
+                break
+            J = jac[active]
+            residuals = data[active] - pred[active]
+            A = np.einsum('ngi,ngj->nij', J, J)
+            grad = np.einsum('ngi,ng->ni', J, residuals)
+            A_diag = A[:, diag, diag]
+            if x_scale is None:
+                A_diag = A_diag + 1e-15 * np.max(A_diag, axis=-1)[:, None]
+            else:
+                A_diag = (np.mean(A_diag * scale2, axis=-1)[:, None] /
+                          scale2)
+            A[:, diag, diag] += lm_lambda[active, None] * A_diag
+            # Parameters on a bound that the descent direction points
+            # beyond are kept fixed for this step
+            x_active = x[active]
+            fixed = (((x_active <= lower) & (grad < 0)) |
+                     ((x_active >= upper) & (grad > 0)))
+            A *= ~(fixed[:, :, None] | fixed[:, None, :])
+            A[:, diag, diag] += fixed
+            grad[fixed] = 0
+            delta = solve_stacked(A, grad)
+
+            new_x = np.clip(x_active + delta, lower, upper)
+            new_pred, new_jac = func(new_x, active)
+            new_cost = np.sum((data[active] - new_pred) ** 2, axis=-1)
+
+            better = new_cost <= cost[active]
+            step = new_x - x_active
+            improved = active[better]
+            reduction = cost[improved] - new_cost[better]
+            x[improved] = new_x[better]
+            pred[improved] = new_pred[better]
+            jac[improved] = new_jac[better]
+            lm_lambda[active] = np.where(better, lm_lambda[active] / 10,
+                                         lm_lambda[active] * 10)
+
+            converged = np.all(np.abs(step) <= xtol * (np.abs(new_x) + xtol),
+                               axis=-1)
+            converged[better] |= reduction <= ftol * cost[improved]
+            cost[improved] = new_cost[better]
+            converged |= lm_lambda[active] > 1e16
+            active = active[~converged]
+    return x
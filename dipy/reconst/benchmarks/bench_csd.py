@@ -2,9 +2,11 @@
 import numpy as np
 import numpy.testing as npt
 
-from dipy.reconst.csdeconv import ConstrainedSphericalDeconvModel
+from dipy.reconst.csdeconv import (ConstrainedSphericalDeconvModel,
+                                   auto_response, csdeconv, csdeconv_batch)
 from dipy.core.gradients import GradientTable
-from dipy.data import read_stanford_labels
+from dipy.data import read_stanford_labels, read_stanford_hardi
+from dipy.segment.mask import median_otsu
 
 
 def num_grad(gtab):
@@ -51,5 +53,32 @@ def bench_csdeconv(center=(50, 40, 40), width=12):
     time = npt.measure(cmd)
     print(msg % (sh_order, num_grad(gtab), time))
 
+
+def bench_csdeconv_batch(chunk_size=1024):
+    img, gtab = read_stanford_hardi()
+    data = img.get_data()
+    _, mask = median_otsu(data, 3, 1, False, vol_idx=range(10, 50),
+                          dilate=2)
+    response, _ = auto_response(gtab, data, roi_radius=10, fa_thr=0.7)
+    model = ConstrainedSphericalDeconvModel(gtab, response)
+    X, B_reg, tau, P = model._X, model.B_reg, model.tau, model._P
+    dwi = data[mask][:, ~gtab.b0s_mask].astype(float)
+
+    print("== Benchmarking CSD solvers on a full-brain mask of %d voxels =="
+          % len(dwi))
+    loop = "for s in dwi: csdeconv(s, X, B_reg, tau, P=P)"
+    time_loop = npt.measure(loop)
+    print("Per-voxel csdeconv loop :: %g sec" % time_loop)
+
+    batch = ("for i in range(0, len(dwi), chunk_size): "
+             "csdeconv_batch(dwi[i:i + chunk_size], X, B_reg, tau, P=P, "
+             "num_threads=num_threads)")
+    for num_threads in [1, None]:
+        time_batch = npt.measure(batch)
+        print("csdeconv_batch, %s threads :: %g sec (%.1fx speedup)" %
+              (num_threads or "all", time_batch, time_loop / time_batch))
+
+
 if __name__ == "__main__":
     bench_csdeconv()
+    bench_csdeconv_batch()
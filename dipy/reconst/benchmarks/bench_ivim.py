@@ -0,0 +1,47 @@
+""" Benchmarks for IVIM fitting
+
+Run all benchmarks with::
+
+    import dipy.reconst as dire
+    dire.bench()
+
+Run this benchmark with:
+
+    nosetests -s --match '(?:^|[\\b_\\.//-])[Bb]ench' /path/to/bench_ivim.py
+"""
+import warnings
+
+import numpy as np
+
+from dipy.core.gradients import gradient_table, generate_bvecs
+from dipy.reconst.ivim import IvimModel, ivim_prediction
+
+from numpy.testing import measure
+
+
+def bench_ivim_fit(n_voxels=1000):
+    bvals = np.array([0., 10., 20., 30., 40., 60., 80., 100., 120., 140.,
+                      160., 180., 200., 300., 400., 500., 600., 700., 800.,
+                      900., 1000.])
+    gtab = gradient_table(bvals, generate_bvecs(len(bvals)).T)
+    rng = np.random.RandomState(0)
+    params = np.column_stack([rng.uniform(500, 1500, n_voxels),
+                              rng.uniform(0.05, 0.25, n_voxels),
+                              rng.uniform(0.005, 0.02, n_voxels),
+                              rng.uniform(0.0005, 0.002, n_voxels)])
+    data = ivim_prediction(params, gtab)
+    data = np.abs(data + rng.normal(0, 10, data.shape))
+    ivim_model = IvimModel(gtab)
+
+    print("== Benchmarking IVIM fit of %d voxels ==" % n_voxels)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        time_voxel = measure("for s in data: ivim_model.fit(s)")
+        print("Per-voxel fit :: %g sec" % time_voxel)
+        time_batch = measure("ivim_model.fit(data)")
+        print("Batched fit :: %g sec (%.1fx speedup)" %
+              (time_batch, time_voxel / time_batch))
+
+
+if __name__ == "__main__":
+    bench_ivim_fit()
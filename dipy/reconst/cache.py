@@ -1,4 +1,236 @@
-from dipy.core.onetime import auto_attr
+import hashlib
+import numbers
+import os
+import tempfile
+import threading
+import types
+from collections import namedtuple, OrderedDict
+
+import numpy as np
+
+from dipy.core.onetime import auto_attr, OneTimeProperty
+from dipy.core.sphere import Sphere
+from dipy.utils.six import string_types
+
+
+def _update_hash(h, obj, seen):
+    """Feed a stable description of `obj` to the hash object `h`.
+
+    Raises TypeError for objects that cannot be described reliably.
+    """
+    if obj is None or isinstance(obj, (bool, numbers.Number, np.generic,
+                                       string_types)):
+        h.update(repr((type(obj).__name__, obj)).encode('utf-8'))
+        return
+    if isinstance(obj, (type, types.FunctionType, types.BuiltinFunctionType)):
+        h.update(('%s.%s' % (obj.__module__, obj.__name__)).encode('utf-8'))
+        return
+    if id(obj) in seen:
+        raise TypeError("Cannot hash self-referencing objects")
+    seen = seen | set([id(obj)])
+    if isinstance(obj, np.ndarray):
+        if obj.dtype.hasobject:
+            raise TypeError("Cannot hash object arrays")
+        h.update(repr(('ndarray', obj.dtype.str, obj.shape)).encode('utf-8'))
+        h.update(np.ascontiguousarray(obj).data)
+    elif isinstance(obj, (tuple, list)):
+        h.update(repr((type(obj).__name__, len(obj))).encode('utf-8'))
+        for item in obj:
+            _update_hash(h, item, seen)
+    elif isinstance(obj, dict):
+        h.update(repr(('dict', len(obj))).encode('utf-8'))
+        for k in sorted(obj, key=repr):
+            _update_hash(h, k, seen)
+            _update_hash(h, obj[k], seen)
+    elif isinstance(obj, Sphere):
+        _update_hash(h, type(obj), seen)
+        _update_hash(h, obj.vertices, seen)
+    elif hasattr(obj, '__dict__'):
+        _update_hash(h, type(obj), seen)
+        _update_hash(h, _object_state(obj), seen)
+    else:
+        raise TypeError("Cannot hash objects of type %s" % type(obj))
+
+
+def _object_state(obj, public=False):
+    """Instance attributes of `obj`, except the one-time computed ones."""
+    cls = type(obj)
+    return dict((name, value) for name, value in vars(obj).items()
+                if not isinstance(getattr(cls, name, None), OneTimeProperty) and
+                not (public and name.startswith('_')))
+
+
+def stable_hash(*objs):
+    """Hash objects by their content, consistently across processes.
+
+    Parameters
+    ----------
+    objs : objects
+        Numbers, strings, arrays, spheres, gradient tables, models and
+        (nested) tuples, lists and dicts of those.
+
+    Returns
+    -------
+    digest : str
+        Hexadecimal SHA-1 digest of the objects.
+
+    Raises
+    ------
+    TypeError
+        If an object cannot be described by its content.
+
+    """
+    h = hashlib.sha1()
+    _update_hash(h, objs, set())
+    return h.hexdigest()
+
+
+class DiskCache(object):
+    """Content addressed store of arrays, shared by processes through disk.
+
+    Parameters
+    ----------
+    path : str
+        Directory where the arrays are stored, created if needed. Several
+        processes, possibly on different machines of a cluster, can use the
+        same directory concurrently.
+    max_bytes : int, optional
+        Maximum total size of the stored arrays. The least recently used
+        arrays are removed when it is exceeded. Unbounded by default.
+    mmap_mode : {None, 'r'}, optional
+        If 'r' (default), arrays are memory-mapped read-only instead of
+        being read in memory.
+
+    Notes
+    -----
+    Each array is stored in its own ``.npy`` file named after its key. Files
+    are first written under a temporary name and then renamed, so readers
+    never see partially written arrays. The access time of an array is
+    recorded in the modification time of its file.
+
+    Examples
+    --------
+    To share the matrices computed by all models across processes::
+
+        from dipy.reconst.cache import Cache, DiskCache
+        Cache.disk_cache = DiskCache('/scratch/dipy_cache', max_bytes=2**30)
+
+    """
+
+    def __init__(self, path, max_bytes=None, mmap_mode='r'):
+        if max_bytes is not None and max_bytes <= 0:
+            raise ValueError("max_bytes must be positive, got %s" % max_bytes)
+        if mmap_mode not in (None, 'r'):
+            raise ValueError("mmap_mode must be None or 'r', got %r" %
+                             (mmap_mode,))
+        self.path = path
+        self.max_bytes = max_bytes
+        self.mmap_mode = mmap_mode
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                # Created by another process in the meantime
+                if not os.path.isdir(path):
+                    raise
+
+    def _filename(self, key):
+        return os.path.join(self.path, key + '.npy')
+
+    def get(self, key, default=None):
+        """Return the array stored under `key`, or `default`."""
+        filename = self._filename(key)
+        try:
+            value = np.load(filename, mmap_mode=self.mmap_mode)
+            os.utime(filename, None)
+        except (IOError, OSError, ValueError):
+            # Missing, or removed by another process
+            return default
+        return value.view(np.ndarray)
+
+    def set(self, key, value):
+        """Store the array `value` under `key`."""
+        value = np.asarray(value)
+        if value.dtype.hasobject:
+            raise TypeError("Cannot store object arrays on disk")
+        if self.max_bytes is not None and value.nbytes > self.max_bytes:
+            return
+        fd, tmp_filename = tempfile.mkstemp(suffix='.tmp', dir=self.path)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, value)
+            _replace(tmp_filename, self._filename(key))
+        except BaseException:
+            _remove(tmp_filename)
+            raise
+        if self.max_bytes is not None:
+            self._evict()
+
+    def _entries(self):
+        """(access time, size, filename) of the stored arrays."""
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith('.npy'):
+                continue
+            filename = os.path.join(self.path, name)
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, filename))
+        return entries
+
+    def _evict(self):
+        entries = sorted(self._entries())
+        nbytes = sum(size for _, size, _ in entries)
+        for _, size, filename in entries:
+            if nbytes <= self.max_bytes:
+                break
+            _remove(filename)
+            nbytes -= size
+
+    def nbytes(self):
+        """Total size of the stored arrays on disk."""
+        return sum(size for _, size, _ in self._entries())
+
+    def clear(self):
+        """Remove all stored arrays."""
+        for _, _, filename in self._entries():
+            _remove(filename)
+
+
+def _replace(src, dst):
+    try:
+        os.replace(src, dst)
+    except AttributeError:
+        # Python 2, rename replaces existing files atomically on POSIX
+        os.rename(src, dst)
+
+
+def _remove(filename):
+    try:
+        os.remove(filename)
+    except OSError:
+        pass
+
+
+def _nbytes(value):
+    """Memory used by the arrays in `value`."""
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (tuple, list)):
+        return sum(_nbytes(item) for item in value)
+    return 0
+
+
+# Guards the in-memory caches of all models, which the threads of the 'thread'
+# backend of multi_voxel_fit share. It is not an attribute of the models so
+# that they can still be pickled.
+_cache_lock = threading.RLock()
+
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'evictions',
+                                     'entries', 'nbytes', 'max_bytes'])
 
 
 class Cache(object):
@@ -23,14 +255,57 @@ class Cache(object):
                 M = self._compute_basis_matrix(sphere)
                 self.model.cache_set('odf_basis_matrix', key=sphere, value=M)
 
+    Cached arrays can also be shared between processes by setting the
+    `disk_cache` attribute to a `DiskCache`, either on a model, a model
+    class, or on `Cache` itself for all models. Arrays are then stored on
+    disk under a hash of the tag, the key and the public attributes of the
+    model, and are looked up there when missing from memory. Values that
+    are not arrays, and keys or models that cannot be hashed by content, are
+    only cached in memory.
+
+    The memory used by the cached arrays can be bounded by setting
+    `cache_max_bytes`, in which case the least recently used values are
+    evicted when the budget is exceeded. `cache_info` reports how well the
+    cache performs.
+
     """
 
+    #: `DiskCache` where arrays are also stored, None to only use memory
+    disk_cache = None
+
+    #: Maximum memory used by the cached arrays, None for no limit
+    cache_max_bytes = None
+
     # We use this method instead of __init__ to construct the cache, so
     # that the class can be used as a mixin, without having to worry about
     # calling the super-class constructor
     @auto_attr
     def _cache(self):
-        return {}
+        return OrderedDict()
+
+    @auto_attr
+    def _cache_stats(self):
+        return dict(hits=0, misses=0, evictions=0, nbytes=0)
+
+    def _cache_store(self, tag, key, value):
+        """Store `value` in memory, evicting the least recently used ones."""
+        nbytes = _nbytes(value)
+        max_bytes = self.cache_max_bytes
+        with _cache_lock:
+            cache = self._cache
+            stats = self._cache_stats
+            old = cache.pop((tag, key), None)
+            if old is not None:
+                stats['nbytes'] -= _nbytes(old)
+            if max_bytes is not None and nbytes > max_bytes:
+                stats['evictions'] += 1
+                return
+            cache[(tag, key)] = value
+            stats['nbytes'] += nbytes
+            while max_bytes is not None and stats['nbytes'] > max_bytes:
+                _, old = cache.popitem(last=False)
+                stats['nbytes'] -= _nbytes(old)
+                stats['evictions'] += 1
 
     def cache_set(self, tag, key, value):
         """Store a value in the cache.
@@ -63,7 +338,11 @@ class Cache(object):
         True
 
         """
-        self._cache[(tag, key)] = value
+        self._cache_store(tag, key, value)
+        if self.disk_cache is not None and isinstance(value, np.ndarray):
+            disk_key = self._disk_cache_key(tag, key)
+            if disk_key is not None and not value.dtype.hasobject:
+                self.disk_cache.set(disk_key, value)
 
     def cache_get(self, tag, key, default=None):
         """Retrieve a value from the cache.
@@ -84,10 +363,75 @@ class Cache(object):
             `default` if no cached entry is found.
 
         """
-        return self._cache.get((tag, key), default)
+        with _cache_lock:
+            try:
+                # Move the value last, as most recently used
+                value = self._cache.pop((tag, key))
+                self._cache[(tag, key)] = value
+                self._cache_stats['hits'] += 1
+                return value
+            except KeyError:
+                pass
+        if self.disk_cache is not None:
+            disk_key = self._disk_cache_key(tag, key)
+            if disk_key is not None:
+                value = self.disk_cache.get(disk_key)
+                if value is not None:
+                    self._cache_store(tag, key, value)
+                    with _cache_lock:
+                        self._cache_stats['hits'] += 1
+                    return value
+        with _cache_lock:
+            self._cache_stats['misses'] += 1
+        return default
 
     def cache_clear(self):
-        """Clear the cache.
+        """Clear the cache and its statistics.
+
+        Arrays stored in the `disk_cache` are kept.
 
         """
-        self._cache = {}
+        with _cache_lock:
+            self._cache = OrderedDict()
+            self._cache_stats = dict(hits=0, misses=0, evictions=0,
+                                     nbytes=0)
+
+    def cache_info(self):
+        """Report the statistics of the cache.
+
+        Returns
+        -------
+        info : CacheInfo
+            Named tuple with the number of ``hits``, ``misses`` and
+            ``evictions`` since the cache was last cleared, the number of
+            cached ``entries``, the memory used by the cached arrays in
+            ``nbytes`` and the ``max_bytes`` budget.
+
+        Examples
+        --------
+        >>> c = Cache()
+        >>> c.cache_max_bytes = 1000
+        >>> c.cache_set('matrix', 1, np.zeros(100))
+        >>> c.cache_set('matrix', 2, np.zeros(100))
+        >>> c.cache_get('matrix', 1) is None
+        True
+        >>> info = c.cache_info()
+        >>> info.misses, info.evictions, info.entries, info.nbytes
+        (1, 1, 1, 800)
+
+        """
+        with _cache_lock:
+            stats = self._cache_stats
+            return CacheInfo(stats['hits'], stats['misses'],
+                             stats['evictions'], len(self._cache),
+                             stats['nbytes'], self.cache_max_bytes)
+
+    def _disk_cache_key(self, tag, key):
+        """Content hash of the model, tag and key, None if not hashable."""
+        state = _object_state(self, public=True)
+        state.pop('disk_cache', None)
+        state.pop('cache_max_bytes', None)
+        try:
+            return stable_hash(type(self), state, tag, key)
+        except TypeError:
+            return None
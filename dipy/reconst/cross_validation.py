@@ -4,8 +4,13 @@ Cross-validation analysis of diffusion models
 from __future__ import division, print_function, absolute_import
 from dipy.utils.six.moves import range
 
+from collections import OrderedDict
+from threading import Lock
+
 import numpy as np
 import dipy.core.gradients as gt
+from dipy.reconst.cache import stable_hash
+from dipy.reconst.multi_voxel import check_backend, worker_pool
 
 
 def coeff_of_determination(data, model, axis=-1):
@@ -57,6 +62,80 @@ def coeff_of_determination(data, model, axis=-1):
     return 100 * (1 - (ss_err/ss_tot))
 
 
+# Models (and left out gradient tables) of the folds of kfold_xval, keyed by
+# the model class and arguments and by the split of the gradient table, so
+# that repeated cross-validations with the same split skip the model setup
+_fold_models = OrderedDict()
+_fold_models_lock = Lock()
+_FOLD_MODELS_MAX = 32
+
+# Data shared by the workers of a process pool, set once per worker by
+# ``_init_xval_worker``
+_worker_data = None
+
+
+def _init_xval_worker(data, mask, S0):
+    global _worker_data
+    _worker_data = (data, mask, S0)
+
+
+def _fold_model(model, keep, left_out, model_args, model_kwargs):
+    """The model of the measurements `keep` of `model.gtab` and the
+    gradient table of the measurements `left_out`."""
+    gtab = model.gtab
+    try:
+        key = stable_hash(type(model), gtab.bvals[keep], gtab.bvecs[keep],
+                          gtab.bvals[left_out], gtab.bvecs[left_out],
+                          model_args, model_kwargs)
+    except TypeError:
+        key = None
+    with _fold_models_lock:
+        if key in _fold_models:
+            _fold_models[key] = _fold_models.pop(key)
+            return _fold_models[key]
+
+    gtgt = gt.gradient_table  # Shorthand
+    this_gtab = gtgt(gtab.bvals[keep], gtab.bvecs[keep])
+    left_out_gtab = gtgt(gtab.bvals[left_out], gtab.bvecs[left_out])
+    this_model = model.__class__(this_gtab, *model_args, **model_kwargs)
+    if key is not None:
+        with _fold_models_lock:
+            _fold_models[key] = (this_model, left_out_gtab)
+            while len(_fold_models) > _FOLD_MODELS_MAX:
+                _fold_models.popitem(last=False)
+    return this_model, left_out_gtab
+
+
+def _xval_fold(model, data, mask, S0, fold_mask, model_args, model_kwargs):
+    """Fit `model` without the diffusion-weighted measurements that are False
+    in `fold_mask`, and predict them.
+
+    Returns the indices of the predicted measurements in `data`, and their
+    predictions.
+    """
+    gtab = model.gtab
+    b0_idx = np.flatnonzero(gtab.b0s_mask)
+    dw_idx = np.flatnonzero(~gtab.b0s_mask)
+    keep = np.concatenate([b0_idx, dw_idx[fold_mask]])
+    left_out = np.concatenate([b0_idx, dw_idx[~fold_mask]])
+
+    this_model, left_out_gtab = _fold_model(model, keep, left_out,
+                                            model_args, model_kwargs)
+    this_fit = this_model.fit(np.take(data, keep, axis=-1), mask=mask)
+    if not hasattr(this_fit, 'predict'):
+        err_str = "Models of type: %s " % this_model.__class__
+        err_str += "do not have an implementation of model prediction"
+        err_str += " and do not support cross-validation"
+        raise ValueError(err_str)
+    this_predict = this_fit.predict(left_out_gtab, S0=1)[..., len(b0_idx):]
+    return dw_idx[~fold_mask], S0[..., None] * this_predict
+
+
+def _xval_fold_in_process(args):
+    data, mask, S0 = _worker_data
+    return _xval_fold(args[0], data, mask, S0, *args[1:])
+
+
 def kfold_xval(model, data, folds, *model_args, **model_kwargs):
     """
     Perform k-fold cross-validation to generate out-of-sample predictions for
@@ -81,7 +160,18 @@ def kfold_xval(model, data, folds, *model_args, **model_kwargs):
         Additional key-word arguments to the model initialization. If contains
         the kwarg `mask`, this will be used as a key-word argument to the `fit`
         method of the model object, rather than being used in the
-        initialization of the model object
+        initialization of the model object. Likewise, the kwargs `backend`
+        (``'serial'``, ``'thread'`` or ``'process'``, default ``'serial'``)
+        and `nbr_workers` (default ``multiprocessing.cpu_count()``) set how
+        the folds are run: one after the other, or concurrently by a pool of
+        threads or processes. The ``'process'`` backend requires the model to
+        be picklable.
+
+    Returns
+    -------
+    prediction : ndarray
+        The out-of-sample predictions, with the shape of `data`, and its type
+        if it is a floating point type (float64 otherwise).
 
     Notes
     -----
@@ -94,6 +184,10 @@ def kfold_xval(model, data, folds, *model_args, **model_kwargs):
     It also assumes that the model object has `bval` and `bvec` attributes
     holding b-values and corresponding unit vectors.
 
+    The models of the folds are cached, so that repeated cross-validations
+    with the same split of the measurements (for example, with the same
+    random seed) do not set them up again.
+
     References
     ----------
     .. [1] Rokem, A., Chan, K.L. Yeatman, J.D., Pestilli, F., Mezer, A.,
@@ -103,54 +197,63 @@ def kfold_xval(model, data, folds, *model_args, **model_kwargs):
     # This should always be there, if the model inherits from
     # dipy.reconst.base.ReconstModel:
     gtab = model.gtab
-    data_b = data[..., ~gtab.b0s_mask]
-    div_by_folds = np.mod(data_b.shape[-1], folds)
+    n_dw = np.count_nonzero(~gtab.b0s_mask)
+    div_by_folds = np.mod(n_dw, folds)
     # Make sure that an equal number of samples get left out in each fold:
     if div_by_folds != 0:
         msg = "The number of folds must divide the diffusion-weighted "
         msg += "data equally, but "
-        msg = "np.mod(%s, %s) is %s" % (data_b.shape[-1], folds, div_by_folds)
+        msg = "np.mod(%s, %s) is %s" % (n_dw, folds, div_by_folds)
         raise ValueError(msg)
 
-    data_0 = data[..., gtab.b0s_mask]
-    S0 = np.mean(data_0, -1)
-    n_in_fold = data_b.shape[-1] / folds
-    prediction = np.zeros(data.shape)
-    # We are going to leave out some randomly chosen samples in each iteration:
-    order = np.random.permutation(data_b.shape[-1])
-
-    nz_bval = gtab.bvals[~gtab.b0s_mask]
-    nz_bvec = gtab.bvecs[~gtab.b0s_mask]
-
-    # Pop the mask, if there is one, out here for use in every fold:
+    # Pop the mask and the backend, if there are some, out here for use in
+    # every fold:
     mask = model_kwargs.pop('mask', None)
-    gtgt = gt.gradient_table  # Shorthand
+    backend = model_kwargs.pop('backend', 'serial')
+    nbr_workers = model_kwargs.pop('nbr_workers', None)
+    backend, nbr_workers = check_backend(backend, nbr_workers)
+
+    S0 = np.mean(data[..., gtab.b0s_mask], -1)
+    n_in_fold = n_dw / folds
+    if np.issubdtype(data.dtype, np.floating):
+        prediction = np.zeros(data.shape, dtype=data.dtype)
+    else:
+        prediction = np.zeros(data.shape)
+    # We are going to leave out some randomly chosen samples in each iteration:
+    order = np.random.permutation(n_dw)
+    fold_masks = []
     for k in range(folds):
-        fold_mask = np.ones(data_b.shape[-1], dtype=bool)
-        fold_idx = order[int(k * n_in_fold): int((k + 1) * n_in_fold)]
-        fold_mask[fold_idx] = False
-        this_data = np.concatenate([data_0, data_b[..., fold_mask]], -1)
-
-        this_gtab = gtgt(np.hstack([gtab.bvals[gtab.b0s_mask],
-                                    nz_bval[fold_mask]]),
-                         np.concatenate([gtab.bvecs[gtab.b0s_mask],
-                                         nz_bvec[fold_mask]]))
-        left_out_gtab = gtgt(np.hstack([gtab.bvals[gtab.b0s_mask],
-                                        nz_bval[~fold_mask]]),
-                             np.concatenate([gtab.bvecs[gtab.b0s_mask],
-                                             nz_bvec[~fold_mask]]))
-        this_model = model.__class__(this_gtab, *model_args, **model_kwargs)
-        this_fit = this_model.fit(this_data, mask=mask)
-        if not hasattr(this_fit, 'predict'):
-            err_str = "Models of type: %s " % this_model.__class__
-            err_str += "do not have an implementation of model prediction"
-            err_str += " and do not support cross-validation"
-            raise ValueError(err_str)
-        this_predict = S0[..., None] * this_fit.predict(left_out_gtab, S0=1)
-
-        idx_to_assign = np.where(~gtab.b0s_mask)[0][~fold_mask]
-        prediction[..., idx_to_assign] =\
-            this_predict[..., np.sum(gtab.b0s_mask):]
+        fold_mask = np.ones(n_dw, dtype=bool)
+        fold_mask[order[int(k * n_in_fold): int((k + 1) * n_in_fold)]] = False
+        fold_masks.append(fold_mask)
+
+    if backend == 'serial' or folds == 1:
+        for fold_mask in fold_masks:
+            idx, fold_prediction = _xval_fold(model, data, mask, S0,
+                                              fold_mask, model_args,
+                                              model_kwargs)
+            prediction[..., idx] = fold_prediction
+    else:
+        pool = worker_pool(backend, min(nbr_workers, folds),
+                           _init_xval_worker, (data, mask, S0))
+        try:
+            if backend == 'thread':
+                def run_fold(fold_mask):
+                    # Each fold predicts its own measurements
+                    idx, fold_prediction = _xval_fold(model, data, mask, S0,
+                                                      fold_mask, model_args,
+                                                      model_kwargs)
+                    prediction[..., idx] = fold_prediction
+                pool.map(run_fold, fold_masks)
+            else:
+                tasks = [(model, fold_mask, model_args, model_kwargs)
+                         for fold_mask in fold_masks]
+                for idx, fold_prediction in pool.imap_unordered(
+                        _xval_fold_in_process, tasks):
+                    prediction[..., idx] = fold_prediction
+        finally:
+            pool.close()
+            pool.join()
 
     # For the b0 measurements
     prediction[..., gtab.b0s_mask] = S0[..., None]
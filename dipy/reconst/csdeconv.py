@@ -15,6 +15,7 @@ from dipy.sims.voxel import single_tensor
 from dipy.utils.six.moves import range
 
 from dipy.reconst.multi_voxel import multi_voxel_fit
+from dipy.reconst.recspeed import csd_iterations
 from dipy.reconst.dti import TensorModel, fractional_anisotropy
 from dipy.reconst.shm import (sph_harm_ind_list, real_sph_harm,
                               sph_harm_lookup, lazy_index, SphHarmFit,
@@ -185,6 +186,14 @@ class ConstrainedSphericalDeconvModel(SphHarmModel):
                                 P=self._P)
         return SphHarmFit(self, shm_coeff, None)
 
+    def batch_fit_params(self, data):
+        """Fit the (n, N) data of many voxels at once with `csdeconv_batch`
+        and return their (n, K) SH coefficients."""
+        dwi_data = data[..., self._where_dwi]
+        shm_coeff, _ = csdeconv_batch(dwi_data, self._X, self.B_reg,
+                                      self.tau, P=self._P, num_threads=1)
+        return shm_coeff
+
     def predict(self, sh_coeff, gtab=None, S0=1.):
         """Compute a signal prediction given spherical harmonic coefficients
         for the provided GradientTable class instance.
@@ -590,6 +599,106 @@ def csdeconv(dwsignal, X, B_reg, tau=0.1, convergence=50, P=None):
     return fodf_sh, num_it
 
 
+def csdeconv_batch(dwsignals, X, B_reg, tau=0.1, convergence=50, P=None,
+                   num_threads=None):
+    r""" Constrained-regularized spherical deconvolution (CSD) of many voxels
+
+    Solves the same problem as :func:`csdeconv`, for all the voxels in
+    `dwsignals` at once.
+
+    Parameters
+    ----------
+    dwsignals : array (n, N)
+        Diffusion weighted signals of ``n`` voxels to be deconvolved.
+    X : array (N, K)
+        Prediction matrix which estimates diffusion weighted signals from FOD
+        coefficients.
+    B_reg : array (M, K)
+        SH basis matrix which maps FOD coefficients to FOD values on the
+        surface of the sphere. B_reg should be scaled to account for lambda.
+    tau : float
+        Threshold controlling the amplitude below which the corresponding fODF
+        is assumed to be zero, see :func:`csdeconv`.
+    convergence : int
+        Maximum number of iterations to allow the deconvolution to converge.
+    P : ndarray
+        Precomputed ``dot(X.T, X)``, see :func:`csdeconv`.
+    num_threads : int, optional
+        Number of threads used for the constrained-regularization
+        iterations. If None (default) then all available threads will be
+        used.
+
+    Returns
+    -------
+    fodf_sh : ndarray (n, K)
+         Spherical harmonics coefficients of the constrained-regularized fiber
+         ODF in each voxel.
+    num_it : ndarray (n,)
+         Number of iterations in the constrained-regularization used for
+         convergence in each voxel.
+
+    Notes
+    -----
+    The unconstrained initial estimates and the initial sets of negative
+    directions are computed for all voxels with matrix products. Voxels
+    without negative directions are done. The iterations of the remaining
+    voxels are run in parallel, without the GIL, by
+    :func:`dipy.reconst.recspeed.csd_iterations`. There, $Q = P + H_{n-1}^T
+    H_{n-1}$ is formed once per voxel and then updated with the few
+    directions that changed sign at each iteration, which is much cheaper
+    than forming it again as done in :func:`csdeconv`.
+    """
+    mu = 1e-5
+    if P is None:
+        P = np.dot(X.T, X)
+    z = np.ascontiguousarray(np.dot(dwsignals, X), dtype=float)
+
+    try:
+        fodf_sh = la.cho_solve(la.cho_factor(P), z.T).T
+    except la.LinAlgError:
+        P = P + mu * np.eye(P.shape[0])
+        fodf_sh = la.cho_solve(la.cho_factor(P), z.T).T
+    fodf_sh = np.ascontiguousarray(fodf_sh)
+
+    # For the first iteration we use a smooth FOD that only uses SH orders up
+    # to 4 (the first 15 coefficients).
+    fodf = np.dot(fodf_sh[:, :15], B_reg[:, :15].T)
+    threshold = B_reg[0, 0] * fodf_sh[:, 0] * tau
+    fodf_small = fodf < threshold[:, None]
+
+    # If the low-order fodf does not have any values less than threshold, the
+    # full-order fodf is used. Voxels where it still has no values less than
+    # threshold are done.
+    smooth = ~fodf_small.any(axis=1)
+    fodf_small[smooth] = (np.dot(fodf_sh[smooth], B_reg.T) <
+                          threshold[smooth, None])
+    num_it = np.zeros(len(fodf_sh), dtype=np.intp)
+    active = np.flatnonzero(fodf_small.any(axis=1)).astype(np.intp)
+
+    # Initial Q = P + dot(H.T, H) of all voxels, computed with a matrix
+    # product with the outer products of the rows of B_reg. Only the lower
+    # triangle of Q is needed.
+    tril = np.tril_indices(B_reg.shape[1])
+    B_outer = B_reg[:, tril[0]] * B_reg[:, tril[1]]
+    Q_tril = P[tril] + np.dot(fodf_small[active].astype(float), B_outer)
+
+    status = csd_iterations(z, fodf_sh, Q_tril,
+                            np.ascontiguousarray(B_reg, dtype=float),
+                            threshold, fodf_small.view(np.uint8), active,
+                            num_it, convergence, num_threads)
+
+    if np.any(status == -1):
+        msg = ("%d-th voxel: leading minor not positive definite" %
+               np.flatnonzero(status == -1)[0])
+        raise la.LinAlgError(msg)
+    if np.any(status == 1):
+        msg = ('maximum number of iterations exceeded - failed to converge '
+               'in %d voxels' % np.sum(status == 1))
+        warnings.warn(msg)
+
+    return fodf_sh, num_it
+
+
 def odf_deconv(odf_sh, R, B_reg, lambda_=1., tau=0.1, r2_term=False):
     r""" ODF constrained-regularized spherical deconvolution using
     the Sharpening Deconvolution Transform (SDT) [1]_, [2]_.
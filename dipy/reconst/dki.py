@@ -1143,8 +1143,287 @@ def _voxel_kurtosis_maximum(dt, md, kt, sphere, gtol=1e-2):
     return max_value, max_direction
 
 
+# Exponents of x, y and z, and multiplicities, of the monomials weighted by
+# the elements of the diffusion tensor (see directional_diffusion) and of the
+# kurtosis tensor (see directional_diffusion_variance)
+_DT_EXPONENTS = np.array([[2, 0, 0], [1, 1, 0], [0, 2, 0], [1, 0, 1],
+                          [0, 1, 1], [0, 0, 2]])
+_DT_MULTIPLICITY = np.array([1., 2., 1., 2., 2., 1.])
+_KT_EXPONENTS = np.array([[4, 0, 0], [0, 4, 0], [0, 0, 4], [3, 1, 0],
+                          [3, 0, 1], [1, 3, 0], [0, 3, 1], [1, 0, 3],
+                          [0, 1, 3], [2, 2, 0], [2, 0, 2], [0, 2, 2],
+                          [2, 1, 1], [1, 2, 1], [1, 1, 2]])
+_KT_MULTIPLICITY = np.array([1., 1., 1., 4., 4., 4., 4., 4., 4., 6., 6., 6.,
+                             12., 12., 12.])
+
+
+def _monomials(V, exponents, multiplicity, order=0):
+    """ Monomials of the coordinates of directions V (..., 3) and, up to
+    `order`, their first and second derivatives with respect to the
+    coordinates.
+
+    Returns arrays of shapes (..., m), (..., m, 3) and (..., m, 3, 3) for m
+    monomials.
+    """
+    V = V[..., None, :]
+
+    def derivative(coef, exps):
+        return multiplicity * coef * np.prod(V ** np.maximum(exps, 0),
+                                             axis=-1)
+
+    values = derivative(1, exponents)
+    if order == 0:
+        return values
+    unit = np.eye(3, dtype=int)
+    grads = np.empty(values.shape + (3,))
+    hess = np.empty(values.shape + (3, 3))
+    for a in range(3):
+        grads[..., a] = derivative(exponents[:, a], exponents - unit[a])
+        for b in range(a, 3):
+            coef = exponents[:, a] * (exponents[:, b] - unit[a, b])
+            hess[..., a, b] = hess[..., b, a] = derivative(
+                coef, exponents - unit[a] - unit[b])
+    return values, grads, hess
+
+
+def _directional_kurtosis_derivatives(dt, md, kt, V, min_kurtosis=-3./7):
+    """ Apparent kurtosis coefficients of many voxels, each in its own
+    direction, with their gradients and Hessians with respect to the
+    directions.
+
+    Parameters
+    ----------
+    dt : array (n, 6)
+        elements of the diffusion tensors.
+    md : array (n,)
+        mean diffusivities.
+    kt : array (n, 15)
+        elements of the kurtosis tensors.
+    V : array (n, 3)
+        one unit direction per voxel.
+    min_kurtosis : float (optional)
+        Directional kurtosis values smaller than `min_kurtosis` are replaced
+        with `min_kurtosis`, and have zero derivatives.
+
+    Returns
+    -------
+    akc : array (n,)
+        Apparent kurtosis coefficients.
+    grad : array (n, 3)
+        Gradients of the coefficients.
+    hess : array (n, 3, 3)
+        Hessians of the coefficients.
+    """
+    P, dP, d2P = _monomials(V, _DT_EXPONENTS, _DT_MULTIPLICITY, order=2)
+    Q, dQ, d2Q = _monomials(V, _KT_EXPONENTS, _KT_MULTIPLICITY, order=2)
+    adc = np.sum(dt * P, axis=-1)[:, None]
+    adv = np.sum(kt * Q, axis=-1)[:, None]
+    adc_grad = np.einsum('nk,nkd->nd', dt, dP)
+    adv_grad = np.einsum('nk,nkd->nd', kt, dQ)
+    adc_hess = np.einsum('nk,nkde->nde', dt, d2P)
+    adv_hess = np.einsum('nk,nkde->nde', kt, d2Q)
+    md2 = (md ** 2)[:, None]
+
+    akc = md2 * adv / adc ** 2
+    grad = md2 * (adv_grad / adc ** 2 - 2 * adv * adc_grad / adc ** 3)
+    cross = adv_grad[:, :, None] * adc_grad[:, None, :]
+    hess = md2[:, :, None] * (
+        adv_hess / adc[:, :, None] ** 2 -
+        2 * (cross + cross.transpose(0, 2, 1)) / adc[:, :, None] ** 3 -
+        2 * (adv / adc ** 3)[:, :, None] * adc_hess +
+        6 * (adv / adc ** 4)[:, :, None] *
+        adc_grad[:, :, None] * adc_grad[:, None, :])
+
+    akc = akc[:, 0]
+    clipped = akc < min_kurtosis
+    grad[clipped] = 0
+    hess[clipped] = 0
+    return akc.clip(min=min_kurtosis), grad, hess
+
+
+def _tangent_basis(V):
+    """ Orthonormal bases (n, 3, 2) of the planes tangent to the sphere at
+    the directions V (n, 3)."""
+    helper = np.zeros_like(V)
+    use_y = np.abs(V[:, 0]) > 0.9
+    helper[~use_y, 0] = 1
+    helper[use_y, 1] = 1
+    b1 = helper - np.sum(helper * V, axis=-1)[:, None] * V
+    b1 /= np.sqrt(np.sum(b1 ** 2, axis=-1))[:, None]
+    b2 = np.cross(V, b1)
+    return np.concatenate((b1[:, :, None], b2[:, :, None]), axis=-1)
+
+
+def _sphere_local_maxima(values, edges):
+    """ Local maxima of many functions sampled on the vertices of a sphere.
+
+    As in `local_maxima`, a vertex is a local maximum if its value is > than
+    at least one of its neighbors and >= than all of them. If a function has
+    no such vertex, its largest vertex is used.
+
+    Parameters
+    ----------
+    values : array (n, g)
+        n functions evaluated on the g vertices of a sphere.
+    edges : array (N, 2)
+        The set of neighbor relations between the vertices.
+
+    Returns
+    -------
+    function_index : array (m,)
+        Index of the function of each of the m maxima found.
+    vertex_index : array (m,)
+        Index of the vertex of each of the m maxima found.
+    """
+    n, g = values.shape
+    neighbors = [[i] for i in range(g)]
+    for i, j in edges:
+        neighbors[i].append(j)
+        neighbors[j].append(i)
+    max_degree = max(len(nb) for nb in neighbors)
+    # pad with the vertex itself, which neither fails nor passes the test
+    neighbors = np.array([nb + [nb[0]] * (max_degree - len(nb))
+                          for nb in neighbors])
+
+    geq_all = np.ones(values.shape, dtype=bool)
+    gt_one = np.zeros(values.shape, dtype=bool)
+    for k in range(1, max_degree):
+        neighbor_values = values[:, neighbors[:, k]]
+        geq_all &= values >= neighbor_values
+        gt_one |= values > neighbor_values
+    is_max = geq_all & gt_one
+    no_max = ~is_max.any(axis=-1)
+    is_max[no_max, np.argmax(values[no_max], axis=-1)] = True
+    return np.nonzero(is_max)
+
+
+def _refine_kurtosis_maximum(dt, md, kt, max_dir, max_value, gtol=1e-2,
+                             max_iter=100):
+    """ Refines directions of maximal kurtosis of many voxels at once.
+
+    The directions are updated in place with damped Newton steps on the
+    sphere, all voxels being updated together, each with its own damping.
+
+    Parameters
+    ----------
+    dt : array (n, 6)
+        elements of the diffusion tensors.
+    md : array (n,)
+        mean diffusivities.
+    kt : array (n, 15)
+        elements of the kurtosis tensors.
+    max_dir : array (n, 3)
+        Initial directions, refined in place.
+    max_value : array (n,)
+        Kurtosis in the initial directions, updated in place.
+    gtol : float, optional
+        The refinement of a voxel stops after the first step taken where the
+        gradient of the kurtosis along the sphere is less than gtol.
+    max_iter : int, optional
+        Maximum number of refinement iterations.
+    """
+    damping = np.ones(len(max_value)) * 1e-3
+    active = np.arange(len(max_value))
+    for _ in range(max_iter):
+        if active.size == 0:
+            break
+        n = max_dir[active]
+        value, grad, hess = _directional_kurtosis_derivatives(
+            dt[active], md[active], kt[active], n)
+
+        # Gradient and Hessian of the kurtosis along the sphere, in a basis
+        # of the tangent plane
+        B = _tangent_basis(n)
+        grad_t = np.einsum('ndi,nd->ni', B, grad)
+        hess_t = np.einsum('ndi,nde,nej->nij', B, hess, B)
+        hess_t -= np.sum(grad * n, axis=-1)[:, None, None] * np.eye(2)
+        grad_norm = np.sqrt(np.sum(grad_t ** 2, axis=-1))
+
+        # Damped Newton step: solve (-H + mu I) s = g for the 2x2 systems
+        M = -hess_t
+        mu = damping[active] * (np.abs(M[:, 0, 0]) + np.abs(M[:, 1, 1]) +
+                                grad_norm)
+        a = M[:, 0, 0] + mu
+        b = M[:, 0, 1]
+        d = M[:, 1, 1] + mu
+        det = a * d - b * b
+        with np.errstate(divide='ignore', invalid='ignore'):
+            s = np.column_stack((d * grad_t[:, 0] - b * grad_t[:, 1],
+                                 a * grad_t[:, 1] - b * grad_t[:, 0]))
+            s /= det[:, None]
+            s[(det <= 0) | (a <= 0)] = np.nan
+            new_dir = n + np.einsum('ndi,ni->nd', B, s)
+            new_dir /= np.sqrt(np.sum(new_dir ** 2, axis=-1))[:, None]
+            new_value, _, _ = _directional_kurtosis_derivatives(
+                dt[active], md[active], kt[active], new_dir)
+
+        better = new_value >= value
+        max_dir[active[better]] = new_dir[better]
+        max_value[active[better]] = np.maximum(new_value[better],
+                                               max_value[active[better]])
+        damping[active] = np.where(better, damping[active] / 10,
+                                   damping[active] * 10)
+        done = (grad_norm < gtol) | (damping[active] > 1e10)
+        active = active[~done]
+
+
+def _kurtosis_maximum_batch(dt, md, kt, sphere, gtol=1e-2, max_iter=100):
+    """ Kurtosis maximum of many voxels at once.
+
+    The directional kurtosis of all voxels is evaluated on the sphere with two
+    matrix products, and its local maxima on the sphere are found for all
+    voxels together. As in `_voxel_kurtosis_maximum`, each local maximum is
+    then refined, here with batched damped Newton steps on the sphere, and the
+    largest refined value of each voxel is kept.
+
+    Parameters
+    ----------
+    dt : array (n, 6)
+        elements of the diffusion tensors.
+    md : array (n,)
+        mean diffusivities.
+    kt : array (n, 15)
+        elements of the kurtosis tensors.
+    sphere : Sphere class instance
+        The sphere providing sample directions for the initial search of the
+        maximum value of kurtosis.
+    gtol : float, optional
+        The refinement of a direction stops after the first step taken where
+        the gradient of the kurtosis along the sphere is less than gtol. If
+        gtol is None, the directions are directly taken from the sphere.
+    max_iter : int, optional
+        Maximum number of refinement iterations.
+
+    Returns
+    -------
+    max_value : array (n,)
+        kurtosis tensor maximum values
+    max_dir : array (n, 3)
+        Cartesian coordinates of the directions of the maximal kurtosis
+        values
+    """
+    P = _monomials(sphere.vertices, _DT_EXPONENTS, _DT_MULTIPLICITY)
+    Q = _monomials(sphere.vertices, _KT_EXPONENTS, _KT_MULTIPLICITY)
+    akc = directional_kurtosis(dt, md[:, None], kt, sphere.vertices,
+                               adc=np.dot(dt, P.T), adv=np.dot(kt, Q.T))
+
+    voxel, vertex = _sphere_local_maxima(akc, sphere.edges)
+    cand_dir = sphere.vertices[vertex]
+    cand_value = akc[voxel, vertex]
+    if gtol is not None:
+        _refine_kurtosis_maximum(dt[voxel], md[voxel], kt[voxel], cand_dir,
+                                 cand_value, gtol=gtol, max_iter=max_iter)
+
+    # keep the largest candidate of each voxel
+    order = np.lexsort((-cand_value, voxel))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = voxel[order][1:] != voxel[order][:-1]
+    best = order[first]
+    return cand_value[best], cand_dir[best]
+
+
 def kurtosis_maximum(dki_params, sphere='repulsion100', gtol=1e-2,
-                     mask=None):
+                     mask=None, chunk_size=10000):
     """ Computes kurtosis maximum value
 
     Parameters
@@ -1168,19 +1447,25 @@ def kurtosis_maximum(dki_params, sphere='repulsion100', gtol=1e-2,
     mask : ndarray
         A boolean array used to mark the coordinates in the data that should be
         analyzed that has the shape dki_params.shape[:-1]
+    chunk_size : int, optional
+        Number of voxels processed at once. Default: 10000
 
     Returns
     --------
     max_value : float
         kurtosis tensor maximum value
-    max_dir : array (3,)
-        Cartesian coordinates of the direction of the maximal kurtosis value
+
+    Notes
+    -----
+    The directional kurtosis of the voxels is first sampled on the sphere,
+    and the local maxima of the samples are then refined with Newton steps on
+    the sphere, for all the voxels of a chunk at once.
     """
     shape = dki_params.shape[:-1]
 
     # load gradient directions
     if not isinstance(sphere, dps.Sphere):
-        sphere = get_sphere('repulsion100')
+        sphere = get_sphere(sphere)
 
     # select voxels where to find fiber directions
     if mask is None:
@@ -1188,6 +1473,9 @@ def kurtosis_maximum(dki_params, sphere='repulsion100', gtol=1e-2,
     else:
         if mask.shape != shape:
             raise ValueError("Mask is not the same shape as dki_params.")
+    if chunk_size <= 0:
+        raise ValueError("chunk_size must be a positive integer, got %d" %
+                         chunk_size)
 
     evals, evecs, kt = split_dki_param(dki_params)
 
@@ -1195,16 +1483,17 @@ def kurtosis_maximum(dki_params, sphere='repulsion100', gtol=1e-2,
     pos_evals = _positive_evals(evals[..., 0], evals[..., 1], evals[..., 2])
     mask = np.logical_and(mask, pos_evals)
 
-    kt_max = np.zeros(mask.shape)
-    dt = lower_triangular(vec_val_vect(evecs, evals))
-    md = mean_diffusivity(evals)
-
-    for idx in ndindex(shape):
-        if not mask[idx]:
-            continue
-        kt_max[idx], da = _voxel_kurtosis_maximum(dt[idx], md[idx], kt[idx],
-                                                  sphere, gtol=gtol)
+    evals, evecs, kt = evals[mask], evecs[mask], kt[mask]
+    kt_max_in_mask = np.empty(len(kt))
+    for i in range(0, len(kt), int(chunk_size)):
+        chunk = slice(i, i + int(chunk_size))
+        dt = lower_triangular(vec_val_vect(evecs[chunk], evals[chunk]))
+        md = mean_diffusivity(evals[chunk])
+        kt_max_in_mask[chunk], _ = _kurtosis_maximum_batch(
+            dt, md, kt[chunk], sphere, gtol=gtol)
 
+    kt_max = np.zeros(mask.shape)
+    kt_max[mask] = kt_max_in_mask
     return kt_max
 
 
@@ -1,9 +1,32 @@
 import numpy as np
 from scipy.ndimage import map_coordinates
-from scipy.fftpack import fftn, fftshift, ifftshift
+from scipy.fftpack import fftshift, ifftshift
+from scipy.sparse import coo_matrix
 from dipy.reconst.odf import OdfModel, OdfFit
 from dipy.reconst.cache import Cache
-from dipy.reconst.multi_voxel import multi_voxel_fit
+
+try:
+    # scipy >= 1.4, whose FFTs can use several threads
+    import scipy.fft as _scipy_fft
+
+    def _fftn(x, axes, nbr_workers=None):
+        return _scipy_fft.fftn(x, axes=axes, workers=nbr_workers)
+
+    def _ifftn(x, axes, nbr_workers=None):
+        return _scipy_fft.ifftn(x, axes=axes, workers=nbr_workers)
+except ImportError:
+    def _fftn(x, axes, nbr_workers=None):
+        return np.fft.fftn(x, axes=axes)
+
+    def _ifftn(x, axes, nbr_workers=None):
+        return np.fft.ifftn(x, axes=axes)
+
+# The axes of the q-space grids (and propagators) in a stack of voxels
+_GRID_AXES = (-3, -2, -1)
+
+# Number of q-space grid points processed at once by the fits, which bounds
+# their memory use
+_GRID_POINTS = 2 ** 22
 
 from dipy.testing import setup_test
 
@@ -128,54 +151,173 @@ class DiffusionSpectrumModel(OdfModel, Cache):
         self.dn = (self.bvals > b0).sum()
         self.gtab = gtab
 
-    @multi_voxel_fit
-    def fit(self, data):
-        return DiffusionSpectrumFit(self, data)
+    def fit(self, data, mask=None, chunk_size=None, nbr_workers=None):
+        """ Fit the model to the signal of one or many voxels
+
+        No work is done here: the returned fit holds the signal array and
+        computes the propagators of its voxels in chunks, filling a stack of
+        q-space grids and running one FFT over the whole stack.
+
+        Parameters
+        ----------
+        data : ndarray (..., N)
+            The signal of one or many voxels.
+        mask : ndarray, optional
+            Boolean array of shape ``data.shape[:-1]``. The propagators, ODFs
+            and metrics of the voxels outside of the mask are set to zero.
+        chunk_size : int, optional
+            The number of voxels processed at once, which bounds the memory
+            used. Default: as many voxels as fit in about 4 million q-space
+            grid points.
+        nbr_workers : int, optional
+            The number of threads used by the FFTs (only with scipy >= 1.4).
+            Default: 1.
+
+        Returns
+        -------
+        fit : DiffusionSpectrumFit
+        """
+        mask = _check_fit_args(data, mask, chunk_size)
+        return DiffusionSpectrumFit(self, data, mask, chunk_size, nbr_workers)
+
+    def _signal_grids(self, values):
+        """ The q-space grids (n, X, X, X) filled with the signal values of
+        n voxels """
+        n_voxels = values.shape[0]
+        grid_shape = 3 * (self.qgrid_size, )
+        # Several gradients may fall on the same grid point, their values are
+        # summed
+        flat_qgrid = np.ravel_multi_index(tuple(self.qgrid.T), grid_shape)
+        order = np.argsort(flat_qgrid, kind='mergesort')
+        points, starts = np.unique(flat_qgrid[order], return_index=True)
+        Sq = np.zeros((n_voxels, np.prod(grid_shape)))
+        Sq[:, points] = np.add.reduceat(values[:, order], starts, axis=1)
+        return Sq.reshape((n_voxels, ) + grid_shape)
+
+    def _pdf_chunk(self, data, normalized=True, nbr_workers=None):
+        """ The propagators (n, X, X, X) of the signals (n, N) of n voxels """
+        Sq = self._signal_grids(data * self.filter)
+        # apply fourier transform
+        Pr = fftshift(np.real(_fftn(ifftshift(Sq, axes=_GRID_AXES),
+                                    _GRID_AXES, nbr_workers)),
+                      axes=_GRID_AXES)
+        # clipping negative values to 0 (ringing artefact)
+        Pr = np.clip(Pr, 0, Pr.max(axis=_GRID_AXES, keepdims=True))
+
+        # normalize the propagator to obtain a pdf
+        if normalized:
+            Pr /= Pr.sum(axis=_GRID_AXES, keepdims=True)
+        return Pr
+
+    def odf_matrix(self, sphere):
+        """ The sparse matrix mapping propagators to ODFs on `sphere`
+
+        The radial integration of `pdf_odf`, with the trilinear interpolation
+        weights and the squared radius folded into one matrix, cached for each
+        sphere.
+
+        Parameters
+        ----------
+        sphere : Sphere
+            The sphere the ODFs are evaluated on.
+
+        Returns
+        -------
+        odf_matrix : sparse matrix (X ** 3, len(sphere.vertices))
+            The ODF of a voxel is ``odf_matrix.T.dot(Pr.ravel())``.
+        """
+        odf_matrix = self.cache_get('odf_matrix', key=sphere)
+        if odf_matrix is None:
+            interp_coords = self.cache_get('interp_coords', key=sphere)
+            if interp_coords is None:
+                interp_coords = pdf_interp_coords(sphere, self.qradius,
+                                                  self.origin)
+                self.cache_set('interp_coords', sphere, interp_coords)
+            odf_matrix = pdf_odf_matrix(interp_coords, self.qradius,
+                                        3 * (self.qgrid_size, ))
+            self.cache_set('odf_matrix', sphere, odf_matrix)
+        return odf_matrix
 
 
 class DiffusionSpectrumFit(OdfFit):
 
-    def __init__(self, model, data):
-        """ Calculates PDF and ODF and other properties for a single voxel
+    def __init__(self, model, data, mask=None, chunk_size=None,
+                 nbr_workers=None):
+        """ Calculates PDF and ODF and other properties for one or many voxels
 
         Parameters
         ----------
         model : object,
             DiffusionSpectrumModel
-        data : 1d ndarray,
+        data : ndarray (..., N),
             signal values
+        mask : ndarray, optional
+            Boolean array of shape ``data.shape[:-1]``, the voxels to
+            reconstruct. Default: all voxels.
+        chunk_size : int, optional
+            The number of voxels processed at once.
+        nbr_workers : int, optional
+            The number of threads used by the FFTs.
         """
         self.model = model
         self.data = data
+        self.mask = mask
+        self.chunk_size = chunk_size
+        self.nbr_workers = nbr_workers
         self.qgrid_sz = self.model.qgrid_size
         self.dn = self.model.dn
-        self._gfa = None
-        self.npeaks = 5
-        self._peak_values = None
-        self._peak_indices = None
+
+    @property
+    def shape(self):
+        return self.data.shape[:-1]
+
+    def __getitem__(self, index):
+        if self.data.ndim == 1:
+            raise IndexError("A single voxel fit can not be indexed")
+        if not isinstance(index, tuple):
+            index = (index,)
+        if len(index) > len(self.shape):
+            raise IndexError("Too many indices for a fit of shape %s" %
+                             (self.shape,))
+        mask = None if self.mask is None else self.mask[index]
+        return self.__class__(self.model, self.data[index], mask,
+                              self.chunk_size, self.nbr_workers)
+
+    def _pdf_chunks(self, normalized=True):
+        """ Yields the voxel indices and propagators of chunks of masked
+        voxels
+
+        The indices are flat indices into ``self.shape``, the propagators have
+        shape (n, X, X, X).
+        """
+        chunk_size = self.chunk_size
+        if chunk_size is None:
+            chunk_size = max(_GRID_POINTS // self.qgrid_sz ** 3, 1)
+        data = self.data.reshape((-1, self.data.shape[-1]))
+        if self.mask is None:
+            index = np.arange(data.shape[0])
+        else:
+            index = np.flatnonzero(self.mask)
+        for start in range(0, len(index), chunk_size):
+            chunk = index[start:start + chunk_size]
+            yield chunk, self.model._pdf_chunk(data[chunk], normalized,
+                                               self.nbr_workers)
+
+    def _voxel_map(self, values_shape, chunk_values, normalized=True):
+        """ Gathers ``chunk_values(Pr)`` of all chunks of propagators into an
+        array of shape ``self.shape + values_shape``, zero outside of the
+        mask """
+        values = np.zeros((int(np.prod(self.shape)), ) + values_shape)
+        for index, Pr in self._pdf_chunks(normalized):
+            values[index] = chunk_values(Pr)
+        return values.reshape(self.shape + values_shape)[()]
 
     def pdf(self, normalized=True):
         """ Applies the 3D FFT in the q-space grid to generate
         the diffusion propagator
         """
-        values = self.data * self.model.filter
-        # create the signal volume
-        Sq = np.zeros((self.qgrid_sz, self.qgrid_sz, self.qgrid_sz))
-        # fill q-space
-
-        for i in range(len(values)):
-            qx, qy, qz = self.model.qgrid[i]
-            Sq[qx, qy, qz] += values[i]
-        # apply fourier transform
-        Pr = fftshift(np.real(fftn(ifftshift(Sq), 3 * (self.qgrid_sz, ))))
-        # clipping negative values to 0 (ringing artefact)
-        Pr = np.clip(Pr, 0, Pr.max())
-
-        # normalize the propagator to obtain a pdf
-        if normalized:
-            Pr /= Pr.sum()
-
-        return Pr
+        return self._voxel_map(3 * (self.qgrid_sz, ), lambda Pr: Pr,
+                               normalized)
 
     def rtop_signal(self, filtering=True):
         """ Calculates the return to origin probability (rtop) from the signal
@@ -197,7 +339,9 @@ class DiffusionSpectrumFit(OdfFit):
         else:
             values = self.data
 
-        rtop = values.sum()
+        rtop = values.sum(-1)
+        if self.mask is not None:
+            rtop = np.where(self.mask, rtop, 0)[()]
 
         return rtop
 
@@ -232,12 +376,10 @@ class DiffusionSpectrumFit(OdfFit):
 
         """
 
-        Pr = self.pdf(normalized=normalized)
-
         center = self.qgrid_sz // 2
 
-        rtop = Pr[center, center, center]
-        return rtop
+        return self._voxel_map((), lambda Pr: Pr[:, center, center, center],
+                               normalized)
 
     def msd_discrete(self, normalized=True):
         r""" Calculates the mean squared displacement on the discrete propagator
@@ -269,8 +411,6 @@ class DiffusionSpectrumFit(OdfFit):
 
         """
 
-        Pr = self.pdf(normalized=normalized)
-
         # create the r squared 3D matrix
         gridsize = self.qgrid_sz
         center = gridsize // 2
@@ -278,10 +418,13 @@ class DiffusionSpectrumFit(OdfFit):
         x = np.tile(a, (gridsize, gridsize, 1))
         y = np.tile(a.reshape(gridsize, 1), (gridsize, 1, gridsize))
         z = np.tile(a.reshape(gridsize, 1, 1), (1, gridsize, gridsize))
-        r2 = x ** 2 + y ** 2 + z ** 2
+        r2 = (x ** 2 + y ** 2 + z ** 2).ravel()
 
-        msd = np.sum(Pr * r2) / float((gridsize ** 3))
-        return msd
+        def msd(Pr):
+            Pr = Pr.reshape((Pr.shape[0], -1))
+            return np.dot(Pr, r2) / float((gridsize ** 3))
+
+        return self._voxel_map((), msd, normalized)
 
     def odf(self, sphere):
         r""" Calculates the real discrete odf for a given discrete sphere
@@ -295,18 +438,26 @@ class DiffusionSpectrumFit(OdfFit):
         where $\hat{\mathbf{u}}$ is the unit vector which corresponds to a
         sphere point.
         """
-        interp_coords = self.model.cache_get('interp_coords',
-                                             key=sphere)
-        if interp_coords is None:
-            interp_coords = pdf_interp_coords(sphere,
-                                              self.model.qradius,
-                                              self.model.origin)
-            self.model.cache_set('interp_coords', sphere, interp_coords)
+        odf_matrix = self.model.odf_matrix(sphere)
 
-        Pr = self.pdf()
+        def odf(Pr):
+            Pr = Pr.reshape((Pr.shape[0], -1))
+            return odf_matrix.T.dot(Pr.T).T
 
         # calculate the orientation distribution function
-        return pdf_odf(Pr, self.model.qradius, interp_coords)
+        return self._voxel_map((len(sphere.vertices), ), odf)
+
+
+def _check_fit_args(data, mask, chunk_size):
+    """ Checks the arguments of the fit methods, returns the boolean mask """
+    if mask is not None:
+        mask = np.asarray(mask, dtype=bool)
+        if mask.shape != data.shape[:-1]:
+            raise ValueError("mask and data shape do not match")
+    if chunk_size is not None and chunk_size <= 0:
+        raise ValueError("chunk_size must be a positive integer, got %d"
+                         % chunk_size)
+    return mask
 
 
 def create_qspace(gtab, origin):
@@ -425,6 +576,54 @@ def pdf_odf(Pr, rradius, interp_coords):
     return odf
 
 
+def pdf_odf_matrix(interp_coords, rradius, grid_shape):
+    r""" Sparse matrix computing the ODFs of many propagators at once
+
+    Folds the linear interpolation of `pdf_odf` and its radial weights into a
+    matrix, so that the ODFs of a stack of propagators are one matrix product.
+    As with `map_coordinates`, the propagator is zero at coordinates outside
+    of the grid.
+
+    Parameters
+    ----------
+    interp_coords : array, shape (3, M, N)
+        coordinates in the pdf for interpolating the odf
+    rradius : array, shape (N,)
+        interpolation range on the radius
+    grid_shape : tuple
+        the shape (X, X, X) of the propagators
+
+    Returns
+    -------
+    odf_matrix : sparse matrix, shape (X ** 3, M)
+        ``odf_matrix.T.dot(Pr.ravel())`` equals ``pdf_odf(Pr, rradius,
+        interp_coords)``
+    """
+    n_vertices, n_radii = interp_coords.shape[1:]
+    coords = interp_coords.reshape((3, -1))
+    radial_weights = np.tile(rradius ** 2, n_vertices)
+    vertex = np.repeat(np.arange(n_vertices), n_radii)
+    grid_shape = np.reshape(grid_shape, (3, 1))
+    in_grid = np.all((coords >= 0) & (coords <= grid_shape - 1), axis=0)
+    low = np.floor(coords).astype(int)
+    frac = coords - low
+    rows, cols, weights = [], [], []
+    for corner in np.ndindex(2, 2, 2):
+        corner = np.reshape(corner, (3, 1))
+        point = low + corner
+        weight = np.prod(np.where(corner, frac, 1 - frac), axis=0)
+        # The upper corners of coordinates on the last grid plane have a zero
+        # weight
+        inside = in_grid & np.all(point < grid_shape, axis=0)
+        rows.append(np.ravel_multi_index(point[:, inside],
+                                         tuple(grid_shape.ravel())))
+        cols.append(vertex[inside])
+        weights.append((weight * radial_weights)[inside])
+    return coo_matrix((np.concatenate(weights),
+                       (np.concatenate(rows), np.concatenate(cols))),
+                      shape=(np.prod(grid_shape), n_vertices)).tocsr()
+
+
 def half_to_full_qspace(data, gtab):
     """ Half to full Cartesian grid mapping
 
@@ -552,51 +751,57 @@ class DiffusionSpectrumDeconvModel(DiffusionSpectrumModel):
                                         filter_width,
                                         normalize_peaks)
 
-    @multi_voxel_fit
-    def fit(self, data):
-        return DiffusionSpectrumDeconvFit(self, data)
+    def fit(self, data, mask=None, chunk_size=None, nbr_workers=None):
+        """ Fit the model to the signal of one or many voxels
 
-
-class DiffusionSpectrumDeconvFit(DiffusionSpectrumFit):
-
-    def pdf(self):
-        """ Applies the 3D FFT in the q-space grid to generate
-        the DSI diffusion propagator, remove the background noise with a
-        hard threshold and then deconvolve the propagator with the
-        Lucy-Richardson deconvolution algorithm
+        See `DiffusionSpectrumModel.fit`.
         """
-        values = self.data
-        # create the signal volume
-        Sq = np.zeros((self.qgrid_sz, self.qgrid_sz, self.qgrid_sz))
-        # fill q-space
-        for i in range(len(values)):
-            qx, qy, qz = self.model.qgrid[i]
-            Sq[qx, qy, qz] += values[i]
+        mask = _check_fit_args(data, mask, chunk_size)
+        return DiffusionSpectrumDeconvFit(self, data, mask, chunk_size,
+                                          nbr_workers)
+
+    def _pdf_chunk(self, data, normalized=True, nbr_workers=None):
+        """ Applies the 3D FFT in the q-space grids of n voxels to generate
+        the DSI diffusion propagators, remove the background noise with a
+        hard threshold and then deconvolve the propagators with the
+        Lucy-Richardson deconvolution algorithm. The deconvolved propagators
+        are always normalized.
+        """
+        Sq = self._signal_grids(data)
         # get deconvolution PSF
-        DSID_PSF = self.model.cache_get('deconv_psf', key=self.model.gtab)
+        DSID_PSF = self.cache_get('deconv_psf', key=self.gtab)
         if DSID_PSF is None:
-            DSID_PSF = gen_PSF(self.model.qgrid, self.qgrid_sz,
-                               self.qgrid_sz, self.qgrid_sz)
-        self.model.cache_set('deconv_psf', self.model.gtab, DSID_PSF)
+            DSID_PSF = gen_PSF(self.qgrid, self.qgrid_size,
+                               self.qgrid_size, self.qgrid_size)
+            self.cache_set('deconv_psf', self.gtab, DSID_PSF)
         # apply fourier transform
-        Pr = fftshift(np.abs(np.real(fftn(ifftshift(Sq),
-                                          3 * (self.qgrid_sz, )))))
+        Pr = fftshift(np.abs(np.real(_fftn(ifftshift(Sq, axes=_GRID_AXES),
+                                           _GRID_AXES, nbr_workers))),
+                      axes=_GRID_AXES)
         # threshold propagator
         Pr = threshold_propagator(Pr)
         # apply LR deconvolution
-        Pr = LR_deconv(Pr, DSID_PSF, 5, 2)
+        Pr = LR_deconv(Pr, DSID_PSF, 5, 2, nbr_workers)
         return Pr
 
 
+class DiffusionSpectrumDeconvFit(DiffusionSpectrumFit):
+    pass
+
+
 def threshold_propagator(P, estimated_snr=15.):
     """
     Applies hard threshold on the propagator to remove background noise for the
     deconvolution.
+
+    `P` can be a stack of propagators along its first dimensions, the
+    threshold of each propagator is computed on its last 3 dimensions.
     """
     P_thresholded = P.copy()
-    threshold = P_thresholded.max() / float(estimated_snr)
+    threshold = (P_thresholded.max(axis=_GRID_AXES, keepdims=True) /
+                 float(estimated_snr))
     P_thresholded[P_thresholded < threshold] = 0
-    return P_thresholded / P_thresholded.sum()
+    return P_thresholded / P_thresholded.sum(axis=_GRID_AXES, keepdims=True)
 
 
 def gen_PSF(qgrid_sampling, siz_x, siz_y, siz_z):
@@ -612,20 +817,24 @@ def gen_PSF(qgrid_sampling, siz_x, siz_y, siz_z):
     return Sq * np.real(np.fft.fftshift(np.fft.ifftn(np.fft.ifftshift(Sq))))
 
 
-def LR_deconv(prop, psf, numit=5, acc_factor=1):
+def LR_deconv(prop, psf, numit=5, acc_factor=1, nbr_workers=None):
     r"""
     Perform Lucy-Richardson deconvolution algorithm on a 3D array.
 
     Parameters
     ----------
-    prop : 3-D ndarray of dtype float
-        The 3D volume to be deconvolve
+    prop : ndarray of dtype float, shape (..., X, Y, Z)
+        The 3D volume to be deconvolve, or a stack of 3D volumes which are
+        deconvolved together
     psf : 3-D ndarray of dtype float
         The filter that will be used for the deconvolution.
     numit : int
         Number of Lucy-Richardson iteration to perform.
     acc_factor : float
         Exponential acceleration factor as in [1]_.
+    nbr_workers : int, optional
+        The number of threads used by the FFTs (only with scipy >= 1.4).
+        Default: 1.
 
     References
     ----------
@@ -637,8 +846,7 @@ def LR_deconv(prop, psf, numit=5, acc_factor=1):
 
     eps = 1e-16
     # Create the otf of the same size as prop
-    otf = np.zeros_like(prop)
-    # prop.ndim==3
+    otf = np.zeros(prop.shape[-3:])
     otf[otf.shape[0] // 2 - psf.shape[0] // 2:otf.shape[0] // 2 +
         psf.shape[0] // 2 + 1, otf.shape[1] // 2 - psf.shape[1] // 2:
         otf.shape[1] // 2 + psf.shape[1] // 2 + 1, otf.shape[2] // 2 -
@@ -649,15 +857,18 @@ def LR_deconv(prop, psf, numit=5, acc_factor=1):
     prop_deconv = prop.copy()
     for it in range(numit):
         # Blur the estimate
-        reBlurred = np.real(np.fft.ifftn(otf * np.fft.fftn(prop_deconv)))
+        reBlurred = np.real(_ifftn(otf * _fftn(prop_deconv, _GRID_AXES,
+                                               nbr_workers),
+                                   _GRID_AXES, nbr_workers))
         reBlurred[reBlurred < eps] = eps
         # Update the estimate
         prop_deconv = prop_deconv * (
-            np.real(np.fft.ifftn(
-                otf * np.fft.fftn((prop / reBlurred) + eps)))) ** acc_factor
+            np.real(_ifftn(otf * _fftn((prop / reBlurred) + eps, _GRID_AXES,
+                                       nbr_workers),
+                           _GRID_AXES, nbr_workers))) ** acc_factor
         # Enforce positivity
         prop_deconv = np.clip(prop_deconv, 0, np.inf)
-    return prop_deconv / prop_deconv.sum()
+    return prop_deconv / prop_deconv.sum(axis=_GRID_AXES, keepdims=True)
 
 
 if __name__ == '__main__':
@@ -2,14 +2,14 @@
 """ Classes and functions for fitting tensors """
 from __future__ import division, print_function, absolute_import
 
+import os
 import warnings
 
 import functools
 
 import numpy as np
 
-import scipy.optimize as opt
-
+from dipy.utils.six import string_types
 from dipy.utils.six.moves import range
 from dipy.utils.arrfuncs import pinv, eigh
 from dipy.data import get_sphere
@@ -18,10 +18,20 @@ from dipy.core.geometry import vector_norm
 from dipy.reconst.vec_val_sum import vec_val_vect
 from dipy.core.onetime import auto_attr
 from dipy.reconst.base import ReconstModel
+from dipy.reconst._lm import solve_stacked
 
 
 MIN_POSITIVE_SIGNAL = 0.0001
 
+# Number of voxels whose metrics are computed at once by TensorFit.metrics
+_METRICS_CHUNK_SIZE = 2 ** 16
+
+# Metrics computed by TensorFit.metrics and the trailing shape of each of them
+_TENSOR_METRICS = {'fa': (), 'ga': (), 'md': (), 'rd': (), 'ad': (),
+                   'trace': (), 'mode': (), 'linearity': (), 'planarity': (),
+                   'sphericity': (), 'color_fa': (3, ), 'evals': (3, ),
+                   'evecs': (3, 3), 'lower_triangular': (6, )}
+
 
 def _roll_evals(evals, axis=-1):
     """
@@ -889,6 +899,115 @@ class TensorFit(object):
     def lower_triangular(self, b0=None):
         return lower_triangular(self.quadratic_form, b0)
 
+    def metrics(self, names, dtype=None, out=None, chunk_size=None):
+        """Compute several tensor metrics in one pass over the voxels.
+
+        The metrics are computed chunk by chunk from `model_params`, and
+        written into the output arrays, so that temporaries (including the
+        quadratic forms needed by the mode) never exceed the size of a chunk.
+
+        Parameters
+        ----------
+        names : str or sequence of str
+            The metrics to compute, among 'fa', 'ga', 'md', 'rd', 'ad',
+            'trace', 'mode', 'linearity', 'planarity', 'sphericity',
+            'color_fa', 'evals', 'evecs' and 'lower_triangular'. They are the
+            same as the attributes (or method) of the same names.
+        dtype : data-type, optional
+            The type of the new output arrays, and of the computations if it
+            is a floating point type. Default: the type of `model_params`.
+        out : dict, optional
+            Preallocated C-contiguous arrays where some of the metrics are
+            written, keyed by name. Their shape must be ``self.shape``
+            followed by the trailing shape of the metric (e.g. ``(3, )`` for
+            'color_fa').
+        chunk_size : int, optional
+            Number of voxels computed at once. Default: 65536.
+
+        Returns
+        -------
+        metrics : dict
+            The arrays of the metrics, keyed by name.
+        """
+        if isinstance(names, string_types):
+            names = [names]
+        for name in names:
+            if name not in _TENSOR_METRICS:
+                raise ValueError("Unknown tensor metric %r, must be one of %s"
+                                 % (name, sorted(_TENSOR_METRICS)))
+        if chunk_size is None:
+            chunk_size = _METRICS_CHUNK_SIZE
+        params = self.model_params.reshape((-1, 12))
+        n_voxels = params.shape[0]
+        if dtype is None:
+            dtype = params.dtype
+        dtype = np.dtype(dtype)
+        if np.issubdtype(dtype, np.floating):
+            compute_dtype = dtype
+        else:
+            compute_dtype = np.dtype(float)
+
+        metrics = {}
+        flat = {}
+        out = {} if out is None else out
+        for name in names:
+            shape = self.shape + _TENSOR_METRICS[name]
+            if name in out:
+                arr = out[name]
+                if arr.shape != shape:
+                    raise ValueError("The output array of %s has shape %s, "
+                                     "expected %s" % (name, arr.shape, shape))
+                if not arr.flags.c_contiguous:
+                    raise ValueError("The output array of %s must be "
+                                     "C-contiguous" % name)
+            else:
+                arr = np.empty(shape, dtype=dtype)
+            metrics[name] = arr
+            flat[name] = arr.reshape((n_voxels, ) + _TENSOR_METRICS[name])
+
+        for start in range(0, n_voxels, chunk_size):
+            chunk = slice(start, start + chunk_size)
+            chunk_params = params[chunk].astype(compute_dtype, copy=False)
+            evals = chunk_params[:, :3]
+            evecs = chunk_params[:, 3:].reshape((-1, 3, 3))
+            fa = q_form = None
+            for name in names:
+                if name in ('fa', 'color_fa') and fa is None:
+                    fa = fractional_anisotropy(evals)
+                if name in ('mode', 'lower_triangular') and q_form is None:
+                    q_form = vec_val_vect(evecs, evals)
+
+                if name == 'fa':
+                    value = fa
+                elif name == 'color_fa':
+                    value = color_fa(fa, evecs)
+                elif name == 'ga':
+                    value = geodesic_anisotropy(evals)
+                elif name == 'md':
+                    value = trace(evals) / 3.0
+                elif name == 'rd':
+                    value = radial_diffusivity(evals)
+                elif name == 'ad':
+                    value = axial_diffusivity(evals)
+                elif name == 'trace':
+                    value = trace(evals)
+                elif name == 'mode':
+                    value = mode(q_form)
+                elif name == 'linearity':
+                    value = linearity(evals)
+                elif name == 'planarity':
+                    value = planarity(evals)
+                elif name == 'sphericity':
+                    value = sphericity(evals)
+                elif name == 'evals':
+                    value = evals
+                elif name == 'evecs':
+                    value = evecs
+                else:
+                    value = lower_triangular(q_form)
+                flat[name][chunk] = value
+        return metrics
+
     @auto_attr
     def fa(self):
         """Fractional anisotropy (FA) calculated from cached eigenvalues."""
@@ -1220,6 +1339,91 @@ class TensorFit(object):
         return predict.reshape(shape + (gtab.bvals.shape[0], ))
 
 
+def streaming_fit(model, data, mask=None, metrics=('fa', 'md', 'rd', 'ad'),
+                  slab_size=None, out_dir=None):
+    """Fit a model slab by slab, reading and writing arrays on disk.
+
+    The data are read one slab of slices (along the last spatial axis) at a
+    time, so that a volume never needs to be loaded in memory. The model
+    parameters and metrics of each slab are written straight into the
+    output arrays, which are memory-mapped ``.npy`` files when `out_dir` is
+    given. Peak memory is then bounded by the size of a slab.
+
+    Parameters
+    ----------
+    model : TensorModel or DiffusionKurtosisModel
+        Model with a ``fit(data, mask)`` method whose fit object has a
+        ``model_params`` attribute.
+    data : nibabel image, array proxy or ndarray ([X, Y, Z, ...], g)
+        Diffusion data. For nibabel images, only the slab being fitted is read
+        from the file through ``data.dataobj``.
+    mask : array, optional
+        A boolean array marking the voxels to fit, with shape
+        ``data.shape[:-1]``.
+    metrics : sequence of str, optional
+        Names of the attributes (e.g. 'fa', 'md', 'rd', 'ad', 'evals',
+        'evecs') or methods without arguments (e.g. 'mk', 'ak', 'rk' for DKI)
+        of the fit object that are computed slab by slab. Default: ('fa',
+        'md', 'rd', 'ad').
+    slab_size : int, optional
+        Number of slices fitted at once. Default: enough slices for about
+        100,000 voxels, and at least one.
+    out_dir : str, optional
+        Directory where the outputs are written as memory-mapped
+        ``<name>.npy`` files. If None (default), outputs are kept in memory.
+
+    Returns
+    -------
+    out : dict
+        Arrays (or memory maps) with the ``model_params`` and the requested
+        metrics, keyed by name. Voxels outside the mask are set to zero.
+
+    """
+    dataobj = getattr(data, 'dataobj', data)
+    shape = dataobj.shape[:-1]
+    if mask is not None:
+        mask = np.array(mask, dtype=bool, copy=False)
+        if mask.shape != shape:
+            raise ValueError("Mask is not the same shape as data.")
+    if slab_size is None:
+        slab_size = max(int(1e5 // np.prod(shape[:-1])), 1)
+    elif slab_size <= 0:
+        raise ValueError("slab_size must be a positive integer, got %d" %
+                         slab_size)
+
+    names = ('model_params', ) + tuple(metrics)
+    out = {}
+    for start in range(0, shape[-1], slab_size):
+        slab = (slice(None), ) * (len(shape) - 1) + \
+            (slice(start, start + slab_size), )
+        if mask is None:
+            slab_mask = None
+        else:
+            slab_mask = mask[slab]
+            if out and not slab_mask.any():
+                # Outputs are already zero in empty slabs
+                continue
+        fit = model.fit(np.asarray(dataobj[slab]), mask=slab_mask)
+        for name in names:
+            value = getattr(fit, name)
+            if callable(value):
+                value = value()
+            value = np.asarray(value)
+            if name not in out:
+                out_shape = shape + value.shape[len(shape):]
+                if out_dir is None:
+                    out[name] = np.zeros(out_shape, dtype=value.dtype)
+                else:
+                    out[name] = np.lib.format.open_memmap(
+                        os.path.join(out_dir, name + '.npy'), mode='w+',
+                        dtype=value.dtype, shape=out_shape)
+            out[name][slab] = value
+    for value in out.values():
+        if isinstance(value, np.memmap):
+            value.flush()
+    return out
+
+
 def iter_fit_tensor(step=1e4):
     """Wrap a fit_tensor func and iterate over chunks of data with given length
 
@@ -1620,8 +1824,145 @@ def _decompose_tensor_nan(tensor, tensor_alternative, min_diffusivity=0):
     return evals, evecs
 
 
+def _gmm_weights(residuals):
+    """Geman-McClure weights of the residuals of each voxel (see
+    :func:`_nlls_err_func`), normalized to a mean weight of one."""
+    r_dev = residuals - np.median(residuals, axis=-1)[..., None]
+    C = 1.4826 * np.median(np.abs(r_dev), axis=-1)[..., None]
+    w = 1 / (residuals ** 2 + C ** 2)
+    w = w / np.mean(w, axis=-1)[..., None]
+    # Perfectly fitted voxels have no spread to weight the residuals with
+    w[~np.all(np.isfinite(w), axis=-1)] = 1.
+    return w
+
+
+def _nlls_fit_batch(design_matrix, data, params, weights=1., gmm=False,
+                    max_iter=100, ftol=1.49012e-08, xtol=1.49012e-08):
+    """Batched Levenberg-Marquardt fit of the tensor in many voxels.
+
+    The Gauss-Newton normal equations (7x7) of all the voxels are built and
+    solved together, each voxel with its own damping factor. Voxels are
+    removed from the iterations as they converge.
+
+    Parameters
+    ----------
+    design_matrix : array (g, 7)
+        Design matrix holding the covariants used to solve for the regression
+        coefficients.
+    data : array (n, g)
+        The signal of the n voxels in all gradient directions.
+    params : array (n, 7)
+        Starting tensor parameters, e.g. the OLS solution.
+    weights : float or array (g,) or (n, g)
+        Weights of the squared residuals. A weight of zero excludes a
+        measurement from the fit.
+    gmm : bool
+        Whether to further weight the residuals with the Geman-McClure
+        M-estimator, recomputed from the residuals at each iteration.
+    max_iter : int
+        Maximum number of iterations.
+    ftol, xtol : float
+        Relative tolerances on the reduction of the cost and on the size of
+        the parameter updates, as in `scipy.optimize.leastsq`.
+
+    Returns
+    -------
+    params : array (n, 7)
+        Fitted tensor parameters.
+    """
+    n, p = params.shape
+    diag = np.arange(p)
+    XX = (design_matrix[:, :, None] * design_matrix[:, None, :])
+    XX = XX.reshape(design_matrix.shape[0], -1)
+    params = params.copy()
+    weights = weights * np.ones_like(data, dtype=float)
+    lm_lambda = np.ones(n) * 1e-3
+    active = np.arange(n)
+    with np.errstate(over='ignore', under='ignore', invalid='ignore',
+                     divide='ignore'):
+        pred = np.exp(np.dot(params, design_matrix.T))
+        for _ in range(max_iter):
+            if active.size == 0:
+                break
+            sig = data[active]
+            y = pred[active]
+            residuals = sig - y
+            w = weights[active]
+            if gmm:
+                w = w * _gmm_weights(residuals)
+            cost = np.sum(w * residuals ** 2, axis=-1)
+
+            # Normal equations J'WJ delta = -J'Wr, with J = -y * X
+            A = np.dot(w * y ** 2, XX).reshape(-1, p, p)
+            grad = np.dot(w * y * residuals, design_matrix)
+            A_diag = A[:, diag, diag]
+            A_diag = A_diag + 1e-15 * np.max(A_diag, axis=-1)[:, None]
+            A[:, diag, diag] += lm_lambda[active, None] * A_diag
+            delta = solve_stacked(A, grad)
+
+            new_params = params[active] + delta
+            new_pred = np.exp(np.dot(new_params, design_matrix.T))
+            new_cost = np.sum(w * (sig - new_pred) ** 2, axis=-1)
+
+            better = new_cost <= cost
+            params[active[better]] = new_params[better]
+            pred[active[better]] = new_pred[better]
+            lm_lambda[active[better]] /= 10
+            lm_lambda[active[~better]] *= 10
+
+            small_step = np.all(np.abs(delta) <=
+                                xtol * (np.abs(new_params) + xtol), axis=-1)
+            converged = ((better & (cost - new_cost <= ftol * cost)) |
+                         small_step | (lm_lambda[active] > 1e16))
+            active = active[~converged]
+    return params
+
+
+def _nlls_output(tensor, start_params, shape, return_S0_hat):
+    """Eigen-decompose fitted tensors into the 12 DTI parameters, using the
+    start parameters in voxels where the fit failed."""
+    failed = ~np.all(np.isfinite(tensor), axis=-1)
+    tensor = np.where(failed[:, None], start_params, tensor)
+    evals, evecs = decompose_tensor(from_lower_triangular(tensor[:, :6]))
+    dti_params = np.concatenate((evals, evecs.reshape(-1, 9)), axis=-1)
+    dti_params = dti_params.reshape(shape + (12,))
+    if return_S0_hat:
+        model_S0 = np.exp(-tensor[:, 6]).reshape(shape + (1,))
+        return (dti_params, model_S0)
+    return dti_params
+
+
+def _nlls_start(design_matrix, data):
+    """Flattened data and OLS starting parameters of the NLLS fits."""
+    flat_data = data.reshape((-1, data.shape[-1]))
+    if np.any(np.all(flat_data == 0, axis=-1)):
+        raise ValueError("The data in this voxel contains only zeros")
+    inv_design = np.linalg.pinv(design_matrix)
+    log_s = np.log(flat_data)
+    ols_params = np.dot(inv_design, log_s.T).T
+    return flat_data, ols_params
+
+
+def _nlls_fit_chunks(fit_flat, design_matrix, data, return_S0_hat, step,
+                     **kwargs):
+    """Fit the tensors of the voxels of `data` in chunks of `step` voxels,
+    with ``fit_flat(design_matrix, flat_data, ols_params, **kwargs)``."""
+    shape = data.shape[:-1]
+    flat_data = data.reshape((-1, data.shape[-1]))
+    size = flat_data.shape[0]
+    step = max(int(step) or size, 1)
+    tensor = np.empty((size, 7))
+    ols_params = np.empty((size, 7))
+    for i in range(0, size, step):
+        chunk, ols_params[i:i + step] = _nlls_start(design_matrix,
+                                                    flat_data[i:i + step])
+        tensor[i:i + step] = fit_flat(design_matrix, chunk,
+                                      ols_params[i:i + step], **kwargs)
+    return _nlls_output(tensor, ols_params, shape, return_S0_hat)
+
+
 def nlls_fit_tensor(design_matrix, data, weighting=None,
-                    sigma=None, jac=True, return_S0_hat=False):
+                    sigma=None, jac=True, return_S0_hat=False, step=1e4):
     """
     Fit the tensor params using non-linear least-squares.
 
@@ -1647,78 +1988,47 @@ def nlls_fit_tensor(design_matrix, data, weighting=None,
         from some part of the image known to contain no signal (only noise).
 
     jac : bool
-        Use the Jacobian? Default: True
+        Kept for backward compatibility. The analytical Jacobian (see
+        :func:`_nlls_jacobian_func`) is always used.
 
     return_S0_hat : bool
         Boolean to return (True) or not (False) the S0 values for the fit.
 
+    step : int, optional
+        The number of voxels fitted at once. Default: 10,000.
+
     Returns
     -------
     nlls_params: the eigen-values and eigen-vectors of the tensor in each
         voxel.
 
-    """
-    # Flatten for the iteration over voxels:
-    flat_data = data.reshape((-1, data.shape[-1]))
-    # Use the OLS method parameters as the starting point for the optimization:
-    inv_design = np.linalg.pinv(design_matrix)
-    log_s = np.log(flat_data)
-    D = np.dot(inv_design, log_s.T).T
-
-    # Flatten for the iteration over voxels:
-    ols_params = np.reshape(D, (-1, D.shape[-1]))
-    # 12 parameters per voxel (evals + evecs):
-    dti_params = np.empty((flat_data.shape[0], 12))
-    if return_S0_hat:
-        model_S0 = np.empty((flat_data.shape[0], 1))
-    for vox in range(flat_data.shape[0]):
-        if np.all(flat_data[vox] == 0):
-            raise ValueError("The data in this voxel contains only zeros")
-
-        start_params = ols_params[vox]
-        # Do the optimization in this voxel:
-        if jac:
-            this_tensor, status = opt.leastsq(_nlls_err_func, start_params,
-                                              args=(design_matrix,
-                                                    flat_data[vox],
-                                                    weighting,
-                                                    sigma),
-                                              Dfun=_nlls_jacobian_func)
-        else:
-            this_tensor, status = opt.leastsq(_nlls_err_func, start_params,
-                                              args=(design_matrix,
-                                                    flat_data[vox],
-                                                    weighting,
-                                                    sigma))
-
-        # The parameters are the evals and the evecs:
-        try:
-            evals, evecs = decompose_tensor(
-                from_lower_triangular(this_tensor[:6]))
-            dti_params[vox, :3] = evals
-            dti_params[vox, 3:] = evecs.ravel()
-            if return_S0_hat:
-                model_S0[vox] = np.exp(-this_tensor[6])
-        # If leastsq failed to converge and produced nans, we'll resort to the
-        # OLS solution in this voxel:
-        except np.linalg.LinAlgError:
-            evals, evecs = decompose_tensor(
-                from_lower_triangular(start_params[:6]))
-            dti_params[vox, :3] = evals
-            dti_params[vox, 3:] = evecs.ravel()
-            if return_S0_hat:
-                model_S0[vox] = np.exp(-start_params[6])
+    Notes
+    -----
+    The voxels of each chunk of `step` voxels are fitted together with a batched Levenberg-Marquardt algorithm, starting from the
+    OLS solution. Voxels where the fit fails are given the OLS solution.
 
-    dti_params.shape = data.shape[:-1] + (12,)
-    if return_S0_hat:
-        model_S0.shape = data.shape[:-1] + (1,)
-        return (dti_params, model_S0)
+    """
+    if weighting is None:
+        weights = 1.
+    elif weighting == 'sigma':
+        if sigma is None:
+            e_s = "Must provide sigma value as input to use this weighting"
+            e_s += " method"
+            raise ValueError(e_s)
+        weights = 1 / np.asarray(sigma, dtype=float) ** 2
+    elif weighting != 'gmm':
+        raise ValueError("Unknown weighting %r, the weighting should be "
+                         "None, 'sigma' or 'gmm'" % (weighting,))
     else:
-        return dti_params
+        weights = 1.
+
+    return _nlls_fit_chunks(_nlls_fit_batch, design_matrix, data,
+                            return_S0_hat, step, weights=weights,
+                            gmm=weighting == 'gmm')
 
 
 def restore_fit_tensor(design_matrix, data, sigma=None, jac=True,
-                       return_S0_hat=False):
+                       return_S0_hat=False, step=1e4):
     """
     Use the RESTORE algorithm [Chang2005]_ to calculate a robust tensor fit
 
@@ -1739,121 +2049,73 @@ def restore_fit_tensor(design_matrix, data, sigma=None, jac=True,
         from some part of the image known to contain no signal (only noise).
 
     jac : bool, optional
-        Whether to use the Jacobian of the tensor to speed the non-linear
-        optimization procedure used to fit the tensor parameters (see also
-        :func:`nlls_fit_tensor`). Default: True
+        Kept for backward compatibility. The analytical Jacobian is always
+        used (see also :func:`nlls_fit_tensor`).
 
     return_S0_hat : bool
         Boolean to return (True) or not (False) the S0 values for the fit.
 
+    step : int, optional
+        The number of voxels fitted at once. Default: 10,000.
 
     Returns
     -------
     restore_params : an estimate of the tensor parameters in each voxel.
 
+    Notes
+    -----
+    Each step of the algorithm is applied at once to all the voxels of a
+    chunk of `step` voxels still needing it: all voxels are
+    first fitted with sigma weighting, voxels with outliers (residuals
+    larger than 3 sigma) are refitted with the Geman-McClure weighting and,
+    in voxels still having outliers, these are excluded from a last sigma
+    weighted fit.
+
     References
     ----------
     Chang, L-C, Jones, DK and Pierpaoli, C (2005). RESTORE: robust estimation
     of tensors by outlier rejection. MRM, 53: 1088-95.
 
     """
-    # Flatten for the iteration over voxels:
-    flat_data = data.reshape((-1, data.shape[-1]))
-    # Use the OLS method parameters as the starting point for the optimization:
-    inv_design = np.linalg.pinv(design_matrix)
-    log_s = np.log(flat_data)
-    D = np.dot(inv_design, log_s.T).T
-    ols_params = np.reshape(D, (-1, D.shape[-1]))
-    # 12 parameters per voxel (evals + evecs):
-    dti_params = np.empty((flat_data.shape[0], 12))
-    if return_S0_hat:
-        model_S0 = np.empty((flat_data.shape[0], 1))
-    for vox in range(flat_data.shape[0]):
-        if np.all(flat_data[vox] == 0):
-            raise ValueError("The data in this voxel contains only zeros")
-
-        start_params = ols_params[vox]
-        # Do nlls using sigma weighting in this voxel:
-        if jac:
-            this_tensor, status = opt.leastsq(_nlls_err_func, start_params,
-                                              args=(design_matrix,
-                                                    flat_data[vox],
-                                                    'sigma',
-                                                    sigma),
-                                              Dfun=_nlls_jacobian_func)
-        else:
-            this_tensor, status = opt.leastsq(_nlls_err_func, start_params,
-                                              args=(design_matrix,
-                                                    flat_data[vox],
-                                                    'sigma',
-                                                    sigma))
-
-        # Get the residuals:
-        pred_sig = np.exp(np.dot(design_matrix, this_tensor))
-        residuals = flat_data[vox] - pred_sig
-        # If any of the residuals are outliers (using 3 sigma as a criterion
-        # following Chang et al., e.g page 1089):
-        if np.any(np.abs(residuals) > 3 * sigma):
-            # Do nlls with GMM-weighting:
-            if jac:
-                this_tensor, status = opt.leastsq(_nlls_err_func,
-                                                  start_params,
-                                                  args=(design_matrix,
-                                                        flat_data[vox],
-                                                        'gmm'),
-                                                  Dfun=_nlls_jacobian_func)
-            else:
-                this_tensor, status = opt.leastsq(_nlls_err_func,
-                                                  start_params,
-                                                  args=(design_matrix,
-                                                        flat_data[vox],
-                                                        'gmm'))
-
-            # How are you doin' on those residuals?
-            pred_sig = np.exp(np.dot(design_matrix, this_tensor))
-            residuals = flat_data[vox] - pred_sig
-            if np.any(np.abs(residuals) > 3 * sigma):
-                # If you still have outliers, refit without those outliers:
-                non_outlier_idx = np.where(np.abs(residuals) <= 3 * sigma)
-                clean_design = design_matrix[non_outlier_idx]
-                clean_sig = flat_data[vox][non_outlier_idx]
-                if np.iterable(sigma):
-                    this_sigma = sigma[non_outlier_idx]
-                else:
-                    this_sigma = sigma
-
-                if jac:
-                    this_tensor, status = opt.leastsq(_nlls_err_func,
-                                                      start_params,
-                                                      args=(clean_design,
-                                                            clean_sig,
-                                                            'sigma',
-                                                            this_sigma),
-                                                      Dfun=_nlls_jacobian_func)
-                else:
-                    this_tensor, status = opt.leastsq(_nlls_err_func,
-                                                      start_params,
-                                                      args=(clean_design,
-                                                            clean_sig,
-                                                            'sigma',
-                                                            this_sigma))
-
-        # The parameters are the evals and the evecs:
-        evals, evecs = _decompose_tensor_nan(
-            from_lower_triangular(this_tensor[:6]),
-            from_lower_triangular(start_params[:6]))
-        dti_params[vox, :3] = evals
-        dti_params[vox, 3:] = evecs.ravel()
-        if return_S0_hat:
-            model_S0[vox] = np.exp(-this_tensor[6])
-
-    dti_params.shape = data.shape[:-1] + (12,)
-    restore_params = dti_params
-    if return_S0_hat:
-        model_S0.shape = data.shape[:-1] + (1,)
-        return (restore_params, model_S0)
-    else:
-        return restore_params
+    if sigma is None:
+        e_s = "Must provide sigma value as input to use this weighting"
+        e_s += " method"
+        raise ValueError(e_s)
+    return _nlls_fit_chunks(_restore_fit_batch, design_matrix, data,
+                            return_S0_hat, step,
+                            sigma=np.asarray(sigma, dtype=float))
+
+
+def _restore_fit_batch(design_matrix, flat_data, ols_params, sigma):
+    """The RESTORE tensors of the voxels of `flat_data`."""
+    # Do nlls using sigma weighting in all voxels:
+    tensor = _nlls_fit_batch(design_matrix, flat_data, ols_params,
+                             weights=1 / sigma ** 2)
+
+    # Voxels with outliers, using 3 sigma as a criterion following Chang et
+    # al., e.g page 1089, are refitted with GMM-weighting:
+    with np.errstate(over='ignore', invalid='ignore'):
+        residuals = flat_data - np.exp(np.dot(tensor, design_matrix.T))
+    outliers = np.where(np.any(np.abs(residuals) > 3 * sigma, axis=-1))[0]
+    if outliers.size:
+        tensor[outliers] = _nlls_fit_batch(design_matrix,
+                                           flat_data[outliers],
+                                           ols_params[outliers], gmm=True)
+
+        # If there are still outliers, refit without those outliers:
+        with np.errstate(over='ignore', invalid='ignore'):
+            residuals = (flat_data[outliers] -
+                         np.exp(np.dot(tensor[outliers], design_matrix.T)))
+        inliers = np.abs(residuals) <= 3 * sigma
+        outliers_left = ~np.all(inliers, axis=-1)
+        outliers = outliers[outliers_left]
+        if outliers.size:
+            weights = inliers[outliers_left] / sigma ** 2
+            tensor[outliers] = _nlls_fit_batch(design_matrix,
+                                               flat_data[outliers],
+                                               ols_params[outliers],
+                                               weights=weights)
+    return tensor
 
 
 _lt_indices = np.array([[0, 1, 3],
@@ -4,13 +4,13 @@ from warnings import warn
 import numpy as np
 from dipy.reconst.cache import Cache
 from dipy.reconst.multi_voxel import multi_voxel_fit
-from dipy.reconst.csdeconv import csdeconv
+from dipy.reconst.csdeconv import csdeconv_batch
+from dipy.reconst._lm import bounded_lm
 from dipy.reconst.shm import real_sph_harm
 from scipy.special import gamma, hyp1f1
 from dipy.core.geometry import cart2sphere
 from dipy.data import get_sphere
 from dipy.reconst.odf import OdfModel, OdfFit
-from scipy.optimize import leastsq
 from dipy.utils.optpkg import optional_package
 cvxpy, have_cvxpy, _ = optional_package("cvxpy")
 
@@ -187,85 +187,119 @@ class ForecastModel(OdfModel, Cache):
 
     @multi_voxel_fit
     def fit(self, data):
+        params = self.batch_fit_params(data[None])[0]
+        return ForecastFit(self, data, params[2:], params[0], params[1])
 
-        data_b0 = data[self.b0s_mask].mean()
-        data_single_b0 = np.r_[data_b0, data[~self.b0s_mask]] / data_b0
+    def fit_to_params(self, fit):
+        return np.r_[fit.d_par, fit.d_perp, fit.sh_coeff]
+
+    def params_to_fit(self, params):
+        return ForecastFit(self, None, params[..., 2:], params[..., 0],
+                           params[..., 1])
+
+    def batch_fit_params(self, data):
+        """ Fit the FORECAST model in many voxels at once
+
+        The mean signal of each shell is computed with the same
+        pseudo-inverses for all voxels, and the parallel and perpendicular
+        diffusivities of all voxels are fitted together with a batched
+        Levenberg-Marquardt algorithm. The voxels with the same (rounded)
+        diffusivities share a FORECAST matrix, and their fODFs are fitted
+        together.
+
+        Parameters
+        ----------
+        data : array (n, N)
+            The measured signals of n voxels.
+
+        Returns
+        -------
+        params : array (n, 2 + P)
+            The parallel and perpendicular diffusivities and the P FORECAST
+            SH coefficients of each voxel.
+        """
+        data_b0 = data[:, self.b0s_mask].mean(-1)
+        data_single_b0 = np.column_stack(
+            (data_b0, data[:, ~self.b0s_mask])) / data_b0[:, None]
 
         # calculates the mean signal at each b_values
         means = find_signal_means(self.b_unique,
-                                  data_single_b0, 
+                                  data_single_b0,
                                   self.one_0_bvals,
                                   self.srm,
                                   self.lb_matrix_signal)
 
-        # average diffusivity initialization
-        x = np.array([np.pi/4, np.pi/4])
-
-        x, status = leastsq(forecast_error_func, x,
-                            args=(self.b_unique, means))
-
-        # transform to bound the diffusivities from 0 to 3e-03
-        d_par = np.cos(x[0])**2 * 3e-03
-        d_perp = np.cos(x[1])**2 * 3e-03
+        d_par, d_perp = fit_diffusivities(self.b_unique, means)
 
-        if d_perp >= d_par:
-            temp = d_par
-            d_par = d_perp
-            d_perp = temp
+        # coefficients vector initialization
+        c0 = np.sqrt(1.0/(4*np.pi))
+        n_c = int((self.sh_order + 1)*(self.sh_order + 2)/2)
+        coef = np.zeros((data.shape[0], n_c))
+        coef[:, 0] = c0
 
         # round to avoid memory explosion
-        diff_key = str(int(np.round(d_par * 1e05))) + \
-            str(int(np.round(d_perp * 1e05)))
+        d_par_key = np.round(d_par * 1e05).astype(int)
+        d_perp_key = np.round(d_perp * 1e05).astype(int)
+        groups = {}
+        for vox, diff_key in enumerate(zip(d_par_key, d_perp_key)):
+            groups.setdefault(diff_key, []).append(vox)
+
+        for (par_key, perp_key), voxels in groups.items():
+            if par_key <= perp_key:
+                continue
+            diff_key = str(par_key) + str(perp_key)
+            M_diff = self.cache_get('forecast_matrix', key=diff_key)
+            if M_diff is None:
+                M_diff = forecast_matrix(self.sh_order, d_par[voxels[0]],
+                                         d_perp[voxels[0]], self.one_0_bvals)
+                self.cache_set('forecast_matrix', key=diff_key, value=M_diff)
+            coef[voxels] = self._fit_sh_coef(M_diff * self.rho,
+                                             data_single_b0[voxels], c0)
+
+        return np.column_stack((d_par, d_perp, coef))
+
+    def _fit_sh_coef(self, M, data_single_b0, c0):
+        """ The FORECAST SH coefficients (n, P) of the normalized signals
+        (n, N) of n voxels sharing the FORECAST matrix M """
+        if self.csd:
+            coef, _ = csdeconv_batch(data_single_b0, M, self.fod, tau=0.1,
+                                     convergence=50, num_threads=1)
+            return coef / coef[:, :1] * c0
+
+        if self.pos:
+            return np.array([self._fit_positive(vox_data, M, c0)
+                             for vox_data in data_single_b0])
 
-        M_diff = self.cache_get('forecast_matrix', key=diff_key)
-        if M_diff is None:
-            M_diff = forecast_matrix(
-                self.sh_order,  d_par, d_perp, self.one_0_bvals)
-            self.cache_set('forecast_matrix', key=diff_key, value=M_diff)
-
-        M = M_diff * self.rho
         M0 = M[:, 0]
-        c0 = np.sqrt(1.0/(4*np.pi))
-
-        # coefficients vector initialization
-        n_c = int((self.sh_order + 1)*(self.sh_order + 2)/2)
-        coef = np.zeros(n_c)
-        coef[0] = c0
-        if int(np.round(d_par*1e05)) > int(np.round(d_perp*1e05)):
-            if self.wls:
-                data_r = data_single_b0 - M0*c0
-
-                Mr = M[:, 1:]
-                Lr = self.lb_matrix[1:, 1:]
-
-                pseudo_inv = np.dot(np.linalg.inv(
-                    np.dot(Mr.T, Mr) + self.lambda_lb*Lr), Mr.T)
-                coef = np.dot(pseudo_inv, data_r)
-                coef = np.r_[c0, coef]
-
-            if self.csd:
-                coef, _ = csdeconv(data_single_b0, M, self.fod, tau=0.1,
-                                   convergence=50)
-                coef = coef / coef[0] * c0
-
-            if self.pos:
-                c = cvxpy.Variable(M.shape[1])
-                design_matrix = cvxpy.Constant(M)
-                objective = cvxpy.Minimize(
-                    cvxpy.sum_squares(design_matrix * c - data_single_b0) +
-                    self.lambda_lb * cvxpy.quad_form(c, self.lb_matrix))
-
-                constraints = [c[0] == c0, self.fod * c >= 0]
-                prob = cvxpy.Problem(objective, constraints)
-                try:
-                    prob.solve(solver=cvxpy.OSQP, eps_abs=1e-05, eps_rel=1e-05)
-                    coef = np.asarray(c.value).squeeze()
-                except Exception:
-                    warn('Optimization did not find a solution')
-                    coef = np.zeros(M.shape[1])
-                    coef[0] = c0
-
-        return ForecastFit(self, data, coef, d_par, d_perp)
+        data_r = data_single_b0 - M0*c0
+
+        Mr = M[:, 1:]
+        Lr = self.lb_matrix[1:, 1:]
+
+        pseudo_inv = np.dot(np.linalg.inv(
+            np.dot(Mr.T, Mr) + self.lambda_lb*Lr), Mr.T)
+        coef = np.dot(data_r, pseudo_inv.T)
+        return np.column_stack((np.full(coef.shape[0], c0), coef))
+
+    def _fit_positive(self, data_single_b0, M, c0):
+        """ The FORECAST SH coefficients of one voxel with a positive fODF,
+        fitted with cvxpy """
+        c = cvxpy.Variable(M.shape[1])
+        design_matrix = cvxpy.Constant(M)
+        objective = cvxpy.Minimize(
+            cvxpy.sum_squares(design_matrix * c - data_single_b0) +
+            self.lambda_lb * cvxpy.quad_form(c, self.lb_matrix))
+
+        constraints = [c[0] == c0, self.fod * c >= 0]
+        prob = cvxpy.Problem(objective, constraints)
+        try:
+            prob.solve(solver=cvxpy.OSQP, eps_abs=1e-05, eps_rel=1e-05)
+            coef = np.asarray(c.value).squeeze()
+        except Exception:
+            warn('Optimization did not find a solution')
+            coef = np.zeros(M.shape[1])
+            coef[0] = c0
+        return coef
 
 
 class ForecastFit(OdfFit):
@@ -279,11 +313,11 @@ class ForecastFit(OdfFit):
             AnalyticalModel
         data : 1d ndarray,
             fitted data
-        sh_coef : 1d ndarray,
+        sh_coef : ndarray (..., P),
             forecast sh coefficients
-        d_par : float,
+        d_par : float or ndarray,
             parallel diffusivity
-        d_perp : float,
+        d_perp : float or ndarray,
             perpendicular diffusivity
         """
         OdfFit.__init__(self, model, data)
@@ -294,8 +328,6 @@ class ForecastFit(OdfFit):
         self.d_par = d_par
         self.d_perp = d_perp
 
-        self.rho = None
-
     def odf(self, sphere, clip_negative=True):
         r""" Calculates the fODF for a given discrete sphere.
 
@@ -306,13 +338,15 @@ class ForecastFit(OdfFit):
         clip_negative : boolean, optional
             if True clip the negative odf values to 0, default True
         """
-        if self.rho is None:
-            self.rho = rho_matrix(self.sh_order, sphere.vertices)
+        rho = self.model.cache_get('rho_matrix', key=sphere)
+        if rho is None:
+            rho = rho_matrix(self.sh_order, sphere.vertices)
+            self.model.cache_set('rho_matrix', key=sphere, value=rho)
 
-        odf = np.dot(self.rho, self._sh_coef)
+        odf = np.dot(self._sh_coef, rho.T)
 
         if clip_negative:
-            odf = np.clip(odf, 0, odf.max())
+            odf = np.clip(odf, 0, odf.max(-1)[..., None])
 
         return odf
 
@@ -343,16 +377,22 @@ class ForecastFit(OdfFit):
         if gtab is None:
             gtab = self.gtab
 
-        M_diff = forecast_matrix(self.sh_order,  
-                                 self.d_par,
-                                 self.d_perp,
-                                 gtab.bvals)
-
+        # the radial part of the FORECAST matrix of each voxel, one SH
+        # degree at a time
+        d_par = np.asarray(self.d_par)[..., None]
+        d_perp = np.asarray(self.d_perp)[..., None]
         rho = rho_matrix(self.sh_order, gtab.bvecs)
-        M = M_diff * rho
-        S = S0 * np.dot(M, self._sh_coef)
-
-        return S
+        S = 0
+        counter = 0
+        for l in range(0, self.sh_order + 1, 2):
+            radial = 2 * np.pi * np.exp(-gtab.bvals * d_perp) * \
+                psi_l(l, gtab.bvals * (d_par - d_perp))
+            stop = counter + 2*l + 1
+            S = S + radial * np.dot(self._sh_coef[..., counter:stop],
+                                    rho[:, counter:stop].T)
+            counter = stop
+
+        return np.asarray(S0)[..., None] * S
 
     @property
     def sh_coeff(self):
@@ -380,7 +420,7 @@ def find_signal_means(b_unique, data_norm, bvals, rho, lb_matrix, w=1e-03):
     ----------
     b_unique : 1d ndarray,
         unique b-values in a vector excluding zero
-    data_norm : 1d ndarray,
+    data_norm : ndarray (..., N),
         normalized diffusion signal
     bvals : 1d ndarray,
         the b-values
@@ -393,25 +433,25 @@ def find_signal_means(b_unique, data_norm, bvals, rho, lb_matrix, w=1e-03):
 
     Returns
     -------
-    means : 1d ndarray
+    means : ndarray (..., len(b_unique))
         the average of the signal for each b-values
 
     """
     lb = len(b_unique)
-    means = np.zeros(lb)
+    means = np.zeros(data_norm.shape[:-1] + (lb,))
     for u in range(lb):
         ind = bvals == b_unique[u]
-        shell = data_norm[ind]
+        shell = data_norm[..., ind]
         if np.sum(ind) > 20:
             M = rho[ind, :]
 
             pseudo_inv = np.dot(np.linalg.inv(
                 np.dot(M.T, M) + w*lb_matrix), M.T)
-            coef = np.dot(pseudo_inv, shell)
 
-            means[u] = coef[0] / np.sqrt(4*np.pi)
+            # only the first SH coefficient is needed
+            means[..., u] = np.dot(shell, pseudo_inv[0]) / np.sqrt(4*np.pi)
         else:
-            means[u] = shell.mean()
+            means[..., u] = shell.mean(-1)
 
     return means
 
@@ -434,6 +474,56 @@ def forecast_error_func(x, b_unique, E):
     return v
 
 
+def fit_diffusivities(b_unique, means, max_iter=1000, tol=1e-10):
+    r""" Fit the parallel and perpendicular diffusivities of many voxels
+
+    The mean signals of each voxel are fitted with the FORECAST and SMT model
+    of the mean signal (see `forecast_error_func`), with diffusivities
+    bounded between 0 and 3e-03. All voxels are fitted together with a
+    batched Levenberg-Marquardt algorithm.
+
+    Parameters
+    ----------
+    b_unique : 1d ndarray,
+        unique b-values in a vector excluding zero
+    means : ndarray (n, len(b_unique)),
+        the average of the signal for each b-values
+    max_iter : int, optional
+        maximum number of iterations
+    tol : float, optional
+        tolerance on the relative change of the cost and of the diffusivities
+
+    Returns
+    -------
+    d_par : ndarray (n,)
+        parallel diffusivity
+    d_perp : ndarray (n,)
+        perpendicular diffusivity
+    """
+    def func(d, voxels):
+        swap = d[:, 1] > d[:, 0]
+        d_par = np.where(swap, d[:, 1], d[:, 0])[:, None]
+        d_perp = np.where(swap, d[:, 0], d[:, 1])[:, None]
+
+        bd = b_unique * (d_par - d_perp)
+        e = 0.5 * np.exp(-b_unique * d_perp)
+        E = e * psi_l(0, bd)
+        # derivative of psi_l(0, b) with respect to b
+        dpsi = e * (-2. / 3) * hyp1f1(1.5, 2.5, -bd) * b_unique
+        j_par = dpsi
+        j_perp = -b_unique * E - dpsi
+
+        jac = np.empty(E.shape + (2,))
+        jac[..., 0] = np.where(swap[:, None], j_perp, j_par)
+        jac[..., 1] = np.where(swap[:, None], j_par, j_perp)
+        return E, jac
+
+    x0 = np.full((means.shape[0], 2), 1.5e-03)
+    d = bounded_lm(func, x0, means, np.zeros(2), np.full(2, 3e-03),
+                   max_iter, tol, tol)
+    return d.max(-1), d.min(-1)
+
+
 def psi_l(l, b):
     n = l//2
     v = (-b)**n
@@ -449,10 +539,10 @@ def forecast_matrix(sh_order,  d_par, d_perp, bvals):
     M = np.zeros((bvals.shape[0], n_c))
     counter = 0
     for l in range(0, sh_order + 1, 2):
-        for m in range(-l, l + 1):
-            M[:, counter] = 2 * np.pi * \
-                np.exp(-bvals * d_perp) * psi_l(l, bvals * (d_par - d_perp))
-            counter += 1
+        stop = counter + 2 * l + 1
+        M[:, counter:stop] = (2 * np.pi * np.exp(-bvals * d_perp) *
+                              psi_l(l, bvals * (d_par - d_perp)))[:, None]
+        counter = stop
     return M
 
 
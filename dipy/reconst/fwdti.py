@@ -154,6 +154,15 @@ class FreeWaterTensorModel(ReconstModel):
 
         return FreeWaterTensorFit(self, fwdti_params)
 
+    def fit_to_params(self, fit):
+        """ Parameters of a single voxel fit, used by `multi_voxel_fit` to
+        store the fits in a packed array of parameters """
+        return fit.model_params
+
+    def params_to_fit(self, fwdti_params):
+        """ Fit of the model with parameters `fwdti_params` (..., 13) """
+        return FreeWaterTensorFit(self, fwdti_params)
+
     def predict(self, fwdti_params, S0=1):
         """ Predict a signal for this TensorModel class instance given
         parameters.
@@ -3,10 +3,15 @@ import numpy as np
 from dipy.reconst.odf import OdfModel, OdfFit, gfa
 from dipy.reconst.cache import Cache
 import warnings
-from dipy.reconst.multi_voxel import multi_voxel_fit
+from dipy.direction.peaks import peak_directions_batch
 from dipy.reconst.recspeed import local_maxima, remove_similar_vertices
 
 
+# Number of voxels whose ODFs are evaluated at once by the whole volume
+# methods of GeneralizedQSamplingFit
+_CHUNK_SIZE = 10000
+
+
 class GeneralizedQSamplingModel(OdfModel, Cache):
     def __init__(self,
                  gtab,
@@ -78,49 +83,242 @@ class GeneralizedQSamplingModel(OdfModel, Cache):
         b_vector = gradsT * tmp  # element-wise product
         self.b_vector = b_vector.T
 
-    @multi_voxel_fit
-    def fit(self, data):
-        return GeneralizedQSamplingFit(self, data)
+    def fit(self, data, mask=None):
+        """ Fit the model to the signal of one or many voxels
+
+        The GQI ODF is a linear function of the signal, so no work is done
+        here: the returned fit holds the signal array and evaluates the ODFs
+        of all its voxels at once.
+
+        Parameters
+        ----------
+        data : ndarray (..., N)
+            The signal of one or many voxels.
+        mask : ndarray, optional
+            Boolean array of shape ``data.shape[:-1]``. The ODFs, GFA and QA
+            of the voxels outside of the mask are set to zero.
+
+        Returns
+        -------
+        fit : GeneralizedQSamplingFit
+        """
+        if mask is not None:
+            mask = np.asarray(mask, dtype=bool)
+            if mask.shape != data.shape[:-1]:
+                raise ValueError("mask and data shape do not match")
+        return GeneralizedQSamplingFit(self, data, mask)
+
+    def gqi_matrix(self, sphere, dtype=np.float64):
+        """ The matrix mapping the signal to the ODF on `sphere`
+
+        Parameters
+        ----------
+        sphere : Sphere
+            The sphere the ODF is evaluated on.
+        dtype : data-type, optional
+            The data type of the matrix, e.g. ``np.float32``.
+
+        Returns
+        -------
+        gqi_matrix : ndarray (N, len(sphere.vertices))
+            The ODF of a voxel is ``np.dot(signal, gqi_matrix)``. The matrix
+            is cached for each sphere and data type.
+        """
+        dtype = np.dtype(dtype)
+        tag = 'gqi_vector'
+        if dtype != np.float64:
+            tag += '_' + dtype.name
+        gqi_vector = self.cache_get(tag, key=sphere)
+        if gqi_vector is None:
+            if dtype != np.float64:
+                gqi_vector = self.gqi_matrix(sphere).astype(dtype)
+            elif self.method == 'gqi2':
+                H = squared_radial_component
+                gqi_vector = np.real(H(np.dot(
+                    self.b_vector, sphere.vertices.T) * self.Lambda))
+            elif self.method == 'standard':
+                gqi_vector = np.real(np.sinc(np.dot(
+                    self.b_vector, sphere.vertices.T) * self.Lambda / np.pi))
+            else:
+                raise ValueError("method must be 'gqi2' or 'standard', got %r"
+                                 % self.method)
+            self.cache_set(tag, sphere, gqi_vector)
+        return gqi_vector
 
 
 class GeneralizedQSamplingFit(OdfFit):
 
-    def __init__(self, model, data):
-        """ Calculates PDF and ODF for a single voxel
+    def __init__(self, model, data, mask=None):
+        """ Calculates PDF and ODF for one or many voxels
 
         Parameters
         ----------
         model : object,
-            DiffusionSpectrumModel
-        data : 1d ndarray,
+            GeneralizedQSamplingModel
+        data : ndarray (..., N),
             signal values
+        mask : ndarray, optional
+            Boolean array of shape ``data.shape[:-1]``, the voxels to
+            reconstruct. Default: all voxels.
 
         """
         OdfFit.__init__(self, model, data)
-        self._gfa = None
-        self.npeaks = 5
-        self._peak_values = None
-        self._peak_indices = None
-        self._qa = None
-
-    def odf(self, sphere):
+        self.mask = mask
+
+    @property
+    def shape(self):
+        return self.data.shape[:-1]
+
+    def __getitem__(self, index):
+        if self.data.ndim == 1:
+            raise IndexError("A single voxel fit can not be indexed")
+        if not isinstance(index, tuple):
+            index = (index,)
+        if len(index) > len(self.shape):
+            raise IndexError("Too many indices for a fit of shape %s" %
+                             (self.shape,))
+        mask = None if self.mask is None else self.mask[index]
+        return GeneralizedQSamplingFit(self.model, self.data[index], mask)
+
+    def _odf_chunks(self, sphere, chunk_size, dtype):
+        """ Yields the voxel indices and ODFs of chunks of masked voxels
+
+        The indices are flat indices into ``self.shape``.
+        """
+        if chunk_size is None:
+            chunk_size = _CHUNK_SIZE
+        elif chunk_size <= 0:
+            raise ValueError("chunk_size must be a positive integer, got %d"
+                             % chunk_size)
+        gqi_vector = self.model.gqi_matrix(sphere, dtype)
+        data = self.data.reshape((-1, self.data.shape[-1]))
+        if self.mask is None:
+            index = np.arange(data.shape[0])
+        else:
+            index = np.flatnonzero(self.mask)
+        for start in range(0, len(index), chunk_size):
+            chunk = index[start:start + chunk_size]
+            signal = np.asarray(data[chunk], dtype=dtype)
+            yield chunk, np.dot(signal, gqi_vector)
+
+    def odf(self, sphere, chunk_size=None, dtype=np.float64):
         """ Calculates the discrete ODF for a given discrete sphere.
+
+        Parameters
+        ----------
+        sphere : Sphere
+            The sphere the ODFs are evaluated on.
+        chunk_size : int, optional
+            The number of voxels whose ODFs are computed with one matrix
+            product. Default: 10000.
+        dtype : data-type, optional
+            The data type of the computation and of the returned ODFs.
+            ``np.float32`` halves the memory of the ODFs and speeds up the
+            matrix products.
+
+        Returns
+        -------
+        odf : ndarray (..., len(sphere.vertices))
+            The ODFs, zero outside of the mask.
         """
-        self.gqi_vector = self.model.cache_get('gqi_vector', key=sphere)
-        if self.gqi_vector is None:
-            if self.model.method == 'gqi2':
-                H = squared_radial_component
-                # print self.gqi_vector.shape
-                self.gqi_vector = np.real(H(np.dot(
-                    self.model.b_vector, sphere.vertices.T) *
-                    self.model.Lambda))
-            if self.model.method == 'standard':
-                self.gqi_vector = np.real(np.sinc(np.dot(
-                    self.model.b_vector, sphere.vertices.T) *
-                    self.model.Lambda / np.pi))
-            self.model.cache_set('gqi_vector', sphere, self.gqi_vector)
-
-        return np.dot(self.data, self.gqi_vector)
+        if self.data.ndim == 1 and self.mask is None:
+            return np.dot(np.asarray(self.data, dtype=dtype),
+                          self.model.gqi_matrix(sphere, dtype))
+        n_vertices = len(sphere.vertices)
+        odf = np.zeros((int(np.prod(self.shape)), n_vertices), dtype=dtype)
+        for index, odf_chunk in self._odf_chunks(sphere, chunk_size, dtype):
+            odf[index] = odf_chunk
+        return odf.reshape(self.shape + (n_vertices,))
+
+    def gfa(self, sphere, chunk_size=None, dtype=np.float64):
+        """ Generalized fractional anisotropy of the ODFs
+
+        Parameters
+        ----------
+        sphere : Sphere
+            The sphere the ODFs are evaluated on.
+        chunk_size : int, optional
+            The number of voxels whose ODFs are computed at once. Only one
+            chunk of ODFs is held in memory at a time. Default: 10000.
+        dtype : data-type, optional
+            The data type of the ODF computation.
+
+        Returns
+        -------
+        gfa : ndarray
+            The GFA of each voxel, zero outside of the mask.
+        """
+        gfa_array = np.zeros(int(np.prod(self.shape)))
+        for index, odf_chunk in self._odf_chunks(sphere, chunk_size, dtype):
+            gfa_array[index] = gfa(odf_chunk)
+        return gfa_array.reshape(self.shape)
+
+    def qa(self, sphere, relative_peak_threshold=0.5,
+           min_separation_angle=25, npeaks=5, gfa_thr=0, normalize=True,
+           chunk_size=None, dtype=np.float64):
+        """ Quantitative anisotropy of the ODF peaks
+
+        The QA of a peak is its ODF value minus the minimum of the ODF [1]_.
+        The peaks are found as in `dipy.direction.peaks_from_model`, which
+        gives the same QA maps.
+
+        Parameters
+        ----------
+        sphere : Sphere
+            The sphere the ODFs are evaluated on.
+        relative_peak_threshold : float, optional
+            Only return peaks greater than ``relative_peak_threshold * m``
+            where m is the largest peak.
+        min_separation_angle : float in [0, 90], optional
+            The minimum angle between directions. If two peaks are too close
+            only the larger of the two is returned.
+        npeaks : int, optional
+            The maximum number of peaks per voxel.
+        gfa_thr : float, optional
+            Voxels with GFA less than `gfa_thr` have no peaks.
+        normalize : bool, optional
+            Whether to divide the QA by the largest ODF peak of the volume,
+            which gives the normalized QA.
+        chunk_size : int, optional
+            The number of voxels whose ODFs are computed at once. Default:
+            10000.
+        dtype : data-type, optional
+            The data type of the ODF computation.
+
+        Returns
+        -------
+        qa : ndarray (..., npeaks)
+            The QA of the peaks of each voxel, in descending order. Voxels with
+            less than `npeaks` peaks, or outside of the mask, are padded with
+            zeros.
+
+        References
+        ----------
+        .. [1] Yeh F-C et al., "Generalized Q-Sampling Imaging", IEEE TMI, 2010
+        """
+        qa_array = np.zeros((int(np.prod(self.shape)), npeaks))
+        global_max = -np.inf
+        for index, odf_chunk in self._odf_chunks(sphere, chunk_size, dtype):
+            odf_chunk = odf_chunk.astype(np.float64)
+            gfa_chunk = gfa(odf_chunk)
+            odf_min = odf_chunk.min(-1)
+            # As in peaks_from_model, voxels with a NaN GFA are kept
+            keep = ~(gfa_chunk < gfa_thr)
+            if not keep.all():
+                global_max = max(global_max, odf_chunk[~keep].max())
+            if not keep.any():
+                continue
+            _, values, indices = peak_directions_batch(
+                odf_chunk[keep], sphere, relative_peak_threshold,
+                min_separation_angle, npeaks)
+            has_peaks = indices[:, 0] >= 0
+            if has_peaks.any():
+                global_max = max(global_max, values[has_peaks, 0].max())
+            qa_array[index[keep]] = np.where(indices >= 0,
+                                             values - odf_min[keep, None], 0)
+        if normalize and np.isfinite(global_max):
+            qa_array /= global_max
+        return qa_array.reshape(self.shape + (npeaks,))
 
 
 def normalize_qa(qa, max_qa=None):
@@ -7,6 +7,7 @@ import numpy as np
 import scipy
 import warnings
 from dipy.reconst.base import ReconstModel
+from dipy.reconst._lm import bounded_lm
 from dipy.reconst.multi_voxel import multi_voxel_fit
 
 SCIPY_LESS_0_17 = (LooseVersion(scipy.version.short_version) <
@@ -23,7 +24,7 @@ def ivim_prediction(params, gtab, S0=1.):
 
     Parameters
     ----------
-    params : array
+    params : array (..., 4)
         An array of IVIM parameters - [S0, f, D_star, D].
 
     gtab : GradientTable class instance
@@ -36,15 +37,45 @@ def ivim_prediction(params, gtab, S0=1.):
 
     Returns
     -------
-    S : array
+    S : array (..., len(bvals))
         An array containing the IVIM signal estimated using given parameters.
     """
-    S0, f, D_star, D = params
+    params = np.asarray(params)
+    S0, f, D_star, D = [params[..., i, None] for i in range(4)]
     b = gtab.bvals
     S = S0 * (f * np.exp(-b * D_star) + (1 - f) * np.exp(-b * D))
     return S
 
 
+def _ivim_jacobian(params, bvals):
+    """Signal predicted by IVIM parameters and its Jacobian.
+
+    Parameters
+    ----------
+    params : array (n, 4)
+        IVIM parameters [S0, f, D_star, D] of n voxels.
+    bvals : array (g,)
+        The b-values.
+
+    Returns
+    -------
+    S : array (n, g)
+        The predicted signals.
+    jac : array (n, g, 4)
+        The derivatives of the signals with respect to the parameters.
+    """
+    S0, f, D_star, D = [params[:, i, None] for i in range(4)]
+    E_star = np.exp(-bvals * D_star)
+    E = np.exp(-bvals * D)
+    S = S0 * (f * E_star + (1 - f) * E)
+    jac = np.empty(S.shape + (4,))
+    jac[..., 0] = f * E_star + (1 - f) * E
+    jac[..., 1] = S0 * (E_star - E)
+    jac[..., 2] = -S0 * f * bvals * E_star
+    jac[..., 3] = -S0 * (1 - f) * bvals * E
+    return S, jac
+
+
 def _ivim_error(params, gtab, signal):
     """Error function to be used in fitting the IVIM model.
 
@@ -192,7 +223,10 @@ class IvimModel(ReconstModel):
 
         x_scale : array, optional
             Scaling for the parameters. This is passed to `least_squares` which
-            is only available for Scipy version > 0.17.
+            is only available for Scipy version > 0.17. When many voxels are
+            fitted at once (see `batch_fit_params`), the damping of the
+            Levenberg-Marquardt iterations is scaled by `x_scale` in the same
+            way, 'jac' giving Marquardt's scaling.
             default: [1000, 0.01, 0.001, 0.0001]
 
         options : dict, optional
@@ -302,8 +336,8 @@ class IvimModel(ReconstModel):
 
         Parameters
         ----------
-        data : array
-            An array containing the data to be fit
+        data : array (..., len(bvals))
+            An array containing the data to be fit, for one or many voxels.
 
         split_b : float
             The b value to split the data
@@ -313,24 +347,24 @@ class IvimModel(ReconstModel):
 
         Returns
         -------
-        S0 : float
+        S0 : float or array
             The estimated S0 value. (intercept)
 
-        D : float
+        D : float or array
             The estimated value of D.
         """
+        data = np.asarray(data)
         if less_than:
-            bvals_split = self.gtab.bvals[self.gtab.bvals <= split_b]
-            D, neg_log_S0 = np.polyfit(bvals_split,
-                                       -np.log(data[self.gtab.bvals <=
-                                                    split_b]), 1)
+            split = self.gtab.bvals <= split_b
         else:
-            bvals_split = self.gtab.bvals[self.gtab.bvals >= split_b]
-            D, neg_log_S0 = np.polyfit(bvals_split,
-                                       -np.log(data[self.gtab.bvals >=
-                                                    split_b]), 1)
-
-        S0 = np.exp(-neg_log_S0)
+            split = self.gtab.bvals >= split_b
+        neg_log_data = -np.log(data[..., split])
+        # One least squares fit for all the voxels:
+        D, neg_log_S0 = np.polyfit(self.gtab.bvals[split],
+                                   neg_log_data.reshape(-1, split.sum()).T, 1)
+
+        S0 = np.exp(-neg_log_S0).reshape(data.shape[:-1])[()]
+        D = D.reshape(data.shape[:-1])[()]
         return S0, D
 
     def estimate_f_D_star(self, params_f_D_star, data, S0, D):
@@ -405,6 +439,109 @@ class IvimModel(ReconstModel):
                 f, D_star = params_f_D_star
                 return f, D_star
 
+    def fit_to_params(self, fit):
+        """Parameters of a single voxel fit, used by `multi_voxel_fit` to
+        store the fits in a packed array of parameters.
+
+        Parameters
+        ----------
+        fit : IvimFit
+            The fit of a single voxel.
+
+        Returns
+        -------
+        ivim_params : array (4,)
+            The parameters [S0, f, D_star, D] of the voxel.
+        """
+        return fit.model_params
+
+    def params_to_fit(self, ivim_params):
+        """Fit of the model with the given parameters.
+
+        Parameters
+        ----------
+        ivim_params : array (..., 4)
+            The parameters [S0, f, D_star, D] of the voxels.
+
+        Returns
+        -------
+        ivim_fit : IvimFit
+            The fit of the voxels.
+        """
+        return IvimFit(self, ivim_params)
+
+    def batch_fit_params(self, data):
+        """Fit the IVIM model in many voxels at once.
+
+        This follows the steps of `fit`, with each step done for all voxels
+        together: the linear fits are done with one least squares call, and
+        the non-linear fits with a batched Levenberg-Marquardt algorithm,
+        bounded by `bounds` and scaled by `x_scale`.
+
+        Parameters
+        ----------
+        data : array (n, len(bvals))
+            The measured signals of n voxels.
+
+        Returns
+        -------
+        ivim_params : array (n, 4)
+            The parameters [S0, f, D_star, D] of each voxel.
+        """
+        data = np.asarray(data, dtype=float)
+        bvals = self.gtab.bvals
+        maxfev = self.options["maxiter"]
+        ftol = self.options["ftol"]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            S0_prime, D = self.estimate_linear_fit(data, self.split_b_D,
+                                                   less_than=False)
+            S0, D_star_prime = self.estimate_linear_fit(data,
+                                                        self.split_b_S0,
+                                                        less_than=True)
+            f_guess = 1 - S0_prime / S0
+
+        # Fit f and D_star, with S0 and D fixed:
+        def f_D_star_jacobian(x, voxels):
+            params = np.column_stack((S0[voxels], x, D[voxels]))
+            pred, jac = _ivim_jacobian(params, bvals)
+            return pred, jac[..., 1:3]
+
+        x0 = np.column_stack((f_guess, D_star_prime))
+        lower = np.zeros(2)
+        upper = np.array([self.bounds[1][1], self.bounds[1][2]])
+        f_D_star = _fit_feasible(f_D_star_jacobian, x0, data, lower, upper,
+                                 maxfev, ftol, self.tol,
+                                 "x0 obtained from linear fitting is not "
+                                 "feasibile as initial guess for leastsq "
+                                 "while estimating f and D_star in %d "
+                                 "voxels. Using parameters from the linear "
+                                 "fit.")
+        params_linear = np.column_stack((S0, f_D_star, D))
+        if not self.two_stage:
+            return params_linear
+
+        # Fit all the parameters again, scaled by `x_scale` as in `_leastsq`
+        # ('jac' is Marquardt's scaling, the default of `bounded_lm`)
+        x_scale = self.x_scale
+        if isinstance(x_scale, str):
+            x_scale = None
+        params_two_stage = _fit_feasible(
+            lambda x, voxels: _ivim_jacobian(x, bvals), params_linear, data,
+            np.asarray(self.bounds[0], dtype=float),
+            np.asarray(self.bounds[1], dtype=float), maxfev, ftol, self.tol,
+            "x0 is unfeasible for leastsq fitting in %d voxels. Returning x0 "
+            "values from the linear fit.", x_scale=x_scale)
+        bounds_violated = ~(np.all(params_two_stage >= self.bounds[0],
+                                   axis=-1) &
+                            np.all(params_two_stage <= self.bounds[1],
+                                   axis=-1))
+        if np.any(bounds_violated):
+            warningMsg = "Bounds are violated for leastsq fitting in %d "
+            warningMsg += "voxels. Returning parameters from linear fit"
+            warnings.warn(warningMsg % bounds_violated.sum(), UserWarning)
+            params_two_stage[bounds_violated] = params_linear[bounds_violated]
+        return params_two_stage
+
     def predict(self, ivim_params, gtab, S0=1.):
         """
         Predict a signal for this IvimModel class instance given parameters.
@@ -499,6 +636,23 @@ class IvimModel(ReconstModel):
                 return x0
 
 
+def _fit_feasible(func, x0, data, lower, upper, max_iter, ftol, xtol,
+                  warning_msg, x_scale=None):
+    """Fit the voxels whose initial parameters are within bounds with
+    `bounded_lm`, keeping the initial parameters of the other voxels."""
+    x = np.array(x0, dtype=float)
+    feasible = np.all((x >= lower) & (x <= upper), axis=-1)
+    if not np.all(feasible):
+        warnings.warn(warning_msg % (~feasible).sum(), UserWarning)
+    voxels = np.where(feasible)[0]
+    if voxels.size:
+        x[voxels] = bounded_lm(lambda x, idx: func(x, voxels[idx]),
+                               x[voxels], data[voxels], lower, upper,
+                               max_iter=max_iter, ftol=ftol, xtol=xtol,
+                               x_scale=x_scale)
+    return x
+
+
 class IvimFit(object):
 
     def __init__(self, model, model_params):
@@ -11,6 +11,7 @@ except ImportError:
     from scipy.misc import factorial as sfactorial
     from scipy.misc import factorial2
 from math import factorial as mfactorial
+from scipy.linalg import eigh
 from dipy.core.geometry import cart2sphere
 from dipy.reconst.shm import real_sph_harm, sph_harm_ind_list
 import dipy.reconst.dti as dti
@@ -374,48 +375,12 @@ class MapmriModel(ReconstModel, Cache):
                                         self.ind_mat.shape[0]))
 
         if self.positivity_constraint:
-            if self.pos_radius == 'adaptive':
-                # custom constraint grid based on scale factor [Avram2015]
-                constraint_grid = create_rspace(self.pos_grid,
-                                                np.sqrt(5) * mu_max)
-            else:
-                constraint_grid = self.constraint_grid
-            if self.anisotropic_scaling:
-                K = mapmri_psi_matrix(self.radial_order, mu, constraint_grid)
-            else:
-                if self.pos_radius == 'adaptive':
-                    # grid changes per voxel. Recompute entire K matrix.
-                    K = mapmri_isotropic_psi_matrix(self.radial_order, mu[0],
-                                                    constraint_grid)
-                else:
-                    # grid is static. Only compute mu-dependent part of K.
-                    K_dependent = mapmri_isotropic_K_mu_dependent(
-                        self.radial_order, mu[0], constraint_grid)
-                    K = K_dependent * self.pos_K_independent
-
-            data_norm = np.asarray(data / data[self.gtab.b0s_mask].mean())
-            c = cvxpy.Variable(M.shape[1])
-            design_matrix = cvxpy.Constant(M)
-            objective = cvxpy.Minimize(
-                cvxpy.sum_squares(design_matrix * c - data_norm) +
-                lopt * cvxpy.quad_form(c, laplacian_matrix)
-            )
-            M0 = M[self.gtab.b0s_mask, :]
-            constraints = [(M0[0] * c) == 1,
-                           (K * c) >= -0.1]
-            prob = cvxpy.Problem(objective, constraints)
-            try:
-                prob.solve(solver=self.cvxpy_solver)
-                coef = np.asarray(c.value).squeeze()
-            except Exception:
-                errorcode = 2
-                warn('Optimization did not find a solution')
-                try:
-                    coef = np.dot(np.linalg.pinv(M), data)  # least squares
-                except np.linalg.linalg.LinAlgError:
-                    errorcode = 3
-                    coef = np.zeros(M.shape[1])
-                    return MapmriFit(self, coef, mu, R, lopt, errorcode)
+            coef, pos_errorcode = self._positivity_constrained_coef(
+                data, M, mu, mu_max, lopt, laplacian_matrix)
+            if pos_errorcode:
+                errorcode = pos_errorcode
+            if errorcode == 3:
+                return MapmriFit(self, coef, mu, R, lopt, errorcode)
         else:
             try:
                 pseudoInv = np.dot(
@@ -431,6 +396,150 @@ class MapmriModel(ReconstModel, Cache):
 
         return MapmriFit(self, coef, mu, R, lopt, errorcode)
 
+    def _positivity_constrained_coef(self, data, M, mu, mu_max, lopt,
+                                     laplacian_matrix):
+        """ Solves the regularized least squares problem of a single voxel
+        under the positivity constraint of the propagator.
+
+        Returns the coefficients and an error code, which is 0 on success and
+        2 or 3 as described in `MapmriFit`.
+        """
+        errorcode = 0
+        if self.pos_radius == 'adaptive':
+            # custom constraint grid based on scale factor [Avram2015]
+            constraint_grid = create_rspace(self.pos_grid,
+                                            np.sqrt(5) * mu_max)
+        else:
+            constraint_grid = self.constraint_grid
+        if self.anisotropic_scaling:
+            K = mapmri_psi_matrix(self.radial_order, mu, constraint_grid)
+        else:
+            if self.pos_radius == 'adaptive':
+                # grid changes per voxel. Recompute entire K matrix.
+                K = mapmri_isotropic_psi_matrix(self.radial_order, mu[0],
+                                                constraint_grid)
+            else:
+                # grid is static. Only compute mu-dependent part of K.
+                K_dependent = mapmri_isotropic_K_mu_dependent(
+                    self.radial_order, mu[0], constraint_grid)
+                K = K_dependent * self.pos_K_independent
+
+        data_norm = np.asarray(data / data[self.gtab.b0s_mask].mean())
+        c = cvxpy.Variable(M.shape[1])
+        design_matrix = cvxpy.Constant(M)
+        objective = cvxpy.Minimize(
+            cvxpy.sum_squares(design_matrix * c - data_norm) +
+            lopt * cvxpy.quad_form(c, laplacian_matrix)
+        )
+        M0 = M[self.gtab.b0s_mask, :]
+        constraints = [(M0[0] * c) == 1,
+                       (K * c) >= -0.1]
+        prob = cvxpy.Problem(objective, constraints)
+        try:
+            prob.solve(solver=self.cvxpy_solver)
+            coef = np.asarray(c.value).squeeze()
+        except Exception:
+            errorcode = 2
+            warn('Optimization did not find a solution')
+            try:
+                coef = np.dot(np.linalg.pinv(M), data)  # least squares
+            except np.linalg.linalg.LinAlgError:
+                errorcode = 3
+                coef = np.zeros(M.shape[1])
+        return coef, errorcode
+
+    def batch_fit(self, data):
+        """ Fits the MAPMRI model to many voxels at once.
+
+        With the isotropic basis and a static scale factor
+        (``anisotropic_scaling=False`` and ``dti_scale_estimation=False``),
+        the design matrix and the Laplacian regularization matrix are the
+        same for all voxels. They are then factorized once, and the
+        regularization weights and coefficients of all voxels are estimated
+        together. Only the positivity constrained problems are still solved
+        voxel by voxel. In all other cases, the voxels are fitted one by one.
+
+        Parameters
+        ----------
+        data : array, shape (n, N)
+            Diffusion signals of n voxels.
+
+        Returns
+        -------
+        fits : list of MapmriFit
+            The fit of each voxel.
+        """
+        if self.anisotropic_scaling or self.dti_scale_estimation:
+            return [self.fit(vox_data) for vox_data in data]
+
+        n_voxels = data.shape[0]
+        tenfit = self.tenmodel.fit(data[:, self.cutoff])
+        R = tenfit.evecs
+        mu = self.mu
+        M = self.M
+        errorcode = np.zeros(n_voxels, dtype=int)
+        if self.laplacian_regularization:
+            laplacian_matrix = self.laplacian_matrix * mu[0]
+        else:
+            laplacian_matrix = np.ones((self.ind_mat.shape[0],
+                                        self.ind_mat.shape[0]))
+
+        coef = None
+        if not self.laplacian_regularization:
+            lopt = np.zeros(n_voxels)
+        elif (not isinstance(self.laplacian_weighting, str) and
+              np.isscalar(self.laplacian_weighting)):
+            lopt = np.repeat(self.laplacian_weighting, n_voxels)
+            if hasattr(self, 'MMt_inv_Mt'):
+                coef = np.dot(data, self.MMt_inv_Mt.T)
+        else:
+            factors = self.cache_get('gcv_factorization', key=mu[0])
+            if factors is None:
+                try:
+                    factors = eigh(laplacian_matrix, np.dot(M.T, M))
+                except np.linalg.LinAlgError:
+                    # M^T M is singular, fit the voxels one by one
+                    return [self.fit(vox_data) for vox_data in data]
+                self.cache_set('gcv_factorization', mu[0], factors)
+            d, V = factors
+            z = np.dot(np.dot(data, M), V)
+
+            def cost(weights):
+                return _gcv_costs_batch(weights, data, z, d)
+
+            if isinstance(self.laplacian_weighting, str):
+                lopt = _gcv_minimize_batch(cost)
+            else:
+                lopt = _gcv_array_batch(cost, self.laplacian_weighting)
+            if not self.positivity_constraint:
+                coef = np.dot(z / (1 + lopt[:, None] * d), V.T)
+
+        normalize = np.ones(n_voxels, dtype=bool)
+        if self.positivity_constraint:
+            evals = tenfit.evals
+            evals = np.clip(evals, self.eigenvalue_threshold,
+                            evals.max(axis=-1)[:, None])
+            mu_max = np.sqrt(evals * 2 * self.tau).max(axis=-1)
+            coef = np.empty((n_voxels, M.shape[1]))
+            for i in range(n_voxels):
+                coef[i], errorcode[i] = self._positivity_constrained_coef(
+                    data[i], M, mu, mu_max[i], lopt[i], laplacian_matrix)
+            normalize = errorcode != 3
+        elif coef is None:
+            try:
+                pseudoInv = np.dot(
+                    np.linalg.inv(np.dot(M.T, M) + lopt[0] * laplacian_matrix),
+                    M.T)
+                coef = np.dot(data, pseudoInv.T)
+            except np.linalg.linalg.LinAlgError:
+                errorcode[:] = 1
+                normalize[:] = False
+                coef = np.zeros((n_voxels, M.shape[1]))
+
+        coef[normalize] /= np.dot(coef[normalize], self.Bm)[:, None]
+        return [MapmriFit(self, coef[i], mu, R[i], lopt[i], errorcode[i])
+                for i in range(n_voxels)]
+
 
 class MapmriFit(ReconstFit):
 
@@ -2028,6 +2137,93 @@ def generalized_crossvalidation(data, M, LR, gcv_startpoint=5e-2):
     return optimal_lambda
 
 
+def _gcv_costs_batch(weights, data, z, d):
+    """The GCV cost function [4] of many voxels for many regularization
+    weights at once.
+
+    The design matrix M and the regularization matrix LR are shared by all
+    voxels and simultaneously diagonalized: V^T M^T M V = I and
+    V^T LR V = diag(d). The smoother matrix of a weight is then
+    S = M V diag(1 / (1 + weight * d)) V^T M^T.
+
+    Parameters
+    ----------
+    weights : array, shape (L,) or (n, L)
+        regularization weights, shared by all voxels or per voxel
+    data : array, shape (n, N)
+        signals of n voxels
+    z : array, shape (n, Ncoef)
+        projection V^T M^T of the signals
+    d : array, shape (Ncoef,)
+        generalized eigenvalues of LR with respect to M^T M
+
+    Returns
+    -------
+    gcv_value : array, shape (n, L)
+    """
+    shrink = 1. / (1. + np.asarray(weights)[..., None] * d)
+    fit_norm2 = np.sum((2 * shrink - shrink ** 2) * z[:, None, :] ** 2,
+                       axis=-1)
+    normyytilde = np.sqrt(np.clip(
+        np.sum(data ** 2, axis=-1)[:, None] - fit_norm2, 0, None))
+    trS = np.sum(shrink, axis=-1)
+    return normyytilde / (data.shape[-1] - trS)
+
+
+def _gcv_array_batch(cost, weights_array=None):
+    """Per voxel regularization weights selected from an array as in
+    `generalized_crossvalidation_array`, for many voxels at once.
+
+    `cost` maps an array of weights (L,) to the GCV costs (n, L).
+    """
+    if weights_array is None:
+        lrange = np.linspace(0.05, 1, 20)  # reasonably fast standard range
+    else:
+        lrange = np.asarray(weights_array)
+    samples = lrange.shape[0]
+    gcv = cost(lrange)
+    # the search stops at the first increase of the cost, or before the last
+    # weight of the array
+    increase = gcv[:, 1:] > gcv[:, :-1]
+    stop = np.where(increase.any(axis=-1), increase.argmax(axis=-1) + 1,
+                    samples)
+    stop = np.minimum(stop, samples - 2)
+    return lrange[stop - 1]
+
+
+def _gcv_minimize_batch(cost, bounds=(1e-5, 10), grid_size=40, n_iter=40):
+    """Per voxel regularization weights minimizing the GCV cost, for many
+    voxels at once.
+
+    The cost is first evaluated on a logarithmic grid of weights, and the
+    minimum of each voxel is then refined with a golden section search
+    between the neighbors of its best grid point.
+
+    `cost` maps weights of shape (L,) or (n, L) to the GCV costs (n, L).
+    """
+    log_grid = np.linspace(np.log(bounds[0]), np.log(bounds[1]), grid_size)
+    best = np.argmin(cost(np.exp(log_grid)), axis=-1)
+    a = log_grid[np.maximum(best - 1, 0)]
+    b = log_grid[np.minimum(best + 1, grid_size - 1)]
+
+    ratio = (np.sqrt(5) - 1) / 2
+    c = b - ratio * (b - a)
+    d = a + ratio * (b - a)
+    fc = cost(np.exp(c)[:, None])[:, 0]
+    fd = cost(np.exp(d)[:, None])[:, 0]
+    for _ in range(n_iter):
+        left = fc < fd
+        # keep [a, d] where the minimum is on the left, [c, b] otherwise
+        b = np.where(left, d, b)
+        a = np.where(left, a, c)
+        c_new = np.where(left, b - ratio * (b - a), d)
+        d_new = np.where(left, c, a + ratio * (b - a))
+        f_new = cost(np.exp(np.where(left, c_new, d_new))[:, None])[:, 0]
+        fc, fd = np.where(left, f_new, fd), np.where(left, fc, f_new)
+        c, d = c_new, d_new
+    return np.exp((a + b) / 2)
+
+
 def gcv_cost_function(weight, args):
     """The GCV cost function that is iterated [4]
     """
@@ -1,4 +1,12 @@
 """Tools to easily make multi voxel models"""
+from __future__ import division
+
+from functools import partial
+from itertools import repeat
+from multiprocessing import cpu_count, Pool
+from multiprocessing.pool import ThreadPool
+from warnings import warn
+
 import numpy as np
 from numpy.lib.stride_tricks import as_strided
 
@@ -6,17 +14,306 @@ from dipy.core.ndindex import ndindex
 from dipy.reconst.quick_squash import quick_squash as _squash
 from dipy.reconst.base import ReconstFit
 
+_BACKENDS = ('serial', 'thread', 'process')
+
+# Default number of voxels fitted at once by models that fit blocks of voxels
+BATCH_SIZE = 1024
+
+# Model shared by the workers of a process pool, set once per worker by
+# ``_init_process_worker`` so that it is not pickled with every chunk.
+_worker_model = None
+
+
+def _init_process_worker(model):
+    global _worker_model
+    _worker_model = model
+
+
+def _is_packed(model):
+    """Whether the fits of `model` are stored as packed parameter vectors."""
+    return (hasattr(model, 'fit_to_params') and
+            hasattr(model, 'params_to_fit'))
+
+
+def _is_batched(model):
+    """Whether `model` can fit blocks of voxels at once."""
+    return _is_packed(model) and hasattr(model, 'batch_fit_params')
+
+
+def _has_batch_fit(model):
+    """Whether `model` can fit blocks of voxels at once, returning one fit
+    object per voxel."""
+    return not _is_packed(model) and hasattr(model, 'batch_fit')
+
+
+def _fit_chunk(model, fit_name, chunk):
+    """Fit each voxel (row) of a 2D data chunk with the single voxel fit.
+
+    Returns a list of fits, or a 2D array of parameters (one row per voxel)
+    for models storing their fits as packed parameter vectors.
+    """
+    if _is_batched(model):
+        return model.batch_fit_params(chunk)
+    if _has_batch_fit(model):
+        return list(model.batch_fit(chunk))
+    fit = getattr(model, fit_name)
+    fits = [fit(vox_data) for vox_data in chunk]
+    if _is_packed(model):
+        return np.array([model.fit_to_params(f) for f in fits])
+    return fits
+
+
+def _fit_chunk_in_process(args):
+    fit_name, chunk = args
+    return _fit_chunk(_worker_model, fit_name, chunk)
+
+
+def _voxel_chunks(data, mask, chunk_size):
+    """Yield the coordinates and data of contiguous chunks of masked voxels.
+
+    Voxels are visited in the same (C) order as ``ndindex``.
+    """
+    coords = np.nonzero(mask)
+    n_voxels = len(coords[0])
+    for start in range(0, n_voxels, chunk_size):
+        chunk_coords = tuple(c[start:start + chunk_size] for c in coords)
+        yield chunk_coords, np.asarray(data[chunk_coords])
+
+
+def check_backend(backend, nbr_workers):
+    """The backend and number of workers to fit with.
+
+    Falls back to the serial backend when the number of workers is not given
+    and the number of cpus cannot be determined.
+
+    Parameters
+    ----------
+    backend : {'serial', 'thread', 'process'}
+        The requested backend.
+    nbr_workers : int or None
+        The requested number of threads or processes, None for the number of
+        cpus.
+
+    Returns
+    -------
+    backend : {'serial', 'thread', 'process'}
+        The backend to use.
+    nbr_workers : int or None
+        The number of workers of the parallel backends.
+
+    Raises
+    ------
+    ValueError
+        If the backend is unknown or `nbr_workers` is not positive.
+    """
+    if backend not in _BACKENDS:
+        raise ValueError("backend must be one of %s, got %r" %
+                         (_BACKENDS, backend))
+    if backend == 'serial':
+        return backend, nbr_workers
+    if nbr_workers is None:
+        try:
+            nbr_workers = cpu_count()
+        except NotImplementedError:
+            warn("Cannot determine number of cpus. Fitting with "
+                 "backend='serial'.")
+            return 'serial', None
+    elif nbr_workers <= 0:
+        raise ValueError("nbr_workers must be a positive integer, "
+                         "got %d" % nbr_workers)
+    return backend, nbr_workers
+
+
+def worker_pool(backend, nbr_workers, initializer=None, initargs=()):
+    """A pool of workers for a parallel backend.
+
+    Parameters
+    ----------
+    backend : {'thread', 'process'}
+        Whether the workers are threads or processes.
+    nbr_workers : int
+        The number of workers.
+    initializer, initargs : callable and tuple, optional
+        Called as ``initializer(*initargs)`` when each worker process starts,
+        usually to set the data shared by the tasks. Unused for threads,
+        which share the memory of the caller.
+
+    Returns
+    -------
+    pool : ThreadPool or Pool
+        The pool, to be closed and joined by the caller.
+    """
+    if backend == 'thread':
+        return ThreadPool(nbr_workers)
+    return Pool(nbr_workers, initializer=initializer, initargs=initargs)
+
+
+def _parallel_fit(self, single_voxel_fit, data, mask, backend, nbr_workers,
+                  chunk_size):
+    """Fit the masked voxels using a pool of `nbr_workers` workers.
+
+    Returns a list of ``(chunk_coords, results)`` pairs, in mask order.
+    """
+    n_voxels = np.count_nonzero(mask)
+    if chunk_size is None:
+        # Same heuristic as peaks_from_model: nbr_workers ** 2 chunks
+        chunk_size = max(int(np.ceil(n_voxels / nbr_workers ** 2)), 1)
+        if _is_batched(self) or _has_batch_fit(self):
+            chunk_size = min(chunk_size, BATCH_SIZE)
+
+    chunks = list(_voxel_chunks(data, mask, chunk_size))
+
+    pool = worker_pool(backend, nbr_workers, _init_process_worker, (self,))
+    if backend == 'thread':
+        worker = partial(_fit_chunk, self, single_voxel_fit.__name__)
+        tasks = (chunk for _, chunk in chunks)
+    else:
+        worker = _fit_chunk_in_process
+        tasks = zip(repeat(single_voxel_fit.__name__),
+                    (chunk for _, chunk in chunks))
+    try:
+        results = pool.map(worker, tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+    return [(chunk_coords, res)
+            for (chunk_coords, _), res in zip(chunks, results)]
+
+
+def _packed_fit(self, single_voxel_fit, data, mask, backend, nbr_workers,
+                chunk_size):
+    """Fit the masked voxels and pack their parameters in a single array."""
+    params = None
+    if backend != 'serial':
+        for chunk_coords, chunk_params in _parallel_fit(
+                self, single_voxel_fit, data, mask, backend, nbr_workers,
+                chunk_size):
+            if params is None:
+                params = np.zeros(data.shape[:-1] + chunk_params.shape[-1:])
+            params[chunk_coords] = chunk_params
+    elif _is_batched(self):
+        if chunk_size is None:
+            chunk_size = BATCH_SIZE
+        for chunk_coords, chunk in _voxel_chunks(data, mask, chunk_size):
+            chunk_params = self.batch_fit_params(chunk)
+            if params is None:
+                params = np.zeros(data.shape[:-1] + chunk_params.shape[-1:])
+            params[chunk_coords] = chunk_params
+    else:
+        for ijk in ndindex(data.shape[:-1]):
+            if mask[ijk]:
+                vox_params = self.fit_to_params(
+                    single_voxel_fit(self, data[ijk]))
+                if params is None:
+                    params = np.zeros(data.shape[:-1] + vox_params.shape)
+                params[ijk] = vox_params
+    if params is None:
+        # Nothing to pack, no voxel was fitted
+        return MultiVoxelFit(self, np.empty(data.shape[:-1], dtype=object),
+                             mask)
+    return PackedMultiVoxelFit(self, params, mask)
 
-def multi_voxel_fit(single_voxel_fit):
+
+def multi_voxel_fit(single_voxel_fit=None, backend='serial', nbr_workers=None,
+                    chunk_size=None):
     """Method decorator to turn a single voxel model fit
     definition into a multi voxel model fit definition
+
+    Parameters
+    ----------
+    single_voxel_fit : callable
+        Fit method of a model, fitting the signal of a single voxel.
+    backend : {'serial', 'thread', 'process'}, optional
+        Default execution backend of the multi voxel fit. ``'serial'`` fits
+        one voxel after the other in the calling thread, ``'thread'`` and
+        ``'process'`` split the masked voxels in contiguous chunks that are
+        fitted by a pool of threads or processes respectively. The
+        ``'process'`` backend requires the model and its fits to be
+        picklable. Default: 'serial'.
+    nbr_workers : int, optional
+        Default number of threads or processes used by the parallel backends.
+        Default: ``multiprocessing.cpu_count()``.
+    chunk_size : int, optional
+        Default number of voxels sent to a worker at once by the parallel
+        backends. Default: the number of masked voxels divided by
+        ``nbr_workers ** 2``.
+
+    Notes
+    -----
+    The decorator can be used with or without arguments::
+
+        @multi_voxel_fit
+        def fit(self, data):
+            ...
+
+        @multi_voxel_fit(backend='thread')
+        def fit(self, data):
+            ...
+
+    In both cases the resulting fit method accepts ``backend``,
+    ``nbr_workers`` and ``chunk_size`` keyword arguments that override the
+    defaults given to the decorator. All backends return identical fits,
+    stored in the same order.
+
+    By default the fit of every voxel is kept in an object array, see
+    `MultiVoxelFit`. Models whose single voxel fits are fully described by a
+    fixed-size parameter vector can instead define the two methods::
+
+        def fit_to_params(self, fit):
+            # Return the 1D parameter vector of a single voxel fit
+            ...
+
+        def params_to_fit(self, params):
+            # Return a fit for the parameters in params[..., :], which must
+            # work on arrays of parameters with any number of voxels
+            ...
+
+    The parameters of all voxels are then stored in one contiguous
+    ``data.shape[:-1] + (P,)`` float array, see `PackedMultiVoxelFit`. Such
+    models can also fit many voxels at once by defining::
+
+        def batch_fit_params(self, data):
+            # Return the (n, P) parameters of the (n, N) data of n voxels
+            ...
+
+    in which case the masked voxels are fitted in blocks of ``chunk_size``
+    voxels (1024 by default for the serial backend). Models keeping their
+    fits in an object array can fit blocks of voxels in the same way by
+    defining::
+
+        def batch_fit(self, data):
+            # Return the list of the fits of the (n, N) data of n voxels
+            ...
     """
-    def new_fit(self, data, mask=None):
+    if single_voxel_fit is None:
+        return partial(multi_voxel_fit, backend=backend,
+                       nbr_workers=nbr_workers, chunk_size=chunk_size)
+    if backend not in _BACKENDS:
+        raise ValueError("backend must be one of %s, got %r" %
+                         (_BACKENDS, backend))
+    default_backend = backend
+    default_nbr_workers = nbr_workers
+    default_chunk_size = chunk_size
+
+    def new_fit(self, data, mask=None, backend=None, nbr_workers=None,
+                chunk_size=None):
         """Fit method for every voxel in data"""
         # If only one voxel just return a normal fit
         if data.ndim == 1:
             return single_voxel_fit(self, data)
 
+        if backend is None:
+            backend = default_backend
+        if nbr_workers is None:
+            nbr_workers = default_nbr_workers
+        backend, nbr_workers = check_backend(backend, nbr_workers)
+        if chunk_size is None:
+            chunk_size = default_chunk_size
+        if chunk_size is not None and chunk_size <= 0:
+            raise ValueError("chunk_size must be a positive integer, "
+                             "got %d" % chunk_size)
+
         # Make a mask if mask is None
         if mask is None:
             shape = data.shape[:-1]
@@ -26,12 +323,34 @@ def multi_voxel_fit(single_voxel_fit):
         elif mask.shape != data.shape[:-1]:
             raise ValueError("mask and data shape do not match")
 
-        # Fit data where mask is True
+        if _is_packed(self):
+            return _packed_fit(self, single_voxel_fit, data, mask, backend,
+                               nbr_workers, chunk_size)
+
         fit_array = np.empty(data.shape[:-1], dtype=object)
+        if backend != 'serial':
+            # Put the fits back in mask order
+            for chunk_coords, fits in _parallel_fit(
+                    self, single_voxel_fit, data, mask, backend, nbr_workers,
+                    chunk_size):
+                for i, fit in enumerate(fits):
+                    fit_array[tuple(c[i] for c in chunk_coords)] = fit
+            return MultiVoxelFit(self, fit_array, mask)
+
+        if _has_batch_fit(self):
+            if chunk_size is None:
+                chunk_size = BATCH_SIZE
+            for chunk_coords, chunk in _voxel_chunks(data, mask, chunk_size):
+                for i, fit in enumerate(self.batch_fit(chunk)):
+                    fit_array[tuple(c[i] for c in chunk_coords)] = fit
+            return MultiVoxelFit(self, fit_array, mask)
+
+        # Fit data where mask is True
         for ijk in ndindex(data.shape[:-1]):
             if mask[ijk]:
                 fit_array[ijk] = single_voxel_fit(self, data[ijk])
         return MultiVoxelFit(self, fit_array, mask)
+    new_fit.__name__ = single_voxel_fit.__name__
     return new_fit
 
 
@@ -99,6 +418,81 @@ class MultiVoxelFit(ReconstFit):
         return result
 
 
+class PackedMultiVoxelFit(ReconstFit):
+    """Holds the parameters of many single voxel fits in one array and
+    allows vectorized access to the attributes and methods of the fits
+
+    Parameters
+    ----------
+    model : object
+        Model defining the ``params_to_fit`` method, used to build a
+        (vectorized) fit from an array of parameters.
+    params : ndarray (..., P)
+        Parameters of the fit in each voxel. Entries outside of `mask` are
+        ignored.
+    mask : boolean ndarray
+        Voxels that have been fitted.
+
+    Notes
+    -----
+    Attributes and methods are evaluated once, on the parameters of all
+    fitted voxels together, and voxels outside of `mask` are filled with
+    zeros, as done by `MultiVoxelFit`.
+    """
+    def __init__(self, model, params, mask):
+        self.model = model
+        self.params = params
+        self.mask = mask
+
+    @property
+    def shape(self):
+        return self.params.shape[:-1]
+
+    def _masked_fit(self):
+        return self.model.params_to_fit(self.params[self.mask])
+
+    def _unmask(self, values):
+        values = np.asarray(values)
+        if values.ndim == 0:
+            values = np.broadcast_to(values, (np.count_nonzero(self.mask),))
+        result = np.zeros(self.shape + values.shape[1:], dtype=values.dtype)
+        result[self.mask] = values
+        return result
+
+    def __getattr__(self, attr):
+        # Do not forward private attributes (e.g. while unpickling)
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+        value = getattr(self._masked_fit(), attr)
+        if not callable(value):
+            return self._unmask(value)
+
+        def method(*args, **kwargs):
+            return self._unmask(value(*args, **kwargs))
+        return method
+
+    def __getitem__(self, index):
+        mask = self.mask[index]
+        params = self.params[index]
+        if np.ndim(mask) == 0:
+            return self.model.params_to_fit(params) if mask else None
+        return PackedMultiVoxelFit(self.model, params, mask)
+
+    def predict(self, *args, **kwargs):
+        """
+        Predict for the multi-voxel object using the vectorized prediction
+        API of the fit, with S0 provided from an array.
+        """
+        fit = self._masked_fit()
+        if not hasattr(fit, 'predict'):
+            msg = "This model does not have prediction implemented yet"
+            raise NotImplementedError(msg)
+        S0 = kwargs.get('S0')
+        if isinstance(S0, np.ndarray):
+            kwargs['S0'] = S0[self.mask]
+        return self._unmask(fit.predict(*args, **kwargs))
+
+
 class CallableArray(np.ndarray):
     """An array which can be called like a function"""
     def __call__(self, *args, **kwargs):
@@ -91,22 +91,24 @@ cdef class PeaksAndMetricsDirectionGetter(DirectionGetter):
     @cython.initializedcheck(False)
     @cython.boundscheck(False)
     @cython.wraparound(False)
-    cdef int get_direction_c(self, double* point, double* direction):
+    cdef int get_direction_c(self, double* point, double* direction) nogil:
         """Interpolate closest peaks to direction from voxels neighboring point
 
         Update direction and return 0 if successful. If no tracking direction
         could be found, return 1.
 
         """
-        if not self.initialized:
-            self._initialize()
-
         cdef:
+            int i
             np.npy_intp s
             double newdirection[3]
             np.npy_intp qa_shape[4]
             np.npy_intp qa_strides[4]
 
+        if not self.initialized:
+            with gil:
+                self._initialize()
+
         for i in range(4):
             qa_shape[i] = self._qa.shape[i]
             qa_strides[i] = self._qa.strides[i]
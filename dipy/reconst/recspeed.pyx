@@ -13,6 +13,9 @@ cimport numpy as cnp
 from libc.stdlib cimport malloc, free
 from libc.string cimport memcpy
 
+from cython.parallel import parallel, prange
+from dipy.utils.omp cimport set_num_threads, restore_default_num_threads
+
 cdef extern from "dpy_math.h" nogil:
     double floor(double x)
     double fabs(double x)
@@ -313,6 +316,157 @@ def local_maxima(double[:] odf, cnp.uint16_t[:, :] edges):
     return values, indices
 
 
+@cython.wraparound(False)
+@cython.boundscheck(False)
+def search_peaks(double[:, ::1] odfs, double[:, ::1] vertices,
+                 cnp.uint16_t[:, ::1] edges, double relative_peak_threshold,
+                 double min_separation_angle, int npeaks, num_threads=None):
+    """Peaks of many functions evaluated on the vertices of a sphere.
+
+    Applies, in parallel and without the GIL, the steps of
+    :func:`dipy.direction.peaks.peak_directions` to each row of `odfs`:
+    :func:`local_maxima`, the relative threshold of
+    :func:`search_descending` applied to the peak values minus
+    ``max(0, min(odf))``, then :func:`remove_similar_vertices`. Only the
+    first `npeaks` peaks of each row are kept.
+
+    Parameters
+    ----------
+    odfs : array (n, N)
+        The functions evaluated on the N vertices of the sphere.
+    vertices : array (N, 3)
+        The vertices of the sphere.
+    edges : array (E, 2)
+        The neighbor relations between the vertices.
+    relative_peak_threshold : float
+        Only peaks greater than ``min + relative_peak_threshold * scale`` are
+        kept, where ``min = max(0, odf.min())`` and
+        ``scale = odf.max() - min``.
+    min_separation_angle : float
+        The minimum angle, in degrees, between two peaks.
+    npeaks : int
+        The maximum number of peaks of a function.
+    num_threads : int, optional
+        Number of threads. If None (default) then all available threads
+        will be used.
+
+    Returns
+    -------
+    values : array (n, npeaks)
+        The peak values of each function, in descending order, padded with
+        zeros.
+    indices : array (n, npeaks)
+        The vertex indices of the peaks, padded with -1.
+    """
+    cdef:
+        cnp.npy_intp n = odfs.shape[0]
+        cnp.npy_intp n_vertices = odfs.shape[1]
+        cnp.npy_intp n_edges = edges.shape[0]
+        cnp.npy_intp v, i, j, k, count, n_kept, hole, insert_B
+        cnp.npy_intp *wpeak
+        double *values
+        double odf0, odf1, odf_min, threshold, insert_A
+        double cos_similarity = cos(DPY_PI/180 * min_separation_angle)
+        cnp.uint16_t find0, find1
+        int has_nan = 0
+        double[:, ::1] peak_values = np.zeros((n, npeaks))
+        cnp.npy_intp[:, ::1] peak_indices = np.full((n, npeaks), -1,
+                                                   dtype=np.intp)
+
+    if vertices.shape[0] != n_vertices or vertices.shape[1] != 3:
+        raise ValueError("vertices should be (N, 3), N the length of the "
+                         "functions")
+    if edges.shape[1] != 2:
+        raise ValueError("edges should be (E, 2)")
+    if n_edges and np.max(edges) >= n_vertices:
+        raise IndexError("Values in edges must be < len(odf)")
+    if n == 0 or npeaks <= 0:
+        return np.asarray(peak_values), np.asarray(peak_indices)
+
+    set_num_threads(num_threads)
+    with nogil, parallel():
+        wpeak = <cnp.npy_intp *> malloc(n_vertices * sizeof(cnp.npy_intp))
+        values = <double *> malloc(n_vertices * sizeof(double))
+        for v in prange(n, schedule='guided'):
+            # local maxima, as in _compare_neighbors
+            for i in range(n_vertices):
+                wpeak[i] = 0
+            count = 0
+            for i in range(n_edges):
+                find0 = edges[i, 0]
+                find1 = edges[i, 1]
+                odf0 = odfs[v, find0]
+                odf1 = odfs[v, find1]
+                if odf0 < odf1:
+                    wpeak[find0] = -1
+                    wpeak[find1] = wpeak[find1] | 1
+                elif odf0 > odf1:
+                    wpeak[find0] = wpeak[find0] | 1
+                    wpeak[find1] = -1
+                elif (odf0 != odf0) or (odf1 != odf1):
+                    count = -1
+                    break
+            if count == -1:
+                has_nan += 1
+                continue
+            for i in range(n_vertices):
+                if wpeak[i] > 0:
+                    # insertion sort by descending values, as in _cosort
+                    insert_A = odfs[v, i]
+                    hole = count
+                    while hole > 0 and insert_A > values[hole - 1]:
+                        values[hole] = values[hole - 1]
+                        wpeak[hole] = wpeak[hole - 1]
+                        hole = hole - 1
+                    values[hole] = insert_A
+                    wpeak[hole] = i
+                    count = count + 1
+
+            if count == 0 or values[0] < 0:
+                continue
+            if count == 1:
+                peak_values[v, 0] = values[0]
+                peak_indices[v, 0] = wpeak[0]
+                continue
+
+            # remove small peaks
+            odf_min = odfs[v, 0]
+            for i in range(1, n_vertices):
+                if odfs[v, i] < odf_min:
+                    odf_min = odfs[v, i]
+            if odf_min < 0:
+                odf_min = 0
+            threshold = relative_peak_threshold * (values[0] - odf_min)
+            for i in range(1, count):
+                if values[i] - odf_min < threshold:
+                    count = i
+                    break
+
+            # remove peaks too close together
+            n_kept = 0
+            for i in range(count):
+                if n_kept == npeaks:
+                    break
+                k = wpeak[i]
+                for j in range(n_kept):
+                    if fabs(vertices[k, 0] * vertices[peak_indices[v, j], 0] +
+                            vertices[k, 1] * vertices[peak_indices[v, j], 1] +
+                            vertices[k, 2] * vertices[peak_indices[v, j], 2]
+                            ) > cos_similarity:
+                        break
+                else:
+                    peak_values[v, n_kept] = values[i]
+                    peak_indices[v, n_kept] = k
+                    n_kept = n_kept + 1
+        free(wpeak)
+        free(values)
+    restore_default_num_threads()
+
+    if has_nan:
+        raise ValueError("odf can not have nans")
+    return np.asarray(peak_values), np.asarray(peak_indices)
+
+
 @cython.wraparound(False)
 @cython.boundscheck(False)
 cdef void _cosort(double[::1] A, cnp.npy_intp[::1] B) nogil:
@@ -610,3 +764,158 @@ def argmax_from_countarrs(cnp.ndarray vals,
         return np.array([])
     # fancy indexing always produces a copy
     return maxinds[argsort(maxes[:n_maxes])]
+
+
+@cython.wraparound(False)
+@cython.boundscheck(False)
+@cython.cdivision(True)
+def csd_iterations(double[:, ::1] z, double[:, ::1] fodf_sh,
+                   double[:, ::1] Q_tril, double[:, ::1] B_reg,
+                   double[::1] threshold, cnp.uint8_t[:, ::1] fodf_small,
+                   cnp.npy_intp[::1] active, cnp.npy_intp[::1] num_it,
+                   int convergence, num_threads=None):
+    """Constrained-regularized iterations of CSD for many voxels.
+
+    Runs the iterations of :func:`dipy.reconst.csdeconv.csdeconv` in each
+    voxel of `active`, in parallel and without the GIL. At each iteration
+    ``Q = P + dot(H.T, H)`` is updated with the directions of the
+    regularization sphere that changed sign since the previous iteration,
+    instead of being recomputed.
+
+    Parameters
+    ----------
+    z : array (n, K)
+        ``dot(dwsignal, X)`` for each voxel.
+    fodf_sh : array (n, K)
+        fODF SH coefficients, updated in place for the voxels in `active`.
+    Q_tril : array (m, K * (K + 1) / 2)
+        Initial ``Q = P + dot(H.T, H)`` of each active voxel, given by the
+        lower triangle of Q in row-major order.
+    B_reg : array (M, K)
+        Regularization matrix, scaled by lambda.
+    threshold : array (n,)
+        fODF amplitude below which the positivity constraint is enforced.
+    fodf_small : array (n, M), dtype uint8
+        Directions of the sphere where the constraint is initially enforced
+        in each voxel. Updated in place.
+    active : array (m,)
+        Indices of the voxels to deconvolve.
+    num_it : array (n,)
+        Number of iterations used by each voxel, filled in place.
+    convergence : int
+        Maximum number of iterations.
+    num_threads : int, optional
+        Number of threads. If None (default) then all available threads
+        will be used.
+
+    Returns
+    -------
+    status : array (n,), dtype int8
+        0 for converged voxels, 1 for voxels which did not converge within
+        `convergence` iterations and -1 for voxels where Q was not positive
+        definite.
+    """
+    cdef:
+        cnp.npy_intp n_coef = B_reg.shape[1]
+        cnp.npy_intp n_dirs = B_reg.shape[0]
+        cnp.npy_intp n_active = active.shape[0]
+        cnp.npy_intp a, v, i, j, k, r, t, it
+        double *Q
+        double *L
+        double *f
+        double *Qi
+        double *Li
+        double *Lj
+        double *b
+        double s, d, sign
+        int changed
+        cnp.int8_t[::1] status = np.zeros(fodf_sh.shape[0], dtype=np.int8)
+
+    if Q_tril.shape[1] != n_coef * (n_coef + 1) // 2:
+        raise ValueError("Q_tril and B_reg shapes do not match")
+    if Q_tril.shape[0] != n_active:
+        raise ValueError("Q_tril and active shapes do not match")
+
+    set_num_threads(num_threads)
+    with nogil, parallel():
+        Q = <double *> malloc(n_coef * n_coef * sizeof(double))
+        L = <double *> malloc(n_coef * n_coef * sizeof(double))
+        f = <double *> malloc(n_coef * sizeof(double))
+        for a in prange(n_active, schedule='guided'):
+            v = active[a]
+            t = 0
+            for i in range(n_coef):
+                for j in range(i + 1):
+                    Q[i * n_coef + j] = Q_tril[a, t]
+                    t = t + 1
+
+            status[v] = 1
+            for it in range(1, convergence + 1):
+                # Cholesky decomposition Q = dot(L, L.T)
+                for j in range(n_coef):
+                    Lj = L + j * n_coef
+                    s = Q[j * n_coef + j]
+                    for k in range(j):
+                        s = s - Lj[k] * Lj[k]
+                    if s <= 0:
+                        status[v] = -1
+                        break
+                    d = sqrt(s)
+                    Lj[j] = d
+                    for i in range(j + 1, n_coef):
+                        Li = L + i * n_coef
+                        s = Q[i * n_coef + j]
+                        for k in range(j):
+                            s = s - Li[k] * Lj[k]
+                        Li[j] = s / d
+                if status[v] == -1:
+                    break
+
+                # Solve dot(L, L.T) f = z by forward and back substitution
+                for i in range(n_coef):
+                    Li = L + i * n_coef
+                    s = z[v, i]
+                    for k in range(i):
+                        s = s - Li[k] * f[k]
+                    f[i] = s / Li[i]
+                for i in range(n_coef - 1, -1, -1):
+                    s = f[i]
+                    for k in range(i + 1, n_coef):
+                        s = s - L[k * n_coef + i] * f[k]
+                    f[i] = s / L[i * n_coef + i]
+                for i in range(n_coef):
+                    fodf_sh[v, i] = f[i]
+                num_it[v] = it
+
+                # Sample the fODF on the regularization sphere and update Q
+                # with the directions that changed sign
+                changed = 0
+                for r in range(n_dirs):
+                    b = &B_reg[r, 0]
+                    s = 0
+                    for i in range(n_coef):
+                        s = s + b[i] * f[i]
+                    if (s < threshold[v]) == (fodf_small[v, r] != 0):
+                        continue
+                    changed = 1
+                    if fodf_small[v, r]:
+                        fodf_small[v, r] = 0
+                        sign = -1
+                    else:
+                        fodf_small[v, r] = 1
+                        sign = 1
+                    for i in range(n_coef):
+                        Qi = Q + i * n_coef
+                        s = sign * b[i]
+                        for j in range(i + 1):
+                            Qi[j] = Qi[j] + s * b[j]
+                if not changed:
+                    status[v] = 0
+                    break
+        free(Q)
+        free(L)
+        free(f)
+    if num_threads is not None:
+        restore_default_num_threads()
+
+    return np.asarray(status)
@@ -16,6 +16,7 @@ This is an implementation of the sparse fascicle model described in
    models at multiple b-values with cross-validation. ISMRM 2014.
 """
 import warnings
+from functools import partial
 
 import numpy as np
 
@@ -33,6 +34,8 @@ import dipy.reconst.dti as dti
 import dipy.data as dpd
 from dipy.reconst.base import ReconstModel, ReconstFit
 from dipy.reconst.cache import Cache
+from dipy.reconst.multi_voxel import BATCH_SIZE, check_backend, worker_pool
+from dipy.reconst.sfmspeed import enet_coordinate_descent_gram
 from dipy.core.onetime import auto_attr
 
 lm, has_sklearn, _ = optional_package('sklearn.linear_model')
@@ -291,6 +294,42 @@ def sfm_design_matrix(gtab, sphere, response, mode='signal'):
     return mat
 
 
+def _enet_fit_block(design_matrix, gram, solver, block):
+    """
+    Fit a block of voxels with the parameters of an sklearn ElasticNet.
+
+    `block` holds the signals (n, N) of the voxels and their starting
+    coefficients (n, p). Returns the fitted coefficients.
+    """
+    fit_it, beta = block
+    beta = np.array(beta, dtype=float, order='C')
+    n_samples = design_matrix.shape[0]
+    if solver.fit_intercept:
+        fit_it = fit_it - fit_it.mean(axis=-1)[:, None]
+    # account for the n_samples scaling of the objective of sklearn
+    enet_coordinate_descent_gram(
+        beta, gram, np.ascontiguousarray(np.dot(fit_it, design_matrix)),
+        np.sum(fit_it ** 2, axis=-1),
+        solver.alpha * solver.l1_ratio * n_samples,
+        solver.alpha * (1.0 - solver.l1_ratio) * n_samples,
+        positive=solver.positive, max_iter=solver.max_iter, tol=solver.tol)
+    return beta
+
+
+# Design matrix, Gram matrix and solver shared by the workers of a process
+# pool, set once per worker by ``_init_enet_worker``.
+_worker_args = None
+
+
+def _init_enet_worker(*args):
+    global _worker_args
+    _worker_args = args
+
+
+def _enet_fit_block_in_process(block):
+    return _enet_fit_block(*(_worker_args + (block,)))
+
+
 class SparseFascicleModel(ReconstModel, Cache):
     def __init__(self, gtab, sphere=None, response=[0.0015, 0.0005, 0.0005],
                  solver='ElasticNet', l1_ratio=0.5, alpha=0.001, isotropic=None):
@@ -379,7 +418,8 @@ class SparseFascicleModel(ReconstModel, Cache):
         return sfm_design_matrix(self.gtab, self.sphere, self.response,
                                  'signal')
 
-    def fit(self, data, mask=None):
+    def fit(self, data, mask=None, backend='serial', nbr_workers=None,
+            chunk_size=None):
         """
         Fit the SparseFascicleModel object to data.
 
@@ -393,11 +433,37 @@ class SparseFascicleModel(ReconstModel, Cache):
             should be analyzed. Has the shape `data.shape[:-1]`. Default: None,
             which implies that all points should be analyzed.
 
+        backend : {'serial', 'thread', 'process'}, optional
+            How the blocks of voxels are fitted when the solver is an sklearn
+            ElasticNet: one after the other, or by a pool of threads or
+            processes. Default: 'serial'.
+
+        nbr_workers : int, optional
+            Number of threads or processes used by the parallel backends.
+            Default: ``multiprocessing.cpu_count()``.
+
+        chunk_size : int, optional
+            Number of voxels fitted at once by the ElasticNet solver.
+            Default: 1024.
+
         Returns
         -------
         SparseFascicleFit object
 
+        Notes
+        -----
+        When the solver is an sklearn ElasticNet (the default), the voxels are
+        fitted in blocks with a coordinate descent that shares the Gram matrix
+        of the design matrix between all voxels, and follows the stopping
+        criteria of sklearn. Every other voxel is fitted first, and, if the
+        solver has ``warm_start=True``, the remaining voxels start from the
+        solution of the preceding voxel, which is usually a neighbor. Other
+        solvers fit the voxels one by one.
         """
+        backend, nbr_workers = check_backend(backend, nbr_workers)
+        if chunk_size is not None and chunk_size <= 0:
+            raise ValueError("chunk_size must be a positive integer, "
+                             "got %d" % chunk_size)
         if mask is None:
             # Flatten it to 2D either way:
             data_in_mask = np.reshape(data, (-1, data.shape[-1]))
@@ -417,15 +483,26 @@ class SparseFascicleModel(ReconstModel, Cache):
                                 self.design_matrix.shape[-1]))
 
         isopredict = isotropic.predict()
-        for vox, vox_data in enumerate(flat_S):
+        if has_sklearn and isinstance(self.solver, lm.ElasticNet):
             # In voxels in which S0 is 0, we just want to keep the
-            # parameters at all-zeros, and avoid nasty sklearn errors:
-            if not (np.any(~np.isfinite(vox_data)) or np.all(vox_data == 0)):
-                fit_it = vox_data - isopredict[vox]
-                with warnings.catch_warnings():
-                    warnings.simplefilter("ignore")
-                    flat_params[vox] = self.solver.fit(self.design_matrix,
-                                                       fit_it).coef_
+            # parameters at all-zeros:
+            valid = (np.all(np.isfinite(flat_S), -1) &
+                     np.any(flat_S != 0, -1))
+            if np.any(valid):
+                flat_params[valid] = self._fit_elastic_net(
+                    flat_S[valid] - isopredict[valid], backend, nbr_workers,
+                    chunk_size)
+        else:
+            for vox, vox_data in enumerate(flat_S):
+                # In voxels in which S0 is 0, we just want to keep the
+                # parameters at all-zeros, and avoid nasty sklearn errors:
+                if not (np.any(~np.isfinite(vox_data)) or
+                        np.all(vox_data == 0)):
+                    fit_it = vox_data - isopredict[vox]
+                    with warnings.catch_warnings():
+                        warnings.simplefilter("ignore")
+                        flat_params[vox] = self.solver.fit(self.design_matrix,
+                                                           fit_it).coef_
 
         if mask is None:
             out_shape = data.shape[:-1] + (-1, )
@@ -440,6 +517,52 @@ class SparseFascicleModel(ReconstModel, Cache):
 
         return SparseFascicleFit(self, beta, S0, isotropic)
 
+    def _fit_elastic_net(self, fit_it, backend, nbr_workers, chunk_size):
+        """
+        Fit the ElasticNet solver to the signals (n, N) of many voxels.
+        """
+        design_matrix = self.design_matrix
+        if self.solver.fit_intercept:
+            design_matrix = design_matrix - design_matrix.mean(0)
+        gram = self.cache_get('gram_matrix', key=self.solver.fit_intercept)
+        if gram is None:
+            gram = np.dot(design_matrix.T, design_matrix)
+            self.cache_set('gram_matrix', self.solver.fit_intercept, gram)
+
+        if chunk_size is None:
+            chunk_size = BATCH_SIZE
+        if backend == 'serial':
+            pool = None
+            fit_blocks = partial(map, partial(_enet_fit_block, design_matrix,
+                                              gram, self.solver))
+        else:
+            pool = worker_pool(backend, nbr_workers, _init_enet_worker,
+                               (design_matrix, gram, self.solver))
+            if backend == 'thread':
+                fit_blocks = partial(pool.map, partial(
+                    _enet_fit_block, design_matrix, gram, self.solver))
+            else:
+                fit_blocks = partial(pool.map, _enet_fit_block_in_process)
+
+        beta = np.zeros((fit_it.shape[0], design_matrix.shape[-1]))
+        try:
+            for first in (0, 1):
+                idx = np.arange(first, fit_it.shape[0], 2)
+                if first and self.solver.warm_start:
+                    start = beta[idx - 1]
+                else:
+                    start = beta[idx]
+                blocks = [(fit_it[idx[i:i + chunk_size]],
+                           start[i:i + chunk_size])
+                          for i in range(0, len(idx), chunk_size)]
+                if blocks:
+                    beta[idx] = np.concatenate(list(fit_blocks(blocks)))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        return beta
+
 
 class SparseFascicleFit(ReconstFit):
     def __init__(self, model, beta, S0, iso):
@@ -0,0 +1,166 @@
+# Emacs should think this is a -*- python -*- file
+""" Optimized routines for the Sparse Fascicle Model
+"""
+
+# cython: embedsignature=True
+
+cimport cython
+
+import numpy as np
+cimport numpy as cnp
+
+cdef extern from "dpy_math.h" nogil:
+    double fabs(double x)
+
+
+# initialize numpy runtime
+cnp.import_array()
+
+
+cdef inline double fmax(double x, double y) nogil:
+    return x if x > y else y
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef int _voxel_enet_cd(double[::1] w, double[:, ::1] gram, double[::1] Xty,
+                        double y_norm2, double l1_reg, double l2_reg,
+                        int positive, int max_iter, double tol,
+                        double[::1] H_w) nogil:
+    """Coordinate descent of the elastic net of a single voxel.
+
+    Returns the number of sweeps done.
+    """
+    cdef:
+        cnp.npy_intp n_features = w.shape[0]
+        cnp.npy_intp j, k
+        int n_iter = 0
+        double w_j, new_w_j, d_w_j, r, w_max, d_w_max
+        double gap, dual_norm_XtA, XtA_k, R_norm2, w_norm2, l1_norm
+        double q_dot_w, const
+
+    # H_w = gram.w, kept up to date with the updates of w
+    for j in range(n_features):
+        H_w[j] = 0
+    for k in range(n_features):
+        if w[k] != 0:
+            for j in range(n_features):
+                H_w[j] += gram[k, j] * w[k]
+
+    while n_iter < max_iter:
+        w_max = 0
+        d_w_max = 0
+        for j in range(n_features):
+            if gram[j, j] == 0:
+                continue
+            w_j = w[j]
+            r = Xty[j] - H_w[j] + gram[j, j] * w_j
+            if positive and r < 0:
+                new_w_j = 0
+            elif r > l1_reg:
+                new_w_j = (r - l1_reg) / (gram[j, j] + l2_reg)
+            elif r < -l1_reg:
+                new_w_j = (r + l1_reg) / (gram[j, j] + l2_reg)
+            else:
+                new_w_j = 0
+            d_w_j = new_w_j - w_j
+            if d_w_j != 0:
+                for k in range(n_features):
+                    H_w[k] += d_w_j * gram[j, k]
+                w[j] = new_w_j
+            d_w_max = fmax(d_w_max, fabs(d_w_j))
+            w_max = fmax(w_max, fabs(new_w_j))
+        n_iter += 1
+
+        if (w_max == 0 or d_w_max / w_max < tol or n_iter == max_iter):
+            # the largest coordinate update is small, check the duality gap
+            dual_norm_XtA = -1e300 if positive else 0
+            q_dot_w = 0
+            w_norm2 = 0
+            l1_norm = 0
+            R_norm2 = y_norm2
+            for k in range(n_features):
+                XtA_k = Xty[k] - H_w[k] - l2_reg * w[k]
+                if positive:
+                    dual_norm_XtA = fmax(dual_norm_XtA, XtA_k)
+                else:
+                    dual_norm_XtA = fmax(dual_norm_XtA, fabs(XtA_k))
+                q_dot_w += Xty[k] * w[k]
+                w_norm2 += w[k] * w[k]
+                l1_norm += fabs(w[k])
+                R_norm2 += w[k] * H_w[k]
+            R_norm2 -= 2 * q_dot_w
+            if dual_norm_XtA > l1_reg:
+                const = l1_reg / dual_norm_XtA
+                gap = 0.5 * R_norm2 * (1 + const * const)
+            else:
+                const = 1
+                gap = R_norm2
+            gap += (l1_reg * l1_norm - const * y_norm2 + const * q_dot_w +
+                    0.5 * l2_reg * (1 + const * const) * w_norm2)
+            if gap < tol * y_norm2:
+                break
+    return n_iter
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def enet_coordinate_descent_gram(double[:, ::1] beta, double[:, ::1] gram,
+                                 double[:, ::1] Xty, double[::1] y_norm2,
+                                 double l1_reg, double l2_reg,
+                                 bint positive=False, int max_iter=1000,
+                                 double tol=1e-4):
+    """Elastic net fit of many voxels sharing the same design matrix.
+
+    Minimizes, for each voxel, ``0.5 * ||y - X w||^2 + l1_reg * ||w||_1 +
+    0.5 * l2_reg * ||w||^2`` with cyclic coordinate descent on the Gram
+    matrix ``X.T X``, which is computed once for all voxels. The stopping
+    criteria are those of `sklearn.linear_model.ElasticNet`: a voxel is done
+    once the largest coefficient update of a sweep is smaller than `tol` times
+    its largest coefficient, and its duality gap is smaller than
+    ``tol * ||y||^2``. The GIL is released during the fit.
+
+    Parameters
+    ----------
+    beta : ndarray (n, p)
+        The starting coefficients of the n voxels. Updated in place.
+    gram : ndarray (p, p)
+        The Gram matrix ``X.T X`` of the design matrix.
+    Xty : ndarray (n, p)
+        The products ``X.T y`` of the design matrix and the signals.
+    y_norm2 : ndarray (n,)
+        The squared norms of the signals.
+    l1_reg, l2_reg : float
+        The L1 and L2 regularization weights.
+    positive : bool, optional
+        Whether to constrain the coefficients to be positive.
+    max_iter : int, optional
+        The maximum number of sweeps over the coefficients of a voxel.
+    tol : float, optional
+        The tolerance of the stopping criteria.
+
+    Returns
+    -------
+    n_iter : ndarray (n,)
+        The number of sweeps done for each voxel.
+    """
+    cdef:
+        cnp.npy_intp n_voxels = beta.shape[0]
+        cnp.npy_intp n_features = beta.shape[1]
+        cnp.npy_intp i
+        double[::1] H_w = np.empty(n_features)
+        int[::1] n_iter = np.empty(n_voxels, dtype=np.int32)
+
+    if (gram.shape[0] != n_features or gram.shape[1] != n_features or
+            Xty.shape[0] != n_voxels or Xty.shape[1] != n_features or
+            y_norm2.shape[0] != n_voxels):
+        raise ValueError("The shapes of beta, gram, Xty and y_norm2 do not "
+                         "match")
+
+    with nogil:
+        for i in range(n_voxels):
+            n_iter[i] = _voxel_enet_cd(beta[i], gram, Xty[i], y_norm2[i],
+                                       l1_reg, l2_reg, positive, max_iter,
+                                       tol, H_w)
+    return np.asarray(n_iter)
@@ -32,7 +32,7 @@ from numpy.random import randint
 from dipy.reconst.odf import OdfModel, OdfFit
 from dipy.core.geometry import cart2sphere
 from dipy.core.onetime import auto_attr
-from dipy.reconst.cache import Cache
+from dipy.reconst.cache import Cache, stable_hash
 
 from distutils.version import LooseVersion
 import scipy
@@ -45,6 +45,12 @@ else:
     SCIPY_15_PLUS = False
 
 
+# SH bases and SH to SF matrices (and their inverses) shared across calls,
+# keyed by the sampled points or sphere, the order, the basis and smoothing
+_sh_matrix_cache = Cache()
+_sh_matrix_cache.cache_max_bytes = 2 ** 28
+
+
 def _copydoc(obj):
     def bandit(f):
         f.__doc__ = obj.__doc__
@@ -226,19 +232,114 @@ def real_sph_harm(m, n, theta, phi):
     y_mn : real float
         The real harmonic $Y^m_n$ sampled at `theta` and `phi`.
 
+    Notes
+    -----
+    The harmonics are evaluated with real arithmetic, computing the
+    associated Legendre functions of all the needed degrees with the
+    recurrences of :func:`_legendre_table`. They match
+    ``scipy.special.sph_harm`` up to rounding errors.
+
     See Also
     --------
     scipy.special.sph_harm
     """
-    # dipy uses a convention for theta and phi that is reversed with respect to
-    # function signature of scipy.special.sph_harm
-    sh = spherical_harmonics(np.abs(m), n, phi, theta)
-
-    real_sh = np.where(m > 0, sh.imag, sh.real)
+    m, n, theta, phi = [np.asarray(a) for a in (m, n, theta, phi)]
+    shape = np.broadcast(m, n, theta, phi).shape
+    if 0 in shape:
+        return np.zeros(shape)
+    points = np.broadcast(theta, phi).shape
+
+    m_abs = np.abs(m).astype(int)
+    n = n.astype(int)
+    m_values, m_index = np.unique(m_abs, return_inverse=True)
+    table = _legendre_table(m_values, n.max(),
+                            np.broadcast_to(theta, points))
+
+    # The points of the table matching each harmonic of the output
+    point_index = []
+    for axis, size in enumerate(points):
+        index = np.arange(size)
+        point_index.append(np.reshape(index, (size,) +
+                                      (1,) * (len(points) - axis - 1)))
+    legendre = table[(m_index.reshape(m_abs.shape), n) + tuple(point_index)]
+
+    angle = m_abs * phi
+    real_sh = legendre * np.where(m > 0, np.sin(angle), np.cos(angle))
     real_sh *= np.where(m == 0, 1., np.sqrt(2))
     return real_sh
 
 
+def _legendre_table(m_values, max_degree, theta):
+    r""" Normalized associated Legendre functions of ``cos(theta)``.
+
+    The functions of all degrees up to `max_degree` are computed for each
+    order with the stable recurrences
+
+    .. math::
+
+        \bar{P}^m_m = -\sqrt{\frac{2m + 1}{2m}} \sin\theta
+            \bar{P}^{m-1}_{m-1}, \quad
+        \bar{P}^m_{m+1} = \sqrt{2m + 3} \cos\theta \bar{P}^m_m, \\
+        \bar{P}^m_n = \sqrt{\frac{4n^2 - 1}{n^2 - m^2}} \left(
+            \cos\theta \bar{P}^m_{n-1} - \sqrt{\frac{(n-1)^2 - m^2}
+            {4(n-1)^2 - 1}} \bar{P}^m_{n-2} \right)
+
+    starting from $\bar{P}^0_0 = 1 / \sqrt{4 \pi}$.
+
+    Parameters
+    ----------
+    m_values : array of int
+        The orders, sorted in ascending order.
+    max_degree : int
+        The maximum degree.
+    theta : ndarray
+        The polar (colatitudinal) coordinate.
+
+    Returns
+    -------
+    table : ndarray (len(m_values), max_degree + 1) + theta.shape
+        ``table[i, n]`` is $\sqrt{\frac{2n+1}{4\pi}\frac{(n-m)!}{(n+m)!}}
+        P^m_n(\cos\theta)$ for ``m = m_values[i]``, including the
+        Condon-Shortley phase as in ``scipy.special.lpmv``, and 0 for
+        ``n < m``.
+    """
+    x = np.cos(theta)
+    y = np.sin(theta)
+    table = np.zeros((len(m_values), max_degree + 1) + x.shape)
+    p_mm = np.full(x.shape, 0.5 / np.sqrt(np.pi))
+    m_prev = 0
+    for i, m in enumerate(m_values):
+        for k in range(m_prev + 1, m + 1):
+            p_mm = -np.sqrt((2. * k + 1) / (2. * k)) * y * p_mm
+        m_prev = m
+        if m > max_degree:
+            continue
+        table[i, m] = p_mm
+        if m < max_degree:
+            table[i, m + 1] = np.sqrt(2. * m + 3) * x * p_mm
+        for l in range(m + 2, max_degree + 1):
+            a = np.sqrt((4. * l * l - 1) / (l * l - m * m))
+            b = np.sqrt(((l - 1.) ** 2 - m * m) / (4. * (l - 1) ** 2 - 1))
+            table[i, l] = a * (x * table[i, l - 1] - b * table[i, l - 2])
+    return table
+
+
+def _cached_basis(basis, sh_order, theta, phi):
+    """`basis` evaluated at the points, memoized by the content of the
+    points."""
+    theta = np.asarray(theta, dtype=float)
+    phi = np.asarray(phi, dtype=float)
+    key = stable_hash(sh_order, theta, phi)
+    real_sh = _sh_matrix_cache.cache_get(basis.__name__, key=key)
+    if real_sh is None:
+        real_sh = basis(sh_order, theta, phi)[0]
+        _sh_matrix_cache.cache_set(basis.__name__, key=key, value=real_sh)
+    m, n = sph_harm_ind_list(sh_order)
+    if basis is _real_sym_sh_mrtrix:
+        m = -m
+    return real_sh.copy(), m, n
+
+
 def real_sym_sh_mrtrix(sh_order, theta, phi):
     """
     Compute real spherical harmonics as in mrtrix, where the real harmonic
@@ -272,6 +373,10 @@ def real_sym_sh_mrtrix(sh_order, theta, phi):
         The degree of the harmonics.
 
     """
+    return _cached_basis(_real_sym_sh_mrtrix, sh_order, theta, phi)
+
+
+def _real_sym_sh_mrtrix(sh_order, theta, phi):
     m, n = sph_harm_ind_list(sh_order)
     phi = np.reshape(phi, [-1, 1])
     theta = np.reshape(theta, [-1, 1])
@@ -320,6 +425,10 @@ def real_sym_sh_basis(sh_order, theta, phi):
     .. [1] https://github.com/scilus/fibernavigator
 
     """
+    return _cached_basis(_real_sym_sh_basis, sh_order, theta, phi)
+
+
+def _real_sym_sh_basis(sh_order, theta, phi):
     m, n = sph_harm_ind_list(sh_order)
     phi = np.reshape(phi, [-1, 1])
     theta = np.reshape(theta, [-1, 1])
@@ -488,6 +597,19 @@ class SphHarmModel(OdfModel, Cache):
             self.cache_set("sampling_matrix", sphere, sampling_matrix)
         return sampling_matrix
 
+    def fit_to_params(self, fit):
+        """The spherical harmonic coefficients of a single voxel fit.
+
+        Used by `multi_voxel_fit` to store the fits of subclasses in a packed
+        array of coefficients.
+        """
+        return fit.shm_coeff
+
+    def params_to_fit(self, shm_coef):
+        """Fit of the model with spherical harmonic coefficients `shm_coef`.
+        """
+        return SphHarmFit(self, shm_coef, None)
+
 
 class QballBaseModel(SphHarmModel):
     """To be subclassed by Qball type models."""
@@ -849,7 +971,60 @@ class ResidualBootstrapWrapper(object):
         return signal
 
 
-def sf_to_sh(sf, sphere, sh_order=4, basis_type=None, smooth=0.0):
+# Default number of voxels projected at once by sf_to_sh and sh_to_sf
+_CHUNK_SIZE = 10000
+
+
+def _project(x, M, out=None, chunk_size=None, dtype=None):
+    """``np.dot(x, M)``, computed slab by slab along the first axis of `x`.
+
+    Parameters
+    ----------
+    x : ndarray (..., K)
+        The arrays to project.
+    M : ndarray (K, P)
+        The projection matrix.
+    out : ndarray (..., P), optional
+        Where the result is written, for example a memory-mapped array.
+    chunk_size : int, optional
+        Approximate number of rows of `x` projected at once (default
+        ``_CHUNK_SIZE``). Each slab spans at least one index along the first
+        axis.
+    dtype : dtype, optional
+        The data type of the result, if `out` is not given. By default, the
+        type of ``np.dot(x, M)``.
+
+    Returns
+    -------
+    out : ndarray (..., P)
+    """
+    x = np.asanyarray(x)
+    shape = x.shape[:-1] + (M.shape[1],)
+    if out is None:
+        if dtype is None:
+            dtype = np.result_type(x.dtype, M.dtype)
+        out = np.empty(shape, dtype=dtype)
+    elif out.shape != shape:
+        raise ValueError("out should have shape %s, got %s" %
+                         (shape, out.shape))
+
+    # The product is done in float32 only if both the input and the output
+    # are float32
+    M = M.astype(np.result_type(x.dtype, out.dtype, np.float32), copy=False)
+    if x.ndim == 1:
+        out[...] = np.dot(x, M)
+        return out
+
+    if chunk_size is None:
+        chunk_size = _CHUNK_SIZE
+    slab = max(chunk_size // max(int(np.prod(x.shape[1:-1])), 1), 1)
+    for start in range(0, x.shape[0], slab):
+        out[start:start + slab] = np.dot(x[start:start + slab], M)
+    return out
+
+
+def sf_to_sh(sf, sphere, sh_order=4, basis_type=None, smooth=0.0, out=None,
+             chunk_size=None, dtype=None):
     """Spherical function to spherical harmonics (SH).
 
     Parameters
@@ -868,6 +1043,14 @@ def sf_to_sh(sf, sphere, sh_order=4, basis_type=None, smooth=0.0):
         (default ``None``).
     smooth : float, optional
         Lambda-regularization in the SH fit (default 0.0).
+    out : ndarray, optional
+        Array, possibly memory-mapped, where the SH coefficients are written.
+    chunk_size : int, optional
+        Number of voxels projected at once, which bounds the memory used
+        besides `sf` and `out` (default 10000).
+    dtype : dtype, optional
+        The data type of the SH coefficients, if `out` is not given
+        (default float64).
 
     Returns
     -------
@@ -875,20 +1058,13 @@ def sf_to_sh(sf, sphere, sh_order=4, basis_type=None, smooth=0.0):
         SH coefficients representing the input function.
 
     """
-    sph_harm_basis = sph_harm_lookup.get(basis_type)
+    _, invB = sh_to_sf_matrix(sphere, sh_order, basis_type, return_inv=True,
+                              smooth=smooth)
+    return _project(sf, invB, out, chunk_size, dtype)
 
-    if sph_harm_basis is None:
-        raise ValueError("Invalid basis name.")
-    B, m, n = sph_harm_basis(sh_order, sphere.theta, sphere.phi)
 
-    L = -n * (n + 1)
-    invB = smooth_pinv(B, sqrt(smooth) * L)
-    sh = np.dot(sf, invB.T)
-
-    return sh
-
-
-def sh_to_sf(sh, sphere, sh_order, basis_type=None):
+def sh_to_sf(sh, sphere, sh_order, basis_type=None, out=None,
+             chunk_size=None, dtype=None):
     """Spherical harmonics (SH) to spherical function (SF).
 
     Parameters
@@ -905,6 +1081,15 @@ def sh_to_sf(sh, sphere, sh_order, basis_type=None):
         ``mrtrix`` for the MRtrix basis, and
         ``fibernav`` for the FiberNavigator basis
         (default ``None``).
+    out : ndarray, optional
+        Array, possibly memory-mapped, where the spherical function values
+        are written.
+    chunk_size : int, optional
+        Number of voxels projected at once, which bounds the memory used
+        besides `sh` and `out` (default 10000).
+    dtype : dtype, optional
+        The data type of the spherical function values, if `out` is not given
+        (default float64).
 
     Returns
     -------
@@ -912,15 +1097,8 @@ def sh_to_sf(sh, sphere, sh_order, basis_type=None):
          Spherical function values on the `sphere`.
 
     """
-    sph_harm_basis = sph_harm_lookup.get(basis_type)
-
-    if sph_harm_basis is None:
-        raise ValueError("Invalid basis name.")
-    B, m, n = sph_harm_basis(sh_order, sphere.theta, sphere.phi)
-
-    sf = np.dot(sh, B.T)
-
-    return sf
+    B = sh_to_sf_matrix(sphere, sh_order, basis_type, return_inv=False)
+    return _project(sh, B, out, chunk_size, dtype)
 
 
 def sh_to_sf_matrix(sphere, sh_order, basis_type=None, return_inv=True,
@@ -953,19 +1131,40 @@ def sh_to_sf_matrix(sphere, sh_order, basis_type=None, return_inv=True,
     invB : ndarray
         Inverse of B.
 
+    Notes
+    -----
+    The matrices are cached across calls, and are read-only.
+
     """
     sph_harm_basis = sph_harm_lookup.get(basis_type)
 
     if sph_harm_basis is None:
         raise ValueError("Invalid basis name.")
-    B, m, n = sph_harm_basis(sh_order, sphere.theta, sphere.phi)
 
-    if return_inv:
-        L = -n * (n + 1)
-        invB = smooth_pinv(B, np.sqrt(smooth) * L)
-        return B.T, invB.T
+    # Keyed by content, equal spheres are often distinct objects
+    key = stable_hash(np.asarray(sphere.theta, dtype=float),
+                      np.asarray(sphere.phi, dtype=float), sh_order,
+                      basis_type)
+    B = _sh_matrix_cache.cache_get('sh_to_sf_matrix', key=key)
+    if B is None:
+        B, m, n = sph_harm_basis(sh_order, sphere.theta, sphere.phi)
+        B = B.T
+        B.setflags(write=False)
+        _sh_matrix_cache.cache_set('sh_to_sf_matrix', key=key, value=B)
 
-    return B.T
+    if return_inv:
+        key = stable_hash(key, float(smooth))
+        invB = _sh_matrix_cache.cache_get('sf_to_sh_matrix', key=key)
+        if invB is None:
+            m, n = sph_harm_ind_list(sh_order)
+            L = -n * (n + 1)
+            invB = smooth_pinv(B.T, np.sqrt(smooth) * L).T
+            invB.setflags(write=False)
+            _sh_matrix_cache.cache_set('sf_to_sh_matrix', key=key,
+                                       value=invB)
+        return B, invB
+
+    return B
 
 
 def calculate_max_order(n_coeffs):
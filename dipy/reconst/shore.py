@@ -210,15 +210,48 @@ class ShoreModel(Cache):
 
     @multi_voxel_fit
     def fit(self, data):
+        return ShoreFit(self, self.batch_fit_params(data[None])[0])
 
-        Lshore = l_shore(self.radial_order)
-        Nshore = n_shore(self.radial_order)
-        # Generate the SHORE basis
+    def fit_to_params(self, fit):
+        return fit.shore_coeff
+
+    def params_to_fit(self, params):
+        return ShoreFit(self, params)
+
+    def _shore_matrix(self):
+        """ The SHORE basis of the gradient table, cached """
         M = self.cache_get('shore_matrix', key=self.gtab)
         if M is None:
             M = shore_matrix(
                 self.radial_order,  self.zeta, self.gtab, self.tau)
             self.cache_set('shore_matrix', self.gtab, M)
+        return M
+
+    def batch_fit_params(self, data):
+        """ Fit the SHORE coefficients of many voxels at once
+
+        Without `constrain_e0`, the fit is the regularized pseudo-inverse of
+        the SHORE basis, computed once for the gradient table and applied to
+        all voxels with one matrix product.
+
+        Parameters
+        ----------
+        data : array (n, N)
+            The measured signals of n voxels.
+
+        Returns
+        -------
+        shore_coef : array (n, P)
+            The SHORE coefficients of each voxel.
+        """
+        if self.constrain_e0:
+            return np.array([self._fit_constrained(vox_data)
+                             for vox_data in data])
+
+        Lshore = l_shore(self.radial_order)
+        Nshore = n_shore(self.radial_order)
+        # Generate the SHORE basis
+        M = self._shore_matrix()
 
         MpseudoInv = self.cache_get('shore_matrix_reg_pinv', key=self.gtab)
         if MpseudoInv is None:
@@ -228,69 +261,73 @@ class ShoreModel(Cache):
             self.cache_set('shore_matrix_reg_pinv', self.gtab, MpseudoInv)
 
         # Compute the signal coefficients in SHORE basis
-        if not self.constrain_e0:
-            coef = np.dot(MpseudoInv, data)
-
-            signal_0 = 0
-
-            for n in range(int(self.radial_order / 2) + 1):
-                signal_0 += (
-                    coef[n] * (genlaguerre(n, 0.5)(0) * (
-                        (factorial(n)) /
-                        (2 * np.pi * (self.zeta ** 1.5) * gamma(n + 1.5))
-                    ) ** 0.5)
-                )
-
-            coef = coef / signal_0
+        coef = np.dot(data, MpseudoInv.T)
+
+        signal_0_weights = np.array([
+            genlaguerre(n, 0.5)(0) * (
+                (factorial(n)) /
+                (2 * np.pi * (self.zeta ** 1.5) * gamma(n + 1.5))
+            ) ** 0.5
+            for n in range(int(self.radial_order / 2) + 1)])
+        signal_0 = np.dot(coef[..., :len(signal_0_weights)],
+                          signal_0_weights)
+
+        return coef / signal_0[..., None]
+
+    def _fit_constrained(self, data):
+        """ Fit the SHORE coefficients of one voxel with E(0) = 1, and
+        optionally a positive propagator, with cvxpy """
+        Lshore = l_shore(self.radial_order)
+        Nshore = n_shore(self.radial_order)
+        M = self._shore_matrix()
+        data_norm = data / data[self.gtab.b0s_mask].mean()
+        M0 = M[self.gtab.b0s_mask, :]
+
+        c = cvxpy.Variable(M.shape[1])
+        design_matrix = cvxpy.Constant(M)
+        objective = cvxpy.Minimize(
+            cvxpy.sum_squares(design_matrix * c - data_norm) +
+            self.lambdaN * cvxpy.quad_form(c, Nshore) +
+            self.lambdaL * cvxpy.quad_form(c, Lshore)
+        )
+
+        if not self.positive_constraint:
+            constraints = [M0[0] * c == 1]
         else:
-            data_norm = data / data[self.gtab.b0s_mask].mean()
-            M0 = M[self.gtab.b0s_mask, :]
-
-            c = cvxpy.Variable(M.shape[1])
-            design_matrix = cvxpy.Constant(M)
-            objective = cvxpy.Minimize(
-                cvxpy.sum_squares(design_matrix * c - data_norm) +
-                self.lambdaN * cvxpy.quad_form(c, Nshore) +
-                self.lambdaL * cvxpy.quad_form(c, Lshore)
+            lg = int(np.floor(self.pos_grid ** 3 / 2))
+            v, t = create_rspace(self.pos_grid, self.pos_radius)
+            psi = self.cache_get(
+                'shore_matrix_positive_constraint',
+                key=(self.pos_grid, self.pos_radius)
             )
-
-            if not self.positive_constraint:
-                constraints = [M0[0] * c == 1]
-            else:
-                lg = int(np.floor(self.pos_grid ** 3 / 2))
-                v, t = create_rspace(self.pos_grid, self.pos_radius)
-                psi = self.cache_get(
+            if psi is None:
+                psi = shore_matrix_pdf(
+                    self.radial_order, self.zeta, t[:lg])
+                self.cache_set(
                     'shore_matrix_positive_constraint',
-                    key=(self.pos_grid, self.pos_radius)
-                )
-                if psi is None:
-                    psi = shore_matrix_pdf(
-                        self.radial_order, self.zeta, t[:lg])
-                    self.cache_set(
-                        'shore_matrix_positive_constraint',
-                        (self.pos_grid, self.pos_radius), psi)
-                constraints = [(M0[0] * c) == 1., (psi * c) >= 1e-3]
-            prob = cvxpy.Problem(objective, constraints)
-            try:
-                prob.solve(solver=self.cvxpy_solver)
-                coef = np.asarray(c.value).squeeze()
-            except Exception:
-                warn('Optimization did not find a solution')
-                coef = np.zeros(M.shape[1])
-        return ShoreFit(self, coef)
+                    (self.pos_grid, self.pos_radius), psi)
+            constraints = [(M0[0] * c) == 1., (psi * c) >= 1e-3]
+        prob = cvxpy.Problem(objective, constraints)
+        try:
+            prob.solve(solver=self.cvxpy_solver)
+            coef = np.asarray(c.value).squeeze()
+        except Exception:
+            warn('Optimization did not find a solution')
+            coef = np.zeros(M.shape[1])
+        return coef
 
 
 class ShoreFit():
 
     def __init__(self, model, shore_coef):
-        """ Calculates diffusion properties for a single voxel
+        """ Calculates diffusion properties for one or many voxels
 
         Parameters
         ----------
         model : object,
             AnalyticalModel
-        shore_coef : 1d ndarray,
-            shore coefficients
+        shore_coef : ndarray (..., P),
+            shore coefficients of each voxel
         """
 
         self.model = model
@@ -333,9 +370,10 @@ class ShoreFit():
             self.model.cache_set(
                 'shore_matrix_pdf', (gridsize, radius_max), psi)
 
-        propagator = np.dot(psi, self._shore_coef)
-        eap = np.empty((gridsize, gridsize, gridsize), dtype=float)
-        eap[tuple(rgrid.astype(int).T)] = propagator
+        propagator = np.dot(self._shore_coef, psi.T)
+        eap = np.empty(self._shore_coef.shape[:-1] +
+                       (gridsize, gridsize, gridsize), dtype=float)
+        eap[(Ellipsis, ) + tuple(rgrid.astype(int).T)] = propagator
         eap *= (2 * radius_max / (gridsize - 1)) ** 3
 
         return eap
@@ -356,43 +394,21 @@ class ShoreFit():
                 self.model.cache_set(
                     'shore_matrix_pdf', hash(r_points.data), psi)
 
-        eap = np.dot(psi, self._shore_coef)
+        eap = np.dot(self._shore_coef, psi.T)
 
-        return np.clip(eap, 0, eap.max())
+        return np.clip(eap, 0, eap.max(-1)[..., None])
 
     def odf_sh(self):
         r""" Calculates the real analytical ODF in terms of Spherical
         Harmonics.
         """
-        # Number of Spherical Harmonics involved in the estimation
-        J = (self.radial_order + 1) * (self.radial_order + 2) // 2
-
-        # Compute the Spherical Harmonics Coefficients
-        c_sh = np.zeros(J)
-        counter = 0
-
-        for l in range(0, self.radial_order + 1, 2):
-            for n in range(l, int((self.radial_order + l) / 2) + 1):
-                for m in range(-l, l + 1):
-
-                    j = int(l + m + (2 * np.array(range(0, l, 2)) + 1).sum())
-
-                    Cnl = (
-                        ((-1) ** (n - l / 2)) /
-                        (2.0 * (4.0 * np.pi ** 2 * self.zeta) ** (3.0 / 2.0)) *
-                        ((2.0 * (4.0 * np.pi ** 2 * self.zeta) ** (3.0 / 2.0) *
-                          factorial(n - l)) /
-                         (gamma(n + 3.0 / 2.0))) ** (1.0 / 2.0)
-                    )
-                    Gnl = (gamma(l / 2 + 3.0 / 2.0) * gamma(3.0 / 2.0 + n)) / \
-                        (gamma(l + 3.0 / 2.0) * factorial(n - l)) * \
-                        (1.0 / 2.0) ** (-l / 2 - 3.0 / 2.0)
-                    Fnl = hyp2f1(-n + l, l / 2 + 3.0 / 2.0, l + 3.0 / 2.0, 2.0)
-
-                    c_sh[j] += self._shore_coef[counter] * Cnl * Gnl * Fnl
-                    counter += 1
+        key = (self.radial_order, self.zeta)
+        odf_sh_matrix = self.model.cache_get('shore_matrix_odf_sh', key=key)
+        if odf_sh_matrix is None:
+            odf_sh_matrix = shore_matrix_odf_sh(self.radial_order, self.zeta)
+            self.model.cache_set('shore_matrix_odf_sh', key, odf_sh_matrix)
 
-        return c_sh
+        return np.dot(self._shore_coef, odf_sh_matrix.T)
 
     def odf(self, sphere):
         r""" Calculates the ODF for a given discrete sphere.
@@ -403,7 +419,7 @@ class ShoreFit():
                 self.radial_order,  self.zeta, sphere.vertices)
             self.model.cache_set('shore_matrix_odf', sphere, upsilon)
 
-        odf = np.dot(upsilon, self._shore_coef)
+        odf = np.dot(self._shore_coef, upsilon.T)
         return odf
 
     def rtop_signal(self):
@@ -416,15 +432,10 @@ class ShoreFit():
         diffusion imaging method for mapping tissue microstructure",
         NeuroImage, 2013.
         """
-        rtop = 0
-        c = self._shore_coef
-
-        for n in range(int(self.radial_order / 2) + 1):
-            rtop += c[n] * (-1) ** n * \
-                ((16 * np.pi * self.zeta ** 1.5 * gamma(n + 1.5)) / (
-                 factorial(n))) ** 0.5
-
-        return np.clip(rtop, 0, rtop.max())
+        return self._radial_sum([
+            (-1) ** n * ((16 * np.pi * self.zeta ** 1.5 * gamma(n + 1.5)) / (
+                factorial(n))) ** 0.5
+            for n in range(int(self.radial_order / 2) + 1)])
 
     def rtop_pdf(self):
         r""" Calculates the analytical return to origin probability (RTOP)
@@ -436,15 +447,10 @@ class ShoreFit():
         diffusion imaging method for mapping tissue microstructure",
         NeuroImage, 2013.
         """
-        rtop = 0
-        c = self._shore_coef
-        for n in range(int(self.radial_order / 2) + 1):
-            rtop += c[n] * (-1) ** n * \
-                ((4 * np.pi ** 2 * self.zeta ** 1.5 * factorial(n)) /
-                 (gamma(n + 1.5))) ** 0.5 * \
-                genlaguerre(n, 0.5)(0)
-
-        return np.clip(rtop, 0, rtop.max())
+        return self._radial_sum([
+            (-1) ** n * ((4 * np.pi ** 2 * self.zeta ** 1.5 * factorial(n)) /
+                         (gamma(n + 1.5))) ** 0.5 * genlaguerre(n, 0.5)(0)
+            for n in range(int(self.radial_order / 2) + 1)])
 
     def msd(self):
         r""" Calculates the analytical mean squared displacement (MSD) [1]_
@@ -465,22 +471,22 @@ class ShoreFit():
         .. [1] Wu Y. et al., "Hybrid diffusion imaging", NeuroImage, vol 36,
         p. 617-629, 2007.
         """
-        msd = 0
-        c = self._shore_coef
+        return self._radial_sum([
+            (-1) ** n * (9 * (gamma(n + 1.5)) / (
+                8 * np.pi ** 6 * self.zeta ** 3.5 * factorial(n))) ** 0.5 *
+            hyp2f1(-n, 2.5, 1.5, 2)
+            for n in range(int(self.radial_order / 2) + 1)])
 
-        for n in range(int(self.radial_order / 2) + 1):
-            msd += c[n] * (-1) ** n *\
-                (9 * (gamma(n + 1.5)) / (8 * np.pi ** 6 * self.zeta ** 3.5 *
-                                         factorial(n))) ** 0.5 *\
-                hyp2f1(-n, 2.5, 1.5, 2)
-
-        return np.clip(msd, 0, msd.max())
+    def _radial_sum(self, weights):
+        """ The weighted sum of the first ``radial_order / 2 + 1`` SHORE
+        coefficients of each voxel """
+        return np.dot(self._shore_coef[..., :len(weights)], weights)
 
     def fitted_signal(self):
         """ The fitted signal.
         """
-        phi = self.model.cache_get('shore_matrix', key=self.model.gtab)
-        return np.dot(phi, self._shore_coef)
+        phi = self.model._shore_matrix()
+        return np.dot(self._shore_coef, phi.T)
 
     @property
     def shore_coeff(self):
@@ -489,6 +495,54 @@ class ShoreFit():
         return self._shore_coef
 
 
+def shore_matrix_odf_sh(radial_order, zeta):
+    r"""Compute the matrix mapping the SHORE coefficients to the Spherical
+    Harmonics coefficients of the analytical ODF
+
+    Parameters
+    ----------
+    radial_order : unsigned int,
+        an even integer that represent the order of the basis
+    zeta : unsigned int,
+        scale factor
+
+    Returns
+    -------
+    odf_sh_matrix : array, shape ((radial_order + 1) * (radial_order + 2) / 2,
+                                  P)
+        The SH coefficients of the ODF are ``np.dot(odf_sh_matrix, coef)``.
+    """
+    # Number of Spherical Harmonics involved in the estimation
+    J = (radial_order + 1) * (radial_order + 2) // 2
+    F = radial_order / 2
+    n_c = int(np.round(1 / 6.0 * (F + 1) * (F + 2) * (4 * F + 3)))
+    odf_sh_matrix = np.zeros((J, n_c))
+    counter = 0
+
+    for l in range(0, radial_order + 1, 2):
+        for n in range(l, int((radial_order + l) / 2) + 1):
+            for m in range(-l, l + 1):
+
+                j = int(l + m + (2 * np.array(range(0, l, 2)) + 1).sum())
+
+                Cnl = (
+                    ((-1) ** (n - l / 2)) /
+                    (2.0 * (4.0 * np.pi ** 2 * zeta) ** (3.0 / 2.0)) *
+                    ((2.0 * (4.0 * np.pi ** 2 * zeta) ** (3.0 / 2.0) *
+                      factorial(n - l)) /
+                     (gamma(n + 3.0 / 2.0))) ** (1.0 / 2.0)
+                )
+                Gnl = (gamma(l / 2 + 3.0 / 2.0) * gamma(3.0 / 2.0 + n)) / \
+                    (gamma(l + 3.0 / 2.0) * factorial(n - l)) * \
+                    (1.0 / 2.0) ** (-l / 2 - 3.0 / 2.0)
+                Fnl = hyp2f1(-n + l, l / 2 + 3.0 / 2.0, l + 3.0 / 2.0, 2.0)
+
+                odf_sh_matrix[j, counter] = Cnl * Gnl * Fnl
+                counter += 1
+
+    return odf_sh_matrix
+
+
 def shore_matrix(radial_order, zeta, gtab, tau=1 / (4 * np.pi ** 2)):
     r"""Compute the SHORE matrix for modified Merlet's 3D-SHORE [1]_
 
@@ -1,12 +1,19 @@
-from dipy.reconst.cache import Cache
+import os
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+from nibabel.tmpdirs import InTemporaryDirectory
+
+from dipy.reconst.cache import Cache, DiskCache, stable_hash
 from dipy.core.sphere import Sphere
 
-from numpy.testing import assert_, assert_equal, run_module_suite
+from numpy.testing import (assert_, assert_equal, assert_array_equal,
+                           assert_raises, run_module_suite)
 
 
 class TestModel(Cache):
-    def __init__(self):
-        pass
+    def __init__(self, order=2):
+        self.order = order
 
 
 def test_basic_cache():
@@ -24,5 +31,117 @@ def test_basic_cache():
     assert_(t.cache_get("design_matrix", s) is None)
 
 
+def test_bounded_cache():
+    t = TestModel()
+    t.cache_max_bytes = 3 * 800
+    for i in range(3):
+        t.cache_set("odf_matrix", key=i, value=np.zeros(100) + i)
+    assert_equal(t.cache_info(), (0, 0, 0, 3, 2400, 2400))
+
+    # Using 0 makes 1 the least recently used value
+    assert_equal(t.cache_get("odf_matrix", 0)[0], 0)
+    t.cache_set("odf_matrix", key=3, value=np.zeros(100) + 3)
+    assert_(t.cache_get("odf_matrix", 1) is None)
+    for i in (0, 2, 3):
+        assert_equal(t.cache_get("odf_matrix", i)[0], i)
+    info = t.cache_info()
+    assert_equal((info.hits, info.misses, info.evictions), (4, 1, 1))
+
+    # Replacing a value updates the cached size, non arrays are free
+    t.cache_set("odf_matrix", key=3, value=np.zeros(50))
+    t.cache_set("odf_order", key=3, value=8)
+    info = t.cache_info()
+    assert_equal((info.entries, info.nbytes), (4, 2000))
+
+    # Values larger than the budget are not kept
+    t.cache_set("odf_matrix", key=4, value=np.zeros(400))
+    assert_(t.cache_get("odf_matrix", 4) is None)
+    assert_equal(t.cache_info().nbytes, 2000)
+
+    t.cache_clear()
+    assert_equal(t.cache_info(), (0, 0, 0, 0, 0, 2400))
+
+
+def test_threaded_cache():
+    t = TestModel()
+    t.cache_max_bytes = 10 * 800
+
+    def use_cache(i):
+        for j in range(200):
+            key = (i * 7 + j) % 25
+            if t.cache_get("odf_matrix", key) is None:
+                t.cache_set("odf_matrix", key=key, value=np.zeros(100))
+
+    pool = ThreadPool(8)
+    try:
+        pool.map(use_cache, range(16))
+    finally:
+        pool.close()
+        pool.join()
+    info = t.cache_info()
+    assert_equal(info.hits + info.misses, 16 * 200)
+    assert_equal(info.nbytes, 800 * info.entries)
+    assert_(info.nbytes <= t.cache_max_bytes)
+
+
+def test_stable_hash():
+    s1 = Sphere(theta=[0, 1], phi=[0, 1])
+    s2 = Sphere(theta=[0, 1], phi=[0, 1])
+    assert_equal(stable_hash(s1, 'a'), stable_hash(s2, 'a'))
+    assert_(stable_hash(s1, 'a') != stable_hash(s1, 'b'))
+    assert_equal(stable_hash(TestModel()), stable_hash(TestModel()))
+    assert_(stable_hash(TestModel()) != stable_hash(TestModel(order=4)))
+    assert_(stable_hash(np.zeros(2)) != stable_hash(np.zeros(2, 'f4')))
+    assert_raises(TypeError, stable_hash, object())
+    assert_raises(TypeError, stable_hash, np.array([None]))
+
+
+def test_disk_cache():
+    s = Sphere(theta=[0], phi=[0])
+    m = np.arange(6.).reshape(2, 3)
+
+    with InTemporaryDirectory() as tmpdir:
+        disk_cache = DiskCache(os.path.join(tmpdir, 'cache'))
+        t1 = TestModel()
+        t1.disk_cache = disk_cache
+        t1.cache_set("design_matrix", key=s, value=m)
+        # Values which are not arrays are only kept in memory
+        t1.cache_set("design_list", key=s, value=[1, 2])
+
+        # Another model with the same parameters finds the array on disk
+        t2 = TestModel()
+        t2.disk_cache = disk_cache
+        assert_array_equal(t2.cache_get("design_matrix", s), m)
+        assert_(t2.cache_get("design_list", s) is None)
+        t2.cache_clear()
+        assert_array_equal(t2.cache_get("design_matrix", s), m)
+
+        # Different parameters or keys do not
+        t3 = TestModel(order=4)
+        t3.disk_cache = disk_cache
+        assert_(t3.cache_get("design_matrix", s) is None)
+        assert_(t2.cache_get("design_matrix", Sphere(theta=[1], phi=[0]))
+                is None)
+
+        # Least recently used arrays are evicted past max_bytes
+        disk_cache = DiskCache(os.path.join(tmpdir, 'cache'),
+                               max_bytes=3 * m.nbytes + 500)
+        for i in range(4):
+            disk_cache.set(str(i), m + i)
+            os.utime(os.path.join(disk_cache.path, '%d.npy' % i),
+                     (i, i))
+        assert_(disk_cache.nbytes() <= disk_cache.max_bytes)
+        assert_(disk_cache.get('0') is None)
+        assert_array_equal(disk_cache.get('3'), m + 3)
+        # Arrays larger than the maximum size are not stored
+        disk_cache.set('big', np.zeros(disk_cache.max_bytes))
+        assert_(disk_cache.get('big') is None)
+
+        disk_cache.clear()
+        assert_equal(disk_cache.nbytes(), 0)
+        assert_(t2.cache_get("design_matrix", Sphere(theta=[0], phi=[0]))
+                is None)
+
+
 if __name__ == "__main__":
     run_module_suite()
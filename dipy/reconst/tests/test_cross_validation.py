@@ -14,6 +14,7 @@ import dipy.core.gradients as gt
 import dipy.sims.voxel as sims
 import dipy.reconst.csdeconv as csd
 import dipy.reconst.base as base
+import dipy.reconst.multi_voxel as multi_voxel
 
 
 # We'll set these globally:
@@ -108,6 +109,45 @@ def test_csd_xval():
     npt.assert_array_almost_equal(np.round(cod[0]), csd_cod)
 
 
+def test_xval_backends():
+    """
+    Test that the folds give the same predictions when run concurrently, and
+    that the fold models are reused
+    """
+    data = nib.load(fdata).get_data()[1:3, 1:3, 1:3].astype(np.float32)
+    gtab = gt.gradient_table(fbval, fbvec)
+    dm = dti.TensorModel(gtab, 'LS')
+    mask = np.ones(data.shape[:-1], dtype=bool)
+    mask[0, 0, 0] = False
+
+    np.random.seed(2016)
+    kf_serial = xval.kfold_xval(dm, data, 4, mask=mask)
+    npt.assert_equal(kf_serial.dtype, np.float32)
+    n_models = len(xval._fold_models)
+    for backend in ['thread', 'process']:
+        np.random.seed(2016)
+        kf = xval.kfold_xval(dm, data, 4, mask=mask, backend=backend,
+                             nbr_workers=2)
+        npt.assert_array_almost_equal(kf, kf_serial)
+    # The same split was used every time:
+    npt.assert_equal(len(xval._fold_models), n_models)
+    npt.assert_raises(ValueError, xval.kfold_xval, dm, data, 4,
+                      backend='gpu')
+
+    # Without the number of cpus, the folds are run one after the other
+    def cpu_count():
+        raise NotImplementedError
+    original_cpu_count = multi_voxel.cpu_count
+    multi_voxel.cpu_count = cpu_count
+    try:
+        np.random.seed(2016)
+        kf = npt.assert_warns(UserWarning, xval.kfold_xval, dm, data, 4,
+                              mask=mask, backend='thread')
+    finally:
+        multi_voxel.cpu_count = original_cpu_count
+    npt.assert_array_almost_equal(kf, kf_serial)
+
+
 def test_no_predict():
     """
     Test that if you try to do this with a model that doesn't have a `predict`
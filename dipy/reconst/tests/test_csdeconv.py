@@ -13,6 +13,8 @@ from dipy.sims.voxel import (multi_tensor,
 from dipy.core.gradients import gradient_table
 from dipy.reconst.csdeconv import (ConstrainedSphericalDeconvModel,
                                    ConstrainedSDTModel,
+                                   csdeconv,
+                                   csdeconv_batch,
                                    forward_sdeconv_mat,
                                    odf_deconv,
                                    odf_sh_to_sharp,
@@ -256,6 +258,51 @@ def test_csdeconv():
     assert_equal(nvoxels, 0)
 
 
+def test_csdeconv_batch():
+    _, fbvals, fbvecs = get_data('small_64D')
+    bvals = np.load(fbvals)
+    bvecs = np.load(fbvecs)
+    gtab = gradient_table(bvals, bvecs)
+    mevals = np.array(([0.0015, 0.0003, 0.0003],
+                       [0.0015, 0.0003, 0.0003]))
+    response = (np.array([0.0015, 0.0003, 0.0003]), 1)
+    csd = ConstrainedSphericalDeconvModel(gtab, response)
+
+    np.random.seed(1)
+    data = np.zeros((4, 5, len(bvals)))
+    for ij in np.ndindex(data.shape[:-1]):
+        angles = np.random.rand(2, 2) * [90, 360]
+        data[ij], _ = multi_tensor(gtab, mevals, 1, angles=angles,
+                                   fractions=[50, 50], snr=30)
+    # An isotropic voxel and an empty voxel
+    data[0, 0] = 1
+    data[0, 1] = 0
+
+    dwi = data[..., ~gtab.b0s_mask].reshape(-1, np.sum(~gtab.b0s_mask))
+    fodf_sh, num_it = csdeconv_batch(dwi, csd._X, csd.B_reg, csd.tau,
+                                     P=csd._P)
+    for i, dwsignal in enumerate(dwi):
+        expected_sh, expected_it = csdeconv(dwsignal, csd._X, csd.B_reg,
+                                            csd.tau, P=csd._P)
+        assert_array_almost_equal(fodf_sh[i], expected_sh)
+        assert_equal(num_it[i], expected_it)
+
+    fodf_sh2, num_it2 = csdeconv_batch(dwi, csd._X, csd.B_reg, csd.tau,
+                                       num_threads=2)
+    assert_array_almost_equal(fodf_sh2, fodf_sh)
+    assert_array_equal(num_it2, num_it)
+
+    # The multi voxel fit of the model uses the batched solver
+    csd_fit = csd.fit(data)
+    assert_array_almost_equal(csd_fit.shm_coeff,
+                              fodf_sh.reshape(data.shape[:-1] + (-1,)))
+    mask = np.random.rand(*data.shape[:-1]) > .5
+    csd_fit = csd.fit(data, mask, chunk_size=3)
+    assert_array_almost_equal(csd_fit.shm_coeff[mask],
+                              fodf_sh[mask.ravel()])
+    assert_array_equal(csd_fit.shm_coeff[~mask], 0)
+
+
 def test_odfdeconv():
     SNR = 100
     S0 = 1
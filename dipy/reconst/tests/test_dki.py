@@ -732,3 +732,36 @@ def test_multi_voxel_kurtosis_maximum():
     RK[1, 1, 1] = 0
     k_max = dki.kurtosis_maximum(dkiF.model_params, mask=mask)
     assert_almost_equal(k_max, RK, decimal=4)
+
+    # TEST - voxels processed in chunks
+    k_max_chunks = dki.kurtosis_maximum(dkiF.model_params, mask=mask,
+                                        chunk_size=3)
+    assert_array_almost_equal(k_max_chunks, k_max)
+    assert_raises(ValueError, dki.kurtosis_maximum, dkiF.model_params,
+                  chunk_size=0)
+
+    # TEST - batched and single voxel maxima agree on crossing fibers
+    params = np.array([crossing_ref, crossing_ref])
+    params[1, 12:] = 0
+    evals, evecs, kt = dki.split_dki_param(params)
+    dt = lower_triangular(dki.vec_val_vect(evecs, evals))
+    MD = dki.mean_diffusivity(evals)
+    k_max, _ = dki._kurtosis_maximum_batch(dt, MD, kt, sphere, gtol=1e-5)
+    for v in range(2):
+        k_voxel, _ = dki._voxel_kurtosis_maximum(dt[v], MD[v], kt[v], sphere,
+                                                 gtol=1e-5)
+        assert_almost_equal(k_max[v], np.squeeze(k_voxel), decimal=5)
+
+
+def test_dki_streaming_fit():
+    data = np.concatenate((DWI, DWI, DWI), axis=2)
+    data[:, :, 1] = signal_sph
+    mask = np.ones(data.shape[:-1], dtype=bool)
+    mask[0, 0, 2] = False
+    dkiM = dki.DiffusionKurtosisModel(gtab_2s)
+    dkiF = dkiM.fit(data, mask)
+    out = dti.streaming_fit(dkiM, data, mask, metrics=('mk', 'fa'),
+                            slab_size=1)
+    assert_array_almost_equal(out['model_params'], dkiF.model_params)
+    assert_array_almost_equal(out['mk'], dkiF.mk())
+    assert_array_almost_equal(out['fa'], dkiF.fa)
@@ -3,9 +3,11 @@ from numpy.testing import (assert_equal,
                            assert_almost_equal,
                            run_module_suite,
                            assert_array_equal,
+                           assert_array_almost_equal,
                            assert_raises)
 from dipy.data import get_data, dsi_voxels
-from dipy.reconst.dsi import DiffusionSpectrumModel
+from dipy.reconst.dsi import (DiffusionSpectrumModel, pdf_interp_coords,
+                              pdf_odf, pdf_odf_matrix)
 from dipy.reconst.odf import gfa
 from dipy.direction.peaks import peak_directions
 from dipy.sims.voxel import SticksAndBall
@@ -102,6 +104,49 @@ def test_multib0_dsi():
     assert_equal(np.alltrue(np.isreal(pdf)), True)
 
 
+def test_dsi_chunks():
+    data, gtab = dsi_voxels()
+    sphere = get_sphere('symmetric724')
+    ds = DiffusionSpectrumModel(gtab)
+    mask = np.zeros(data.shape[:-1], dtype=bool)
+    mask[1:, :5, 2] = True
+
+    # The fits of chunks of voxels match the fits of single voxels
+    dsfit = ds.fit(data, mask=mask, chunk_size=7)
+    odf = dsfit.odf(sphere)
+    pdf = dsfit.pdf()
+    rtop = dsfit.rtop_pdf()
+    msd = dsfit.msd_discrete(normalized=False)
+    assert_equal(odf.shape, data.shape[:-1] + (len(sphere.vertices),))
+    assert_array_equal(odf[~mask], 0)
+    assert_array_equal(rtop[~mask], 0)
+    for ijk in np.ndindex(*mask.shape):
+        if mask[ijk]:
+            voxel_fit = ds.fit(data[ijk])
+            assert_array_almost_equal(odf[ijk], voxel_fit.odf(sphere))
+            assert_array_almost_equal(pdf[ijk], voxel_fit.pdf())
+            assert_almost_equal(rtop[ijk], voxel_fit.rtop_pdf())
+            assert_almost_equal(msd[ijk],
+                                voxel_fit.msd_discrete(normalized=False))
+    assert_array_almost_equal(dsfit[1:, :5, 2].odf(sphere), odf[1:, :5, 2])
+    assert_array_almost_equal(ds.fit(data, nbr_workers=2).odf(sphere)[mask],
+                              odf[mask])
+
+    assert_raises(ValueError, ds.fit, data, mask[0])
+    assert_raises(ValueError, ds.fit, data, chunk_size=0)
+
+
+def test_pdf_odf_matrix():
+    sphere = get_sphere('symmetric362')
+    radius = np.arange(2.1, 9, .5)
+    Pr = np.random.RandomState(0).rand(17, 17, 17)
+    interp_coords = pdf_interp_coords(sphere, radius, 8)
+    odf_matrix = pdf_odf_matrix(interp_coords, radius, Pr.shape)
+    # Including the coordinates that fall outside of the grid
+    assert_array_almost_equal(odf_matrix.T.dot(Pr.ravel()),
+                              pdf_odf(Pr, radius, interp_coords))
+
+
 def sticks_and_ball_dummies(gtab):
     sb_dummies = {}
     S, sticks = SticksAndBall(gtab, d=0.0015, S0=100,
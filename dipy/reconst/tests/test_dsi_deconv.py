@@ -3,9 +3,11 @@ from numpy.testing import (assert_equal,
                            assert_almost_equal,
                            run_module_suite,
                            assert_array_equal,
+                           assert_array_almost_equal,
                            assert_raises)
 from dipy.data import get_data, dsi_deconv_voxels
-from dipy.reconst.dsi import DiffusionSpectrumDeconvModel
+from dipy.reconst.dsi import (DiffusionSpectrumDeconvModel, LR_deconv,
+                              gen_PSF)
 from dipy.reconst.odf import gfa
 from dipy.direction.peaks import peak_directions
 from dipy.sims.voxel import SticksAndBall
@@ -72,6 +74,21 @@ def test_multivox_dsi():
     assert_equal(data.shape[:-1] + (35, 35, 35), PDF.shape)
     assert_equal(np.alltrue(np.isreal(PDF)), True)
 
+    # Voxels deconvolved in chunks or one by one give the same propagators
+    PDF = DS.fit(data, chunk_size=3).pdf()
+    for ijk in np.ndindex(*data.shape[:-1]):
+        assert_array_almost_equal(PDF[ijk], DS.fit(data[ijk]).pdf())
+
+
+def test_LR_deconv_stack():
+    rng = np.random.RandomState(1)
+    qgrid = rng.randint(4, 11, (40, 3))
+    psf = gen_PSF(qgrid, 15, 15, 15)
+    props = rng.rand(3, 15, 15, 15)
+    deconv = LR_deconv(props, psf, 5, 2)
+    for prop, prop_deconv in zip(props, deconv):
+        assert_array_almost_equal(prop_deconv, LR_deconv(prop, psf, 5, 2))
+
 
 if __name__ == '__main__':
     run_module_suite()
@@ -3,6 +3,8 @@
 """
 from __future__ import division, print_function, absolute_import
 
+import os
+
 import numpy as np
 from nose.tools import (assert_true, assert_equal,
                         assert_almost_equal, assert_raises)
@@ -10,6 +12,7 @@ import numpy.testing as npt
 from numpy.testing import (assert_array_equal, assert_array_almost_equal,
                            assert_)
 import nibabel as nib
+from nibabel.tmpdirs import InTemporaryDirectory
 
 import scipy.optimize as opt
 
@@ -620,6 +623,80 @@ def test_nlls_fit_tensor():
     assert_array_almost_equal(tf1.fa, tf2.fa, decimal=1)
 
 
+def test_nlls_fit_batch():
+    # The batched fit converges to the same minimum as fitting each voxel
+    # with scipy's leastsq
+    bvecs, bval = read_bvec_file(get_data('55dir_grad.bvec'))
+    gtab = grad.gradient_table(bval, bvecs)
+    X = dti.design_matrix(gtab)
+    rng = np.random.RandomState(1234)
+    D = np.array([1., 0., 1., 0., 0., 1., 0.]) / bval[1]
+    D = D * rng.uniform(0.5, 1.5, (20, 7))
+    D[:, 6] = -np.log(1000.)
+    Y = np.exp(np.dot(D, X.T)) + rng.normal(0, 20, (20, len(X)))
+    Y = np.abs(Y)
+
+    tensor_model = dti.TensorModel(gtab, fit_method='NLLS',
+                                   return_S0_hat=True)
+    tensor_fit = tensor_model.fit(Y)
+    for vox in range(len(Y)):
+        start = np.dot(np.linalg.pinv(X), np.log(Y[vox]))
+        expected, _ = opt.leastsq(dti._nlls_err_func, start,
+                                  args=(X, Y[vox]),
+                                  Dfun=dti._nlls_jacobian_func)
+        assert_array_almost_equal(tensor_fit.quadratic_form[vox],
+                                  from_lower_triangular(expected[:6]))
+        assert_almost_equal(tensor_fit.S0_hat[vox], np.exp(-expected[6]),
+                            places=3)
+
+    # All voxels with outliers are handled together by RESTORE
+    Y_out = Y.copy()
+    Y_out[::2, 5] = 1.
+    tensor_model = dti.TensorModel(gtab, fit_method='RESTORE', sigma=20.)
+    restore_fit = tensor_model.fit(Y_out)
+    assert_array_almost_equal(restore_fit.evals * 1e3,
+                              tensor_fit.evals * 1e3, decimal=1)
+
+    # Sigma weighting with a different noise level in each direction
+    sigma = rng.uniform(10, 30, len(X))
+    sigma_params = dti.nlls_fit_tensor(X, Y, weighting='sigma', sigma=sigma)
+    for vox in range(len(Y)):
+        start = np.dot(np.linalg.pinv(X), np.log(Y[vox]))
+        expected, _ = opt.leastsq(dti._nlls_err_func, start,
+                                  args=(X, Y[vox], 'sigma', sigma))
+        evals, evecs = dti.decompose_tensor(
+            from_lower_triangular(expected[:6]))
+        assert_array_almost_equal(sigma_params[vox, :3] * 1e3, evals * 1e3,
+                                  decimal=4)
+
+    # The Geman-McClure weighting is robust to outliers
+    gmm_params = dti.nlls_fit_tensor(X, Y_out, weighting='gmm')
+    nlls_params = dti.nlls_fit_tensor(X, Y_out)
+    gmm_error = np.abs(gmm_params[::2, :3] - tensor_fit.evals[::2])
+    nlls_error = np.abs(nlls_params[::2, :3] - tensor_fit.evals[::2])
+    npt.assert_(np.mean(gmm_error) < np.mean(nlls_error))
+
+    # Fitting in chunks gives the same tensors
+    for fit_tensor, kwargs in [(dti.nlls_fit_tensor, {'weighting': 'gmm'}),
+                               (dti.restore_fit_tensor, {'sigma': 20.})]:
+        params, S0 = fit_tensor(X, Y_out, return_S0_hat=True, **kwargs)
+        chunk_params, chunk_S0 = fit_tensor(X, Y_out, return_S0_hat=True,
+                                            step=3, **kwargs)
+        assert_array_almost_equal(chunk_params, params)
+        assert_array_almost_equal(chunk_S0, S0)
+
+    # The weighting and sigma can be given as positional arguments
+    assert_array_almost_equal(dti.nlls_fit_tensor(X, Y, 'sigma', sigma),
+                              sigma_params)
+    assert_array_almost_equal(dti.restore_fit_tensor(X, Y_out, 20.),
+                              restore_fit.model_params)
+
+    tensor_model = dti.TensorModel(gtab, fit_method='NLLS', weighting='l1')
+    npt.assert_raises(ValueError, tensor_model.fit, Y)
+    tensor_model = dti.TensorModel(gtab, fit_method='RESTORE')
+    npt.assert_raises(ValueError, tensor_model.fit, Y)
+
+
 def test_restore():
     """
     Test the implementation of the RESTORE algorithm
@@ -803,3 +880,70 @@ def test_decompose_tensor_nan():
                                            from_lower_triangular(D_alter))
     assert_array_almost_equal(lalter, np.array([1.6e-3, 0.4e-3, 0.3e-3]))
     assert_array_almost_equal(valter, vref)
+
+
+def test_streaming_fit():
+    fdata, fbvals, fbvecs = get_data('small_64D')
+    bvals = np.load(fbvals)
+    bvecs = np.load(fbvecs)
+    gtab = grad.gradient_table(bvals, bvecs)
+    img = nib.load(fdata)
+    data = img.get_data()
+    mask = data[..., 0] > 0
+    mask[..., 3:6] = False
+    tensor_model = TensorModel(gtab)
+    tensor_fit = tensor_model.fit(data, mask)
+
+    with InTemporaryDirectory() as tmpdir:
+        out = dti.streaming_fit(tensor_model, nib.load(fdata), mask,
+                                metrics=('fa', 'md', 'evecs'), slab_size=3,
+                                out_dir=tmpdir)
+        assert_equal(sorted(out), ['evecs', 'fa', 'md', 'model_params'])
+        assert_array_almost_equal(out['model_params'],
+                                  tensor_fit.model_params)
+        for name in ('fa', 'md', 'evecs'):
+            assert_array_almost_equal(out[name][mask],
+                                      getattr(tensor_fit, name)[mask])
+        # Slabs without voxels in the mask are not fitted
+        assert_array_equal(out['evecs'][:, :, 3:6], 0)
+        assert_array_almost_equal(np.load(os.path.join(tmpdir, 'fa.npy')),
+                                  out['fa'])
+        del out
+
+    out = dti.streaming_fit(tensor_model, data, slab_size=4)
+    assert_array_almost_equal(out['model_params'],
+                              tensor_model.fit(data).model_params)
+    assert_raises(ValueError, dti.streaming_fit, tensor_model, data,
+                  mask[0])
+    assert_raises(ValueError, dti.streaming_fit, tensor_model, data,
+                  slab_size=0)
+
+
+def test_tensor_fit_metrics():
+    data, gtab = dsi_voxels()
+    mask = np.ones(data.shape[:-1], dtype=bool)
+    mask[0, 0, 0] = False
+    tensor_fit = TensorModel(gtab).fit(data, mask)
+    names = ['fa', 'ga', 'md', 'rd', 'ad', 'trace', 'mode', 'linearity',
+             'planarity', 'sphericity', 'color_fa', 'evals', 'evecs']
+    metrics = tensor_fit.metrics(names + ['lower_triangular'], chunk_size=7)
+    assert_equal(sorted(metrics), sorted(names + ['lower_triangular']))
+    for name in names:
+        assert_array_almost_equal(metrics[name], getattr(tensor_fit, name))
+    assert_array_almost_equal(metrics['lower_triangular'],
+                              tensor_fit.lower_triangular())
+
+    # Single precision outputs, some of them preallocated
+    fa = np.zeros(tensor_fit.shape, dtype=np.float32)
+    metrics = tensor_fit.metrics(['fa', 'mode'], dtype=np.float32,
+                                 out={'fa': fa})
+    assert_(metrics['fa'] is fa)
+    assert_equal(metrics['mode'].dtype, np.float32)
+    assert_array_almost_equal(fa, tensor_fit.fa, decimal=5)
+    assert_array_almost_equal(metrics['mode'][mask], tensor_fit.mode[mask],
+                              decimal=5)
+
+    assert_raises(ValueError, tensor_fit.metrics, ['fa', 'foo'])
+    assert_raises(ValueError, tensor_fit.metrics, 'fa', out={'fa': fa[0]})
+    assert_raises(ValueError, tensor_fit.metrics, 'fa',
+                  out={'fa': np.asfortranarray(fa)})
@@ -213,5 +213,39 @@ def test_multivox_forecast():
     mse3 = np.sum((S_predict[2, 0, 0]-S[2, 0, 0])**2) / len(gtab.bvals)
     assert_almost_equal(mse3, 0.0, 3)
 
+
+def test_forecast_batch():
+    gtab = get_3shell_gtab()
+    mevals = np.array(([0.0017, 0.0003, 0.0003],
+                       [0.0015, 0.0005, 0.0005]))
+    angles = [[(0, 0), (60, 0)], [(90, 0), (45, 90)], [(0, 0), (90, 0)],
+              [(30, 20), (30, 20)]]
+    S = np.zeros((2, 2, 1, len(gtab.bvals)))
+    for i, angl in enumerate(angles):
+        S[i // 2, i % 2, 0], _ = MultiTensor(
+            gtab, mevals, S0=100.0, angles=angl,
+            fractions=[50, 50], snr=50)
+    mask = np.ones(S.shape[:3], dtype=bool)
+    mask[1, 0, 0] = False
+
+    sphere = get_sphere('repulsion100')
+    for dec_alg in ['WLS', 'CSD']:
+        fm = ForecastModel(gtab, sh_order=6, dec_alg=dec_alg)
+        f_fit = fm.fit(S, mask=mask)
+        odf = f_fit.odf(sphere)
+        S_predict = f_fit.predict(S0=100.0)
+        fa = f_fit.fractional_anisotropy()
+        assert_equal(odf.shape, S.shape[:3] + (len(sphere.vertices),))
+        assert_equal(odf[1, 0, 0], 0)
+        for idx in zip(*np.nonzero(mask)):
+            v_fit = fm.fit(S[idx])
+            assert_almost_equal(f_fit.dpar[idx], v_fit.dpar)
+            assert_almost_equal(f_fit.dperp[idx], v_fit.dperp)
+            assert_almost_equal(f_fit.sh_coeff[idx], v_fit.sh_coeff)
+            assert_almost_equal(fa[idx], v_fit.fractional_anisotropy())
+            assert_almost_equal(odf[idx], v_fit.odf(sphere))
+            assert_almost_equal(S_predict[idx], v_fit.predict(S0=100.0))
+
+
 if __name__ == '__main__':
     run_module_suite()
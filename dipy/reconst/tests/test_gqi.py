@@ -7,12 +7,14 @@ from dipy.reconst.gqi import GeneralizedQSamplingModel
 from dipy.data import get_sphere
 from numpy.testing import (assert_equal,
                            assert_almost_equal,
+                           assert_array_almost_equal,
+                           assert_raises,
                            run_module_suite)
 from dipy.reconst.tests.test_dsi import sticks_and_ball_dummies
 from dipy.core.subdivide_octahedron import create_unit_sphere
 from dipy.core.sphere_stats import angular_similarity
 from dipy.reconst.odf import gfa
-from dipy.direction.peaks import peak_directions
+from dipy.direction.peaks import peak_directions, peaks_from_model
 
 
 def test_gqi():
@@ -73,5 +75,51 @@ def test_mvoxel_gqi():
     assert_equal(directions.shape[0], 2)
 
 
+def test_gqi_volume_fit():
+    data, gtab = dsi_voxels()
+    sphere = get_sphere('symmetric724')
+    mask = np.zeros(data.shape[:-1], dtype=bool)
+    mask[1:, :, 1] = True
+
+    for method in ['standard', 'gqi2']:
+        gq = GeneralizedQSamplingModel(gtab, method, 1.2)
+        gqfit = gq.fit(data, mask=mask)
+
+        # Chunked ODFs match the ODFs of single voxel fits
+        odfs = gqfit.odf(sphere, chunk_size=3)
+        assert_equal(odfs.shape, data.shape[:-1] + (len(sphere.vertices),))
+        assert_equal(odfs[~mask], 0)
+        for ijk in np.ndindex(*mask.shape):
+            if mask[ijk]:
+                assert_array_almost_equal(odfs[ijk],
+                                          gq.fit(data[ijk]).odf(sphere))
+                assert_array_almost_equal(gqfit[ijk].odf(sphere),
+                                          odfs[ijk])
+        assert_array_almost_equal(gqfit[1:, :, 1].odf(sphere),
+                                  odfs[1:, :, 1])
+
+        odfs32 = gqfit.odf(sphere, dtype=np.float32)
+        assert_equal(odfs32.dtype, np.float32)
+        assert_array_almost_equal(odfs32 / odfs.max(), odfs / odfs.max(), 5)
+
+        gfa_map = gqfit.gfa(sphere, chunk_size=4)
+        assert_array_almost_equal(gfa_map[mask], gfa(odfs[mask]))
+        assert_equal(gfa_map[~mask], 0)
+
+        # The QA maps are those of peaks_from_model
+        pam = peaks_from_model(gq, data, sphere, .5, 25, mask=mask,
+                               normalize_peaks=True)
+        assert_array_almost_equal(gqfit.qa(sphere, .5, 25, chunk_size=5),
+                                  pam.qa)
+        assert_array_almost_equal(gqfit.qa(sphere, .5, 25,
+                                           dtype=np.float32), pam.qa, 4)
+        qa_map = gqfit.qa(sphere, .5, 25, normalize=False)
+        assert_array_almost_equal(qa_map[mask][:, 0],
+                                  odfs[mask].max(-1) - odfs[mask].min(-1))
+
+    assert_raises(ValueError, gq.fit, data, mask[0])
+    assert_raises(ValueError, gqfit.odf, sphere, chunk_size=0)
+
+
 if __name__ == "__main__":
     run_module_suite()
@@ -11,6 +11,8 @@ References
        of brain perfusion with intravoxel incoherent motion
        MR imaging." Radiology 265.3 (2012): 874-881.
 """
+import warnings
+
 import numpy as np
 from numpy.testing import (assert_array_equal, assert_array_almost_equal,
                            assert_raises, assert_array_less, run_module_suite,
@@ -405,6 +407,37 @@ def test_leastsq_failing():
     assert_array_almost_equal(fit_single.D, 6.936684e-04)
 
 
+def test_batch_fit():
+    """
+    Test that fitting many voxels at once gives the same parameters as
+    fitting each voxel separately.
+    """
+    rng = np.random.RandomState(1234)
+    params_multi = np.column_stack([rng.uniform(500, 1500, 20),
+                                    rng.uniform(0.05, 0.25, 20),
+                                    rng.uniform(0.005, 0.02, 20),
+                                    rng.uniform(0.0005, 0.002, 20)])
+    data = ivim_prediction(params_multi, gtab)
+    data = np.abs(data + rng.normal(0, 10, data.shape))
+    # Include a voxel for which the linear fit is returned
+    data[0] = noisy_single
+
+    for model in [ivim_model, IvimModel(gtab, two_stage=False),
+                  IvimModel(gtab, x_scale='jac'),
+                  IvimModel(gtab, x_scale=[1., 1., 1., 1.])]:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            expected = np.array([model.fit(d).model_params for d in data])
+        assert_warns(UserWarning, model.fit, data)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            ivim_fit = model.fit(data.reshape(4, 5, -1))
+        assert_array_almost_equal(ivim_fit.model_params.reshape(-1, 4) /
+                                  expected, 1, decimal=4)
+        assert_array_almost_equal(ivim_fit.predict(gtab).reshape(data.shape),
+                                  ivim_prediction(expected, gtab), decimal=1)
+
+
 def test_leastsq_error():
     """
     Test error handling of the `_leastsq` method works when unfeasible x0 is
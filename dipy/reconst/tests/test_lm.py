@@ -0,0 +1,24 @@
+import numpy as np
+import numpy.testing as npt
+
+from dipy.reconst._lm import solve_stacked
+
+
+def test_solve_stacked():
+    rng = np.random.RandomState(0)
+    a = rng.rand(5, 3, 3) + 3 * np.eye(3)
+    b = rng.rand(5, 3)
+    npt.assert_array_almost_equal(solve_stacked(a, b),
+                                  [np.linalg.solve(ai, bi)
+                                   for ai, bi in zip(a, b)])
+
+    # Singular systems get nan, the others are still solved
+    a[2] = 0
+    x = solve_stacked(a, b)
+    npt.assert_(np.all(np.isnan(x[2])))
+    for i in [0, 1, 3, 4]:
+        npt.assert_array_almost_equal(x[i], np.linalg.solve(a[i], b[i]))
+
+
+if __name__ == '__main__':
+    npt.run_module_suite()
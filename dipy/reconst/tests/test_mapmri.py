@@ -294,6 +294,37 @@ def test_mapmri_isotropic_static_scale_factor(radial_order=6):
                         mapf_scale_adapt_reg_stat.fitted_signal())
 
 
+def test_mapmri_isotropic_static_scale_batch_fit(radial_order=6):
+    gtab = get_gtab_taiwan_dsi()
+    l1, l2, l3 = [0.0015, 0.0003, 0.0003]
+    S = np.array([generate_signal_crossing(gtab, l1, l2, l3, angle2=a)[0]
+                  for a in [40, 60, 90]])
+    S_noise = add_noise(np.tile(S, (2, 1, 1)), snr=20, S0=100.)
+    mask = np.ones(S_noise.shape[:-1], dtype=bool)
+    mask[1, 1] = False
+
+    for weighting in [0.2, np.linspace(0, .3, 301), "GCV"]:
+        mapmod = MapmriModel(gtab, radial_order=radial_order,
+                             laplacian_regularization=True,
+                             laplacian_weighting=weighting,
+                             anisotropic_scaling=False,
+                             dti_scale_estimation=False)
+        mapfit = mapmod.fit(S_noise, mask=mask)
+        assert_equal(mapfit.fit_array[1, 1], None)
+        for ijk in zip(*np.nonzero(mask)):
+            voxel_fit = mapmod.fit(S_noise[ijk])
+            # the batched GCV search may end on a slightly lower cost
+            gcv = isinstance(weighting, str)
+            decimal = 3 if gcv else 7
+            assert_array_almost_equal(mapfit[ijk]._mapmri_coef,
+                                      voxel_fit._mapmri_coef, decimal)
+            assert_array_almost_equal(mapfit[ijk].fitted_signal(),
+                                      voxel_fit.fitted_signal(), decimal)
+            if not gcv:
+                assert_equal(mapfit[ijk].lopt, voxel_fit.lopt)
+            assert_array_almost_equal(mapfit[ijk].R, voxel_fit.R)
+
+
 def test_mapmri_signal_fitting_over_radial_order(order_max=8):
     gtab = get_gtab_taiwan_dsi()
     l1, l2, l3 = [0.0012, 0.0003, 0.0003]
@@ -5,7 +5,9 @@ from functools import reduce
 import numpy as np
 import numpy.testing as npt
 
-from dipy.reconst.multi_voxel import _squash, multi_voxel_fit, CallableArray
+from dipy.reconst import multi_voxel
+from dipy.reconst.multi_voxel import (_squash, multi_voxel_fit, CallableArray,
+                                      MultiVoxelFit, PackedMultiVoxelFit)
 from dipy.core.sphere import unit_icosahedron
 
 
@@ -178,3 +180,167 @@ def test_multi_voxel_fit():
     # Test indexing into a fit
     npt.assert_equal(type(fit[0, 0, 0]), SillyFit)
     npt.assert_equal(fit[:2, :2, :2].shape, (2, 2, 2))
+
+
+class _MeanModel(object):
+    # Defined at module level so that it can be pickled by the process backend
+
+    @multi_voxel_fit
+    def fit(self, data):
+        return _MeanFit(self, data)
+
+
+class _MeanFit(object):
+
+    def __init__(self, model, data):
+        self.model = model
+        self.mean = data.mean()
+        self.data = data
+
+
+def test_multi_voxel_fit_backends():
+    data = np.random.rand(4, 5, 3, 10)
+    mask = np.random.rand(4, 5, 3) > 0.3
+    model = _MeanModel()
+
+    serial_fit = model.fit(data, mask)
+    for backend in ['thread', 'process']:
+        for chunk_size in [None, 1, 7, 1000]:
+            fit = model.fit(data, mask, backend=backend, nbr_workers=2,
+                            chunk_size=chunk_size)
+            npt.assert_array_equal(fit.mean, serial_fit.mean)
+            npt.assert_array_equal(fit.data, serial_fit.data)
+            npt.assert_array_equal(fit.mask, mask)
+            npt.assert_(fit[~mask].shape == (np.sum(~mask),))
+            npt.assert_(all(f is None for f in fit.fit_array[~mask]))
+
+    # Without a mask
+    fit = model.fit(data, backend='thread', nbr_workers=3)
+    npt.assert_array_almost_equal(fit.mean, data.mean(-1))
+
+    # Defaults given to the decorator
+    class ThreadedModel(object):
+
+        @multi_voxel_fit(backend='thread', nbr_workers=2, chunk_size=4)
+        def fit(self, data):
+            return _MeanFit(self, data)
+
+    fit = ThreadedModel().fit(data, mask)
+    npt.assert_array_equal(fit.mean, serial_fit.mean)
+
+    npt.assert_raises(ValueError, model.fit, data, mask, backend='gpu')
+    npt.assert_raises(ValueError, model.fit, data, mask, backend='thread',
+                      nbr_workers=0)
+    npt.assert_raises(ValueError, model.fit, data, mask, backend='thread',
+                      chunk_size=0)
+    npt.assert_raises(ValueError, multi_voxel_fit, _MeanModel.fit,
+                      backend='gpu')
+
+    # Without the number of cpus, the voxels are fitted in the calling thread
+    def cpu_count():
+        raise NotImplementedError
+    original_cpu_count = multi_voxel.cpu_count
+    original_parallel_fit = multi_voxel._parallel_fit
+    multi_voxel.cpu_count = cpu_count
+    multi_voxel._parallel_fit = None
+    try:
+        fit = npt.assert_warns(UserWarning, model.fit, data, mask,
+                               backend='thread')
+    finally:
+        multi_voxel.cpu_count = original_cpu_count
+        multi_voxel._parallel_fit = original_parallel_fit
+    npt.assert_array_equal(fit.mean, serial_fit.mean)
+
+
+class _PackedMeanModel(_MeanModel):
+
+    def fit_to_params(self, fit):
+        return np.array([fit.mean, fit.data[0]])
+
+    def params_to_fit(self, params):
+        return _VectorizedMeanFit(self, params)
+
+
+class _VectorizedMeanFit(object):
+
+    def __init__(self, model, params):
+        self.model = model
+        self.mean = params[..., 0]
+        self.first = params[..., 1]
+
+    def odf(self, sphere):
+        return self.mean[..., None] * np.ones(len(sphere.phi))
+
+    def predict(self, S0=1.):
+        return (np.asarray(S0) * self.mean)[..., None] * np.ones(3)
+
+
+def test_packed_multi_voxel_fit():
+    data = np.random.rand(4, 5, 3, 10)
+    mask = np.random.rand(4, 5, 3) > 0.3
+    model = _PackedMeanModel()
+
+    fit = model.fit(data, mask)
+    npt.assert_equal(type(fit), PackedMultiVoxelFit)
+    npt.assert_equal(fit.params.shape, (4, 5, 3, 2))
+    npt.assert_equal(fit.shape, (4, 5, 3))
+
+    expected = np.where(mask, data.mean(-1), 0)
+    npt.assert_array_equal(fit.mean, expected)
+    npt.assert_array_equal(fit.first, np.where(mask, data[..., 0], 0))
+    odf = fit.odf(unit_icosahedron)
+    npt.assert_equal(odf.shape, (4, 5, 3, 12))
+    npt.assert_array_equal(odf[..., 3], expected)
+
+    S0 = np.random.rand(4, 5, 3)
+    npt.assert_array_almost_equal(fit.predict(S0=S0)[..., 0], S0 * expected)
+    npt.assert_array_almost_equal(fit.predict(S0=2.)[..., 0], 2 * expected)
+
+    # Indexing into a fit
+    ijk = tuple(np.argwhere(mask)[0])
+    npt.assert_equal(type(fit[ijk]), _VectorizedMeanFit)
+    npt.assert_equal(fit[ijk].mean, data[ijk].mean())
+    ijk = tuple(np.argwhere(~mask)[0])
+    npt.assert_(fit[ijk] is None)
+    npt.assert_array_equal(fit[:2, 1:3].mean, expected[:2, 1:3])
+
+    # All backends give the same parameters
+    for backend in ['thread', 'process']:
+        pfit = model.fit(data, mask, backend=backend, nbr_workers=2,
+                         chunk_size=5)
+        npt.assert_array_equal(pfit.params, fit.params)
+
+    # Empty mask
+    fit = model.fit(data, np.zeros(mask.shape, dtype=bool))
+    npt.assert_equal(type(fit), MultiVoxelFit)
+
+
+class _BatchMeanModel(_MeanModel):
+
+    def __init__(self):
+        self.chunk_sizes = []
+
+    def batch_fit(self, data):
+        self.chunk_sizes.append(len(data))
+        return [_MeanFit(self, vox_data) for vox_data in data]
+
+
+def test_batch_multi_voxel_fit():
+    data = np.random.rand(4, 5, 3, 10)
+    mask = np.random.rand(4, 5, 3) > 0.3
+    model = _BatchMeanModel()
+
+    fit = model.fit(data, mask, chunk_size=7)
+    npt.assert_equal(type(fit), MultiVoxelFit)
+    npt.assert_array_equal(fit.mean, np.where(mask, data.mean(-1), 0))
+    npt.assert_(all(f is None for f in fit.fit_array[~mask]))
+    npt.assert_equal(sum(model.chunk_sizes), mask.sum())
+    npt.assert_(max(model.chunk_sizes) <= 7)
+
+    # A single voxel is fitted without batch_fit
+    npt.assert_equal(type(model.fit(data[0, 0, 0])), _MeanFit)
+
+    for backend in ['thread', 'process']:
+        pfit = model.fit(data, mask, backend=backend, nbr_workers=2,
+                         chunk_size=5)
+        npt.assert_array_equal(pfit.mean, fit.mean)
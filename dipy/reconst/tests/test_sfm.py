@@ -2,6 +2,7 @@ import numpy as np
 import numpy.testing as npt
 import nibabel as nib
 import dipy.reconst.sfm as sfm
+import dipy.reconst.sfmspeed as sfmspeed
 import dipy.data as dpd
 import dipy.core.gradients as grad
 import dipy.sims.voxel as sims
@@ -109,6 +110,60 @@ def test_sfm_stick():
     npt.assert_(xval.coeff_of_determination(pred, S) > 96)
 
 
+def test_enet_coordinate_descent_gram():
+    np.random.seed(2015)
+    X = np.random.randn(50, 20)
+    Y = np.random.randn(4, 50)
+    gram = np.dot(X.T, X)
+    for positive in [True, False]:
+        beta = np.zeros((4, 20))
+        sfmspeed.enet_coordinate_descent_gram(
+            beta, gram, np.dot(Y, X), np.sum(Y ** 2, -1), 5., 2.,
+            positive=positive, max_iter=10000, tol=1e-12)
+        npt.assert_equal(np.all(beta >= 0), positive)
+        for y, b in zip(Y, beta):
+            # The KKT conditions of the elastic net
+            grad = np.dot(X.T, y - np.dot(X, b)) - 2. * b
+            npt.assert_array_almost_equal(grad[b > 0], 5.)
+            npt.assert_array_almost_equal(grad[b < 0], -5.)
+            npt.assert_(np.all(grad[b == 0] <= 5. + 1e-8))
+            if not positive:
+                npt.assert_(np.all(grad[b == 0] >= -5. - 1e-8))
+    npt.assert_raises(ValueError, sfmspeed.enet_coordinate_descent_gram,
+                      beta, gram, np.dot(Y, X)[:3], np.sum(Y ** 2, -1), 5.,
+                      2.)
+
+
+@npt.dec.skipif(not sfm.has_sklearn)
+def test_sfm_batch_elastic_net():
+    fdata, fbvals, fbvecs = dpd.get_data()
+    data = nib.load(fdata).get_data()[:2, :2, :2]
+    gtab = grad.gradient_table(fbvals, fbvecs)
+    sfmodel = sfm.SparseFascicleModel(gtab)
+    sffit = sfmodel.fit(data)
+
+    # Same fitted signals as sklearn, voxel by voxel
+    S0 = np.mean(data[..., gtab.b0s_mask], -1)
+    S = data[..., ~gtab.b0s_mask] / S0[..., None]
+    iso = sffit.iso.predict().reshape(S.shape)
+    for ijk in np.ndindex(data.shape[:-1]):
+        solver = sfm.lm.ElasticNet(l1_ratio=0.5, alpha=0.001, positive=True)
+        beta = solver.fit(sfmodel.design_matrix, S[ijk] - iso[ijk]).coef_
+        npt.assert_array_almost_equal(
+            np.dot(sfmodel.design_matrix, sffit.beta[ijk]),
+            np.dot(sfmodel.design_matrix, beta), 3)
+
+    for backend in ['thread', 'process']:
+        pfit = sfmodel.fit(data, backend=backend, nbr_workers=2,
+                           chunk_size=3)
+        npt.assert_array_almost_equal(pfit.beta, sffit.beta)
+
+    npt.assert_raises(ValueError, sfmodel.fit, data, backend='gpu')
+    npt.assert_raises(ValueError, sfmodel.fit, data, chunk_size=0)
+    npt.assert_raises(ValueError, sfmodel.fit, data, backend='thread',
+                      nbr_workers=0)
+
+
 def test_sfm_sklearnlinearsolver():
     class SillySolver(opt.SKLearnLinearSolver):
         def fit(self, X, y):
@@ -1,4 +1,5 @@
 """Test spherical harmonic models and the tools associated with those models"""
+import copy
 import warnings
 import numpy as np
 import numpy.linalg as npl
@@ -8,6 +9,8 @@ from numpy.testing import assert_array_equal, assert_array_almost_equal
 import numpy.testing as npt
 from scipy.special import sph_harm as sph_harm_sp
 
+from nibabel.tmpdirs import InTemporaryDirectory
+
 from dipy.core.sphere import hemi_icosahedron
 from dipy.core.gradients import gradient_table
 from dipy.sims.voxel import single_tensor
@@ -27,7 +30,7 @@ from dipy.reconst.shm import (real_sph_harm, real_sym_sh_basis,
                               bootstrap_data_voxel, ResidualBootstrapWrapper,
                               CsaOdfModel, QballModel, SphHarmFit,
                               spherical_harmonics, anisotropic_power,
-                              calculate_max_order)
+                              calculate_max_order, sh_to_sf_matrix)
 
 
 def test_order_from_ncoeff():
@@ -97,6 +100,34 @@ def test_real_sph_harm():
     assert_equal(rsh(aa, bb, cc, dd).shape, (3, 4, 5, 6))
 
 
+def test_real_sph_harm_scipy():
+    # The recurrences match the complex harmonics of scipy at high orders
+    rng = np.random.RandomState(0)
+    theta = np.r_[rng.uniform(0.01, np.pi - 0.01, 200), 0, np.pi / 2, np.pi]
+    phi = np.r_[rng.uniform(0, 2 * np.pi, 200), 0, 1, 2]
+    for sh_order in [2, 8, 16]:
+        m, n = sph_harm_ind_list(sh_order)
+        sh = sph_harm_sp(np.abs(m), n, phi[:, None], theta[:, None])
+        expected = np.where(m > 0, sh.imag, sh.real)
+        expected *= np.where(m == 0, 1., np.sqrt(2))
+        assert_array_almost_equal(
+            real_sph_harm(m, n, theta[:, None], phi[:, None]), expected, 12)
+
+        basis, m2, n2 = real_sym_sh_basis(sh_order, theta, phi)
+        assert_array_almost_equal(basis, expected, 12)
+        assert_array_equal(m2, m)
+        assert_array_equal(n2, n)
+
+    # The bases are memoized, but each call returns its own array
+    basis[:] = 0
+    basis, m, n = real_sym_sh_basis(sh_order, theta, phi)
+    assert_array_almost_equal(basis, expected, 12)
+    mrtrix, m, n = real_sym_sh_mrtrix(sh_order, theta, phi)
+    assert_array_almost_equal(mrtrix * np.where(m == 0, 1, np.sqrt(2)),
+                              real_sph_harm(m, n, theta[:, None],
+                                            phi[:, None]))
+
+
 def test_real_sym_sh_mrtrix():
     coef, expected, sphere = mrtrix_spherical_functions()
     basis, m, n = real_sym_sh_mrtrix(8, sphere.theta, sphere.phi)
@@ -375,6 +406,50 @@ def test_sf_to_sh():
     assert_array_almost_equal(odf2d, odf2d_sf, 2)
 
 
+def test_sf_to_sh_chunks():
+    sphere = hemi_icosahedron.subdivide(2)
+    rng = np.random.RandomState(0)
+    sh = rng.randn(7, 3, 2, 45)
+
+    B, invB = sh_to_sf_matrix(sphere, 8, return_inv=True, smooth=0.01)
+    # the matrices are cached and read-only
+    B2, invB2 = sh_to_sf_matrix(sphere, 8, return_inv=True, smooth=0.01)
+    assert_true(B2 is B and invB2 is invB)
+    assert_raises(ValueError, B.fill, 0)
+    assert_true(sh_to_sf_matrix(sphere, 8, return_inv=False) is B)
+    # equal spheres share the cached matrices
+    same = copy.deepcopy(sphere)
+    B3, invB3 = sh_to_sf_matrix(same, 8, return_inv=True, smooth=0.01)
+    assert_true(B3 is B and invB3 is invB)
+    assert_true(sh_to_sf_matrix(same, 8, return_inv=True,
+                                smooth=0.1)[1] is not invB)
+
+    sf = np.dot(sh, B)
+    for chunk_size in [None, 1, 5, 13, 1000]:
+        assert_array_almost_equal(
+            sh_to_sf(sh, sphere, 8, chunk_size=chunk_size), sf)
+        assert_array_almost_equal(
+            sf_to_sh(sf, sphere, 8, smooth=0.01, chunk_size=chunk_size),
+            np.dot(sf, invB))
+    assert_array_almost_equal(sh_to_sf(sh[0, 0, 0], sphere, 8), sf[0, 0, 0])
+
+    # float32 and memory-mapped outputs
+    sf32 = sh_to_sf(sh.astype(np.float32), sphere, 8, dtype=np.float32)
+    assert_equal(sf32.dtype, np.float32)
+    assert_array_almost_equal(sf32, sf, 4)
+    with InTemporaryDirectory():
+        out = np.memmap('sf.dat', dtype=np.float32, mode='w+',
+                        shape=sf.shape)
+        res = sh_to_sf(sh, sphere, 8, out=out, chunk_size=4)
+        assert_true(res is out)
+        out.flush()
+        assert_array_almost_equal(np.memmap('sf.dat', dtype=np.float32,
+                                            mode='r', shape=sf.shape), sf, 5)
+        del out, res
+    assert_raises(ValueError, sh_to_sf, sh, sphere, 8,
+                  out=np.zeros(sf.shape[1:]))
+
+
 def test_faster_sph_harm():
 
     sh_order = 8
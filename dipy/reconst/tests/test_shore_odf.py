@@ -71,5 +71,33 @@ def test_multivox_shore():
     assert_equal(np.alltrue(np.isreal(c_shore)), True)
 
 
+def test_shore_batch():
+    gtab = get_3shell_gtab()
+    sphere = get_sphere('repulsion100')
+    data, _ = SticksAndBall(gtab, d=0.0015, S0=100,
+                            angles=[(0, 0), (90, 0)],
+                            fractions=[50, 50], snr=None)
+    data = data * np.random.RandomState(0).uniform(
+        0.8, 1.2, (3, 4, 1, len(gtab.bvals)))
+    mask = np.ones(data.shape[:3], dtype=bool)
+    mask[0, 1, 0] = False
+    asm = ShoreModel(gtab, radial_order=6, zeta=700,
+                     lambdaN=1e-8, lambdaL=1e-8)
+    asmfit = asm.fit(data, mask=mask)
+    odf = asmfit.odf(sphere)
+    rtop = asmfit.rtop_signal()
+    msd = asmfit.msd()
+    assert_equal(odf[0, 1, 0], 0)
+    for idx in zip(*np.nonzero(mask)):
+        vfit = asm.fit(data[idx])
+        assert_almost_equal(asmfit.shore_coeff[idx], vfit.shore_coeff)
+        assert_almost_equal(odf[idx], vfit.odf(sphere))
+        assert_almost_equal(asmfit.odf_sh()[idx], vfit.odf_sh())
+        assert_almost_equal(rtop[idx], vfit.rtop_signal())
+        assert_almost_equal(msd[idx], vfit.msd())
+        assert_almost_equal(asmfit.fitted_signal()[idx],
+                            vfit.fitted_signal())
+
+
 if __name__ == '__main__':
     run_module_suite()
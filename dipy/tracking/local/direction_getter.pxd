@@ -2,6 +2,9 @@
 cimport numpy as np
 
 cdef class DirectionGetter:
+    cdef:
+        # The state of the random generator of fast_numpy.random
+        np.npy_uint64 rng_state
 
     cpdef np.ndarray[np.float_t, ndim=2] initial_direction(
         self, double[::1] point)
@@ -11,4 +14,4 @@ cdef class DirectionGetter:
         double[::1] point,
         double[::1] direction) except -1
     cdef int get_direction_c(
-        self, double* point, double* direction)
+        self, double* point, double* direction) nogil
@@ -2,6 +2,16 @@
 cimport numpy as np
 
 cdef class DirectionGetter:
+    def seed_random(self, seed):
+        """Seed the random generator used to sample directions.
+
+        Parameters
+        ----------
+        seed : int
+            The new state of the generator, in [0, 2 ** 64).
+        """
+        self.rng_state = seed
+
     cpdef np.ndarray[np.float_t, ndim=2] initial_direction(
             self, double[::1] point):
         pass
@@ -11,5 +21,5 @@ cdef class DirectionGetter:
                             double[::1] direction) except -1:
         return self.get_direction_c(&point[0], &direction[0])
 
-    cdef int get_direction_c(self, double* point, double* direction):
+    cdef int get_direction_c(self, double* point, double* direction) nogil:
         pass
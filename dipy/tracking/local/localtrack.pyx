@@ -1,6 +1,4 @@
 
-from random import random
-
 cimport cython
 cimport numpy as np
 import numpy as np
@@ -9,7 +7,8 @@ from .tissue_classifier cimport(
     TissueClass, TissueClassifier, ConstrainedTissueClassifier,
     TRACKPOINT, ENDPOINT, OUTSIDEIMAGE, INVALIDPOINT, PYERROR)
 from dipy.tracking.local.interpolation cimport trilinear_interpolate4d_c
-from dipy.utils.fast_numpy cimport cumsum, where_to_insert, copy_point
+from dipy.utils.fast_numpy cimport (cumsum, where_to_insert, copy_point,
+                                    random)
 
 
 cdef extern from "dpy_math.h" nogil:
@@ -142,8 +141,9 @@ def local_tracker(
         vs[i] = voxel_size[i]
         seed[i] = seed_pos[i]
 
-    i = _local_tracker(dg, tc, seed, dir, vs, streamline,
-                       step_size, fixedstep, &tissue_class)
+    with nogil:
+        i = _local_tracker(dg, tc, seed, dir, vs, streamline,
+                           step_size, fixedstep, &tissue_class)
     return i, tissue_class
 
 
@@ -158,9 +158,9 @@ cdef int _local_tracker(DirectionGetter dg,
                         np.float_t[:, :] streamline,
                         double step_size,
                         int fixedstep,
-                        TissueClass* tissue_class):
+                        TissueClass* tissue_class) nogil:
     cdef:
-        size_t i
+        size_t i, j
         double point[3]
         double voxdir[3]
         void (*step)(double*, double*, double) nogil
@@ -286,37 +286,39 @@ def pft_tracker(
         vs[i] = voxel_size[i]
         seed[i] = seed_pos[i]
 
-    i = _pft_tracker(dg, tc, seed, dir, vs, streamline,
-                     directions, step_size, &tissue_class, pft_max_nbr_back_steps,
-                     pft_max_nbr_front_steps, pft_max_trials, particle_count,
-                     particle_paths, particle_dirs, particle_weights,
-                     particle_steps, particle_tissue_classes)
+    with nogil:
+        i = _pft_tracker(dg, tc, seed, dir, vs, streamline, directions,
+                         step_size, &tissue_class, pft_max_nbr_back_steps,
+                         pft_max_nbr_front_steps, pft_max_trials,
+                         particle_count, particle_paths, particle_dirs,
+                         particle_weights, particle_steps,
+                         particle_tissue_classes)
     return i, tissue_class
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.cdivision(True)
-cdef _pft_tracker(DirectionGetter dg,
-                  ConstrainedTissueClassifier tc,
-                  double* seed,
-                  double* dir,
-                  double* voxel_size,
-                  np.float_t[:, :] streamline,
-                  np.float_t[:, :] directions,
-                  double step_size,
-                  TissueClass * tissue_class,
-                  int pft_max_nbr_back_steps,
-                  int pft_max_nbr_front_steps,
-                  int pft_max_trials,
-                  int particle_count,
-                  np.float_t[:, :, :, :] particle_paths,
-                  np.float_t[:, :, :, :] particle_dirs,
-                  np.float_t[:] particle_weights,
-                  np.int_t[:, :] particle_steps,
-                  np.int_t[:, :] particle_tissue_classes):
+cdef int _pft_tracker(DirectionGetter dg,
+                      ConstrainedTissueClassifier tc,
+                      double* seed,
+                      double* dir,
+                      double* voxel_size,
+                      np.float_t[:, :] streamline,
+                      np.float_t[:, :] directions,
+                      double step_size,
+                      TissueClass * tissue_class,
+                      int pft_max_nbr_back_steps,
+                      int pft_max_nbr_front_steps,
+                      int pft_max_trials,
+                      int particle_count,
+                      np.float_t[:, :, :, :] particle_paths,
+                      np.float_t[:, :, :, :] particle_dirs,
+                      np.float_t[:] particle_weights,
+                      np.int_t[:, :] particle_steps,
+                      np.int_t[:, :] particle_tissue_classes) nogil:
     cdef:
-        int i, pft_trial, pft_streamline_i, back_steps, front_steps
+        int i, j, pft_trial, pft_streamline_i, back_steps, front_steps
         int strl_array_len
         double point[3]
         double voxdir[3]
@@ -384,28 +386,28 @@ cdef _pft_tracker(DirectionGetter dg,
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.cdivision(True)
-cdef _pft(np.float_t[:, :] streamline,
-          int streamline_i,
-          np.float_t[:, :] directions,
-          DirectionGetter dg,
-          ConstrainedTissueClassifier tc,
-          double* voxel_size,
-          double step_size,
-          TissueClass * tissue_class,
-          int pft_nbr_steps,
-          int particle_count,
-          np.float_t[:, :, :, :] particle_paths,
-          np.float_t[:, :, :, :] particle_dirs,
-          np.float_t[:] particle_weights,
-          np.int_t[:, :] particle_steps,
-          np.int_t[:, :] particle_tissue_classes):
+cdef int _pft(np.float_t[:, :] streamline,
+              int streamline_i,
+              np.float_t[:, :] directions,
+              DirectionGetter dg,
+              ConstrainedTissueClassifier tc,
+              double* voxel_size,
+              double step_size,
+              TissueClass * tissue_class,
+              int pft_nbr_steps,
+              int particle_count,
+              np.float_t[:, :, :, :] particle_paths,
+              np.float_t[:, :, :, :] particle_dirs,
+              np.float_t[:] particle_weights,
+              np.int_t[:, :] particle_steps,
+              np.int_t[:, :] particle_tissue_classes) nogil:
     cdef:
         double sum_weights, sum_squared, N_effective, rdm_sample
         double point[3]
         double dir[3]
         double voxdir[3]
         double eps = 1e-16
-        int s, p, j
+        int s, p, j, pp, ss, p_source
 
     if pft_nbr_steps <= 0:
         return streamline_i
@@ -476,7 +478,8 @@ cdef _pft(np.float_t[:, :] streamline,
                        &particle_weights[0],
                        particle_count)
                 for pp in range(particle_count):
-                    rdm_sample = random() * particle_weights[particle_count - 1]
+                    rdm_sample = (random(&dg.rng_state) *
+                                  particle_weights[particle_count - 1])
                     p_source = where_to_insert(&particle_weights[0],
                                                rdm_sample,
                                                particle_count)
@@ -496,7 +499,8 @@ cdef _pft(np.float_t[:, :] streamline,
            &particle_weights[0],
            particle_count)
     if particle_weights[particle_count - 1] > 0:
-        rdm_sample = random() * particle_weights[particle_count - 1]
+        rdm_sample = (random(&dg.rng_state) *
+                      particle_weights[particle_count - 1])
         p = where_to_insert(&particle_weights[0], rdm_sample, particle_count)
     else:
         p = 0
@@ -1,4 +1,6 @@
+import multiprocessing as mp
 import random
+from itertools import islice
 
 import numpy as np
 
@@ -7,6 +9,7 @@ from dipy.tracking.local.tissue_classifier import ConstrainedTissueClassifier
 
 from dipy.align import Bunch
 from dipy.tracking import utils
+from dipy.tracking.streamline import Streamlines
 
 
 # enum TissueClass (tissue_classifier.pxd) is not accessible
@@ -15,6 +18,32 @@ from dipy.tracking import utils
 # https://github.com/cython/cython/commit/50133b5a91eea348eddaaad22a606a7fa1c7c457
 TissueTypes = Bunch(OUTSIDEIMAGE=-1, INVALIDPOINT=0, TRACKPOINT=1, ENDPOINT=2)
 
+_TRACKING_BACKENDS = ('serial', 'process')
+
+# The tracker used by the worker processes of the 'process' backend. Direction
+# getters and tissue classifiers cannot be pickled, so the workers inherit it
+# when they are forked.
+_tracking_worker = None
+
+_MASK64 = 2 ** 64 - 1
+
+
+def _seed_rng_state(random_seed, index):
+    """The seed of the random generators when tracking from the seed `index`.
+
+    It is a counter-based hash (splitmix64) of `random_seed` and `index`, so
+    that each seed gets its own random stream, whatever the order in which
+    the seeds are tracked.
+    """
+    z = (random_seed * 0x9E3779B97F4A7C15 + index + 1) & _MASK64
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & _MASK64
+    return (z ^ (z >> 31)) & 0xFFFFFFFF
+
+
+def _track_seed_batch(task):
+    return task[0], _tracking_worker._track_batch(*task)
+
 
 class LocalTracking(object):
 
@@ -38,7 +67,8 @@ class LocalTracking(object):
 
     def __init__(self, direction_getter, tissue_classifier, seeds, affine,
                  step_size, max_cross=None, maxlen=500, fixedstep=True,
-                 return_all=True, random_seed=None):
+                 return_all=True, random_seed=None, backend='serial',
+                 nbr_workers=None, batch_size=1000, ordered=True):
         """Creates streamlines by using local fiber-tracking.
 
         Parameters
@@ -72,8 +102,27 @@ class LocalTracking(object):
             If true, return all generated streamlines, otherwise only
             streamlines reaching end points or exiting the image.
         random_seed : int
-            The seed for the random seed generator (numpy.random.seed and
-            random.seed).
+            The seed for the random seed generator (numpy.random.seed,
+            random.seed and the generators of the direction getter and of the
+            tissue classifier). The generators are seeded again before tracking
+            from each seed, with a hash of `random_seed` and of the index of
+            the seed, so that the streamlines do not depend on the backend or
+            on the number of workers.
+        backend : {'serial', 'process'}
+            Whether the seeds are tracked one after the other, or by a pool of
+            worker processes, in batches of `batch_size` seeds. The
+            'process' backend forks the workers, so it is only available on
+            platforms supporting the 'fork' start method. When `random_seed`
+            is None, the workers use a random seed drawn from numpy's random
+            generator. Default: 'serial'.
+        nbr_workers : int
+            Number of worker processes. Default: multiprocessing.cpu_count().
+        batch_size : int
+            Number of seeds sent to a worker at once. Default: 1000.
+        ordered : bool
+            If true, the streamlines are returned in the order of the seeds,
+            otherwise in the order in which the batches are completed by the
+            workers. Only used by the 'process' backend. Default: True.
         """
 
         self.direction_getter = direction_getter
@@ -94,6 +143,20 @@ class LocalTracking(object):
         self.max_length = maxlen
         self.return_all = return_all
         self.random_seed = random_seed
+        inv_A = np.linalg.inv(affine)
+        self._inv_lin = inv_A[:3, :3]
+        self._inv_offset = inv_A[:3, 3]
+        F = np.empty((maxlen + 1, 3), dtype=float)
+        self._buffers = (F, F.copy())
+        if backend not in _TRACKING_BACKENDS:
+            raise ValueError("backend must be one of %s, got %r" %
+                             (_TRACKING_BACKENDS, backend))
+        if batch_size < 1:
+            raise ValueError("batch_size must be greater than 0.")
+        self.backend = backend
+        self.nbr_workers = nbr_workers
+        self.batch_size = batch_size
+        self.ordered = ordered
 
     def _tracker(self, seed, first_step, streamline):
         return local_tracker(self.direction_getter,
@@ -110,47 +173,231 @@ class LocalTracking(object):
         track = self._generate_streamlines()
         return utils.move_streamlines(track, self.affine)
 
+    def to_streamlines(self):
+        """Track from all the seeds into a Streamlines object.
+
+        Unlike iterating over the tracker, which yields one new array per
+        streamline, the points are written into a single buffer growing
+        geometrically, which is moved to point space at once.
+
+        Returns
+        -------
+        streamlines : Streamlines
+            The streamlines, in point space (see ``affine``).
+        """
+        buffer = _StreamlineBuffer()
+        if self.backend == 'process':
+            for points, lengths in self._track_batches_parallel():
+                buffer.extend(points, lengths)
+        else:
+            for parts in self._track_seeds():
+                buffer.append(parts)
+        return buffer.to_streamlines(self.affine)
+
     def _generate_streamlines(self):
         """A streamline generator"""
+        if self.backend == 'process':
+            for points, lengths in self._track_batches_parallel():
+                start = 0
+                for length in lengths:
+                    yield points[start:start + length]
+                    start += length
+            return
+
+        for parts in self._track_seeds():
+            if len(parts) == 1:
+                yield parts[0].copy()
+            else:
+                yield np.concatenate(parts, axis=0)
+
+    def _seed_random(self, seed):
+        """Seed the random generators of the direction getter and of the
+        tissue classifier, with different states so that their streams
+        differ."""
+        self.direction_getter.seed_random(seed)
+        self.tissue_classifier.seed_random(~seed & _MASK64)
+
+    def _track_seeds(self):
+        """Track from the seeds one after the other (see ``_track_seed``)"""
+        if self.random_seed is None:
+            # The generators of the direction getter and tissue classifier
+            # are seeded from the state of the random module
+            self._seed_random(random.getrandbits(64))
+        for i, s in enumerate(self.seeds):
+            for parts in self._track_seed(i, s, self.random_seed):
+                yield parts
+
+    def _track_batches_parallel(self):
+        """Track batches of seeds in worker processes, and yield the points
+        and lengths of the streamlines of each batch"""
+        global _tracking_worker
+        try:
+            context = mp.get_context('fork')
+        except AttributeError:
+            # Python 2 always forks on POSIX platforms
+            context = mp
+        except ValueError:
+            raise ValueError("The process backend of LocalTracking requires "
+                             "the 'fork' start method, which is not "
+                             "available on this platform.")
+        random_seed = self.random_seed
+        if random_seed is None:
+            random_seed = np.random.randint(2 ** 31)
+        nbr_workers = self.nbr_workers
+        if nbr_workers is None:
+            nbr_workers = mp.cpu_count()
+
+        def tasks():
+            seeds = iter(self.seeds)
+            start = 0
+            while True:
+                batch = list(islice(seeds, self.batch_size))
+                if not batch:
+                    return
+                yield start, np.array(batch, dtype=float), random_seed
+                start += len(batch)
 
-        # Get inverse transform (lin/offset) for seeds
-        inv_A = np.linalg.inv(self.affine)
-        lin = inv_A[:3, :3]
-        offset = inv_A[:3, 3]
-
-        F = np.empty((self.max_length + 1, 3), dtype=float)
-        B = F.copy()
-        for s in self.seeds:
-            s = np.dot(lin, s) + offset
-            # Set the random seed in numpy and random
-            if self.random_seed is not None:
-                s_random_seed = hash(np.abs((np.sum(s)) + self.random_seed)) \
-                    % (2**32 - 1)
-                random.seed(s_random_seed)
-                np.random.seed(s_random_seed)
-            directions = self.direction_getter.initial_direction(s)
-            if directions.size == 0 and self.return_all:
-                # only the seed position
-                yield [s]
-            directions = directions[:self.max_cross]
-            for first_step in directions:
-                stepsF, tissue_class = self._tracker(s, first_step, F)
-                if not (self.return_all or
-                        tissue_class == TissueTypes.ENDPOINT or
-                        tissue_class == TissueTypes.OUTSIDEIMAGE):
-                    continue
-                first_step = -first_step
-                stepsB, tissue_class = self._tracker(s, first_step, B)
-                if not (self.return_all or
-                        tissue_class == TissueTypes.ENDPOINT or
-                        tissue_class == TissueTypes.OUTSIDEIMAGE):
-                    continue
-                if stepsB == 1:
-                    streamline = F[:stepsF].copy()
-                else:
-                    parts = (B[stepsB - 1:0:-1], F[:stepsF])
-                    streamline = np.concatenate(parts, axis=0)
-                yield streamline
+        _tracking_worker = self
+        pool = context.Pool(nbr_workers)
+        try:
+            if self.ordered:
+                results = pool.imap(_track_seed_batch, tasks())
+            else:
+                results = pool.imap_unordered(_track_seed_batch, tasks())
+            for _, (points, lengths) in results:
+                yield points, lengths
+            pool.close()
+        finally:
+            _tracking_worker = None
+            pool.terminate()
+            pool.join()
+
+    def _track_batch(self, start, seeds, random_seed):
+        """The points and lengths of the streamlines of a batch of seeds, the
+        first one being the seed `start`."""
+        buffer = _StreamlineBuffer()
+        for i, s in enumerate(seeds):
+            for parts in self._track_seed(start + i, s, random_seed):
+                buffer.append(parts)
+        return buffer.points, buffer.lengths
+
+    def _track_seed(self, index, s, random_seed):
+        """Track from the seed `s`, the seed number `index`.
+
+        Yields the parts of each streamline (in voxel coordinates) as a tuple
+        of one or two arrays to be concatenated. They are views of the
+        tracking buffers, only valid until the next streamline is tracked.
+        """
+        F, B = self._buffers
+        # Inverse transform (lin/offset) for seeds
+        s = np.dot(self._inv_lin, s) + self._inv_offset
+        # Set the random seed in numpy, random, the direction getter and the
+        # tissue classifier
+        if random_seed is not None:
+            s_random_seed = _seed_rng_state(random_seed, index)
+            random.seed(s_random_seed)
+            np.random.seed(s_random_seed)
+            self._seed_random(s_random_seed)
+        directions = self.direction_getter.initial_direction(s)
+        if directions.size == 0 and self.return_all:
+            # only the seed position
+            yield (s[None], )
+        directions = directions[:self.max_cross]
+        for first_step in directions:
+            stepsF, tissue_class = self._tracker(s, first_step, F)
+            if not (self.return_all or
+                    tissue_class == TissueTypes.ENDPOINT or
+                    tissue_class == TissueTypes.OUTSIDEIMAGE):
+                continue
+            first_step = -first_step
+            stepsB, tissue_class = self._tracker(s, first_step, B)
+            if not (self.return_all or
+                    tissue_class == TissueTypes.ENDPOINT or
+                    tissue_class == TissueTypes.OUTSIDEIMAGE):
+                continue
+            if stepsB == 1:
+                yield (F[:stepsF], )
+            else:
+                yield (B[stepsB - 1:0:-1], F[:stepsF])
+
+
+class _StreamlineBuffer(object):
+    """The points of streamlines stored one after the other in an array
+    growing geometrically, with the number of points of each streamline."""
+
+    def __init__(self, capacity=4096):
+        self._points = np.empty((capacity, 3))
+        self._lengths = np.empty(max(capacity // 32, 1), dtype=np.intp)
+        self.n_points = 0
+        self.n_streamlines = 0
+
+    @property
+    def points(self):
+        return self._points[:self.n_points]
+
+    @property
+    def lengths(self):
+        return self._lengths[:self.n_streamlines]
+
+    def _reserve(self, n_points, n_streamlines):
+        """Grow the arrays to hold `n_points` and `n_streamlines` more.
+
+        New arrays are allocated, so that the views given by ``points`` and
+        ``lengths`` stay valid.
+        """
+        needed = self.n_points + n_points
+        if needed > len(self._points):
+            points = np.empty((max(needed, 2 * len(self._points)), 3))
+            points[:self.n_points] = self.points
+            self._points = points
+        needed = self.n_streamlines + n_streamlines
+        if needed > len(self._lengths):
+            lengths = np.empty(max(needed, 2 * len(self._lengths)),
+                               dtype=np.intp)
+            lengths[:self.n_streamlines] = self.lengths
+            self._lengths = lengths
+
+    def append(self, parts):
+        """Append the streamline made of the concatenated `parts`"""
+        length = sum(len(part) for part in parts)
+        self._reserve(length, 1)
+        start = self.n_points
+        for part in parts:
+            self._points[start:start + len(part)] = part
+            start += len(part)
+        self._lengths[self.n_streamlines] = length
+        self.n_points = start
+        self.n_streamlines += 1
+
+    def extend(self, points, lengths):
+        """Append streamlines given by their concatenated points and their
+        lengths"""
+        self._reserve(len(points), len(lengths))
+        self._points[self.n_points:self.n_points + len(points)] = points
+        self._lengths[self.n_streamlines:
+                      self.n_streamlines + len(lengths)] = lengths
+        self.n_points += len(points)
+        self.n_streamlines += len(lengths)
+
+    def to_streamlines(self, affine=None, chunk_size=2 ** 16):
+        """The streamlines of the buffer, without copy, moved by `affine`.
+
+        The streamlines are views of the arrays of the buffer, which must
+        not be used afterwards.
+        """
+        points = self.points
+        lengths = self.lengths
+        if affine is not None:
+            lin_T = affine[:3, :3].T.copy()
+            offset = affine[:3, 3].copy()
+            for start in range(0, len(points), chunk_size):
+                chunk = points[start:start + chunk_size]
+                chunk[:] = np.dot(chunk, lin_T) + offset
+        streamlines = Streamlines()
+        streamlines._data = points
+        streamlines._lengths = lengths
+        streamlines._offsets = np.cumsum(lengths) - lengths
+        return streamlines
 
 
 class ParticleFilteringTracking(LocalTracking):
@@ -159,7 +406,8 @@ class ParticleFilteringTracking(LocalTracking):
                  step_size, max_cross=None, maxlen=500,
                  pft_back_tracking_dist=2, pft_front_tracking_dist=1,
                  pft_max_trial=20, particle_count=15, return_all=True,
-                 random_seed=None):
+                 random_seed=None, backend='serial', nbr_workers=None,
+                 batch_size=1000, ordered=True):
         r"""A streamline generator using the particle filtering tractography
         method [1]_.
 
@@ -207,7 +455,18 @@ class ParticleFilteringTracking(LocalTracking):
             streamlines reaching end points or exiting the image.
         random_seed : int
             The seed for the random seed generator (numpy.random.seed and
-            random.seed).
+            random.seed), seeded again for each seed (see LocalTracking).
+        backend : {'serial', 'process'}
+            Whether the seeds are tracked one after the other, or by a pool of
+            worker processes (see LocalTracking). Default: 'serial'.
+        nbr_workers : int
+            Number of worker processes. Default: multiprocessing.cpu_count().
+        batch_size : int
+            Number of seeds sent to a worker at once. Default: 1000.
+        ordered : bool
+            If true, the streamlines are returned in the order of the seeds,
+            otherwise in the order in which the batches are completed.
+            Default: True.
 
         References
         ----------
@@ -256,7 +515,11 @@ class ParticleFilteringTracking(LocalTracking):
                                                         maxlen,
                                                         True,
                                                         return_all,
-                                                        random_seed)
+                                                        random_seed,
+                                                        backend,
+                                                        nbr_workers,
+                                                        batch_size,
+                                                        ordered)
 
     def _tracker(self, seed, first_step, streamline):
         return pft_tracker(self.direction_getter,
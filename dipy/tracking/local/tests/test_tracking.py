@@ -15,7 +15,7 @@ from dipy.reconst.csdeconv import ConstrainedSphericalDeconvModel
 from dipy.tracking.local import (ActTissueClassifier, BinaryTissueClassifier,
                                  LocalTracking, ParticleFilteringTracking,
                                  ThresholdTissueClassifier)
-from dipy.tracking.local.localtracking import TissueTypes
+from dipy.tracking.local.localtracking import TissueTypes, _StreamlineBuffer
 from dipy.tracking.utils import seeds_from_mask
 from dipy.tracking.streamline import Streamlines
 from dipy.sims.voxel import single_tensor, multi_tensor
@@ -148,14 +148,10 @@ def test_stop_conditions():
     npt.assert_equal(len(sl), 1)
 
 
-def test_probabilistic_odf_weighted_tracker():
-    """This tests that the Probabalistic Direction Getter plays nice
-    LocalTracking and produces reasonable streamlines in a simple example.
-    """
+def _simple_pmf_image():
+    """The sphere, pmf and tracking mask of a simple image with three possible
+    configurations, a vertical tract, a horizontal tract and a crossing."""
     sphere = HemiSphere.from_sphere(unit_octahedron)
-
-    # A simple image with three possible configurations, a vertical tract,
-    # a horizontal tract and a crossing
     pmf_lookup = np.array([[0., 0., 1.],
                            [1., 0., 0.],
                            [0., 1., 0.],
@@ -166,13 +162,18 @@ def test_probabilistic_odf_weighted_tracker():
                              [0, 1, 0, 0, 0, 0],
                              [0, 1, 0, 0, 0, 0],
                              ])
-
     simple_image = simple_image[..., None]
     pmf = pmf_lookup[simple_image]
+    mask = (simple_image > 0).astype(float)
+    return sphere, pmf, mask
 
-    seeds = [np.array([1., 1., 0.])] * 30
 
-    mask = (simple_image > 0).astype(float)
+def test_probabilistic_odf_weighted_tracker():
+    """This tests that the Probabalistic Direction Getter plays nice
+    LocalTracking and produces reasonable streamlines in a simple example.
+    """
+    sphere, pmf, mask = _simple_pmf_image()
+    seeds = [np.array([1., 1., 0.])] * 30
     tc = ThresholdTissueClassifier(mask, .5)
 
     dg = ProbabilisticDirectionGetter.from_pmf(pmf, 90, sphere,
@@ -253,6 +254,72 @@ def test_probabilistic_odf_weighted_tracker():
     npt.assert_equal(tracking_1, tracking_2)
 
 
+def test_parallel_tracking():
+    """This tests that tracking the seeds in worker processes gives the
+    same streamlines as tracking them one after the other.
+    """
+    sphere, pmf, mask = _simple_pmf_image()
+    tc = ThresholdTissueClassifier(mask, .5)
+    dg = ProbabilisticDirectionGetter.from_pmf(pmf, 90, sphere,
+                                               pmf_threshold=0.1)
+    seeds = [np.array([1., 1., 0.])] * 20 + [np.array([2., 3., 0.])] * 10
+
+    serial = list(LocalTracking(dg, tc, seeds, np.eye(4), 1.,
+                                random_seed=3))
+    # Seeds at the same position get different random streams
+    npt.assert_(len(set(len(sl) for sl in serial[:20])) > 1)
+    for nbr_workers in [1, 2]:
+        parallel = list(LocalTracking(dg, tc, iter(seeds), np.eye(4), 1.,
+                                      random_seed=3, backend='process',
+                                      nbr_workers=nbr_workers,
+                                      batch_size=7))
+        npt.assert_equal(len(parallel), len(serial))
+        for sl, expected in zip(parallel, serial):
+            npt.assert_array_equal(sl, expected)
+    unordered = list(LocalTracking(dg, tc, seeds, np.eye(4), 1.,
+                                   random_seed=3, backend='process',
+                                   nbr_workers=2, batch_size=7,
+                                   ordered=False))
+    npt.assert_equal(sorted(sl.tobytes() for sl in unordered),
+                     sorted(sl.tobytes() for sl in serial))
+
+    npt.assert_raises(ValueError, LocalTracking, dg, tc, seeds, np.eye(4),
+                      1., backend='gpu')
+    npt.assert_raises(ValueError, LocalTracking, dg, tc, seeds, np.eye(4),
+                      1., batch_size=0)
+
+
+def test_tracking_to_streamlines():
+    """This tests that LocalTracking.to_streamlines gives the streamlines of
+    the iteration over the tracker, in a single Streamlines object.
+    """
+    sphere, pmf, mask = _simple_pmf_image()
+    tc = ThresholdTissueClassifier(mask, .5)
+    dg = ProbabilisticDirectionGetter.from_pmf(pmf, 90, sphere,
+                                               pmf_threshold=0.1)
+    seeds = [np.array([1., 1., 0.])] * 300 + [np.array([2., 3., 0.])] * 100
+    affine = np.diag([2., 3., 1., 1.])
+    affine[:3, 3] = [1., -2., 5.]
+    seeds = [np.dot(affine[:3, :3], s) + affine[:3, 3] for s in seeds]
+
+    for kwargs in [{}, {'backend': 'process', 'nbr_workers': 2,
+                        'batch_size': 64}]:
+        expected = list(LocalTracking(dg, tc, seeds, affine, 1.,
+                                      random_seed=3, **kwargs))
+        streamlines = LocalTracking(dg, tc, seeds, affine, 1., random_seed=3,
+                                    **kwargs).to_streamlines()
+        npt.assert_(isinstance(streamlines, Streamlines))
+        npt.assert_equal(len(streamlines), len(expected))
+        for sl, expected_sl in zip(streamlines, expected):
+            npt.assert_array_almost_equal(sl, expected_sl)
+
+    # A seed outside of the mask gives a single point with return_all
+    streamlines = LocalTracking(dg, tc, [np.array([0., 0., 0.])], np.eye(4),
+                                1., return_all=True).to_streamlines()
+    npt.assert_equal(len(streamlines), 1)
+    npt.assert_array_equal(streamlines[0], [[0., 0., 0.]])
+
+
 def test_particle_filtering_tractography():
     """This tests that the ParticleFilteringTracking produces
     more streamlines connecting the gray matter than LocalTracking.
@@ -395,6 +462,28 @@ def test_particle_filtering_tractography():
     npt.assert_equal(tracking_1, tracking_2)
 
 
+def test_streamline_buffer():
+    """This tests that growing the streamline buffer keeps the points and
+    lengths given before valid.
+    """
+    buffer = _StreamlineBuffer(capacity=4)
+    buffer.append((np.ones((3, 3)),))
+    points, lengths = buffer.points, buffer.lengths
+    for i in range(10):
+        buffer.append((np.full((2, 3), i), np.full((1, 3), i)))
+    buffer.extend(np.zeros((5, 3)), [2, 3])
+    npt.assert_array_equal(points, np.ones((3, 3)))
+    npt.assert_array_equal(lengths, [3])
+    npt.assert_equal(buffer.n_points, 38)
+    npt.assert_array_equal(buffer.lengths, [3] + [3] * 10 + [2, 3])
+
+    streamlines = buffer.to_streamlines(np.diag([2., 2., 2., 1.]))
+    npt.assert_equal(len(streamlines), 13)
+    npt.assert_array_equal(streamlines[0], 2 * np.ones((3, 3)))
+    npt.assert_array_equal(streamlines[5], np.full((3, 3), 8.))
+    npt.assert_array_equal(streamlines[12], np.zeros((3, 3)))
+
+
 def test_maximum_deterministic_tracker():
     """This tests that the Maximum Deterministic Direction Getter plays nice
     LocalTracking and produces reasonable streamlines in a simple example.
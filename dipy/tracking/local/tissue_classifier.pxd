@@ -1,3 +1,5 @@
+cimport numpy as np
+
 
 cdef enum TissueClass:
     PYERROR = -2
@@ -9,10 +11,12 @@ cdef enum TissueClass:
 
 cdef class TissueClassifier:
     cdef:
+        # The state of the random generator of fast_numpy.random
+        np.npy_uint64 rng_state
         double interp_out_double[1]
         double[::1] interp_out_view
     cpdef TissueClass check_point(self, double[::1] point)
-    cdef TissueClass check_point_c(self, double* point)
+    cdef TissueClass check_point_c(self, double* point) nogil
 
 
 cdef class BinaryTissueClassifier(TissueClassifier):
@@ -32,9 +36,9 @@ cdef class ConstrainedTissueClassifier(TissueClassifier):
     cdef:
         double[:, :, :] include_map, exclude_map
     cpdef double get_exclude(self, double[::1] point)
-    cdef double get_exclude_c(self, double* point)
+    cdef double get_exclude_c(self, double* point) nogil
     cpdef double get_include(self, double[::1] point)
-    cdef double get_include_c(self, double* point)
+    cdef double get_include_c(self, double* point) nogil
     pass
 
 
@@ -10,18 +10,29 @@ cdef extern from "dpy_math.h" nogil:
     int dpy_rint(double)
 
 from .interpolation cimport trilinear_interpolate4d_c
+from dipy.utils.fast_numpy cimport random
 
 import numpy as np
 
 cdef class TissueClassifier:
+    def seed_random(self, seed):
+        """Seed the random generator used by the classifier.
+
+        Parameters
+        ----------
+        seed : int
+            The new state of the generator, in [0, 2 ** 64).
+        """
+        self.rng_state = seed
+
     cpdef TissueClass check_point(self, double[::1] point):
         if point.shape[0] != 3:
             raise ValueError("Point has wrong shape")
 
         return self.check_point_c(&point[0])
 
-    cdef TissueClass check_point_c(self, double* point):
-         pass
+    cdef TissueClass check_point_c(self, double* point) nogil:
+        pass
 
 
 cdef class BinaryTissueClassifier(TissueClassifier):
@@ -34,15 +45,15 @@ cdef class BinaryTissueClassifier(TissueClassifier):
         self.interp_out_view = self.interp_out_double
         self.mask = (mask > 0).astype('uint8')
 
-    cdef TissueClass check_point_c(self, double* point):
+    cdef TissueClass check_point_c(self, double* point) nogil:
         cdef:
             unsigned char result
             int err
             int voxel[3]
 
-        voxel[0] = int(dpy_rint(point[0]))
-        voxel[1] = int(dpy_rint(point[1]))
-        voxel[2] = int(dpy_rint(point[2]))
+        voxel[0] = <int> dpy_rint(point[0])
+        voxel[1] = <int> dpy_rint(point[1])
+        voxel[2] = <int> dpy_rint(point[2])
 
         if (voxel[0] < 0 or voxel[0] >= self.mask.shape[0]
                 or voxel[1] < 0 or voxel[1] >= self.mask.shape[1]
@@ -71,7 +82,7 @@ cdef class ThresholdTissueClassifier(TissueClassifier):
         self.metric_map = np.asarray(metric_map, 'float64')
         self.threshold = threshold
 
-    cdef TissueClass check_point_c(self, double* point):
+    cdef TissueClass check_point_c(self, double* point) nogil:
         cdef:
             double result
             int err
@@ -84,8 +95,9 @@ cdef class ThresholdTissueClassifier(TissueClassifier):
             return OUTSIDEIMAGE
         elif err != 0:
             # This should never happen
-            raise RuntimeError(
-                "Unexpected interpolation error (code:%i)" % err)
+            with gil:
+                raise RuntimeError(
+                    "Unexpected interpolation error (code:%i)" % err)
 
         result = self.interp_out_view[0]
 
@@ -145,7 +157,8 @@ cdef class ConstrainedTissueClassifier(TissueClassifier):
 
         return self.get_exclude_c(&point[0])
 
-    cdef double get_exclude_c(self, double* point):
+    cdef double get_exclude_c(self, double* point) nogil:
+        cdef int exclude_err
         exclude_err = trilinear_interpolate4d_c(self.exclude_map[..., None],
                                                 point, self.interp_out_view)
         if exclude_err != 0:
@@ -158,7 +171,8 @@ cdef class ConstrainedTissueClassifier(TissueClassifier):
 
         return self.get_include_c(&point[0])
 
-    cdef double get_include_c(self, double* point):
+    cdef double get_include_c(self, double* point) nogil:
+        cdef int exclude_err
         exclude_err = trilinear_interpolate4d_c(self.include_map[..., None],
                                                 point, self.interp_out_view)
         if exclude_err != 0:
@@ -191,7 +205,7 @@ cdef class ActTissueClassifier(ConstrainedTissueClassifier):
         self.include_map = np.asarray(include_map, 'float64')
         self.exclude_map = np.asarray(exclude_map, 'float64')
 
-    cdef TissueClass check_point_c(self, double* point):
+    cdef TissueClass check_point_c(self, double* point) nogil:
         cdef:
             double include_result, exclude_result
             int include_err, exclude_err
@@ -212,12 +226,14 @@ cdef class ActTissueClassifier(ConstrainedTissueClassifier):
             return OUTSIDEIMAGE
         elif include_err != 0:
             # This should never happen
-            raise RuntimeError("Unexpected interpolation error " +
-                               "(include_map - code:%i)" % include_err)
+            with gil:
+                raise RuntimeError("Unexpected interpolation error " +
+                                   "(include_map - code:%i)" % include_err)
         elif exclude_err != 0:
             # This should never happen
-            raise RuntimeError("Unexpected interpolation error " +
-                               "(exclude_map - code:%i)" % exclude_err)
+            with gil:
+                raise RuntimeError("Unexpected interpolation error " +
+                                   "(exclude_map - code:%i)" % exclude_err)
 
         if include_result > 0.5:
             return ENDPOINT
@@ -253,9 +269,9 @@ cdef class CmcTissueClassifier(ConstrainedTissueClassifier):
         self.average_voxel_size = average_voxel_size
         self.correction_factor = step_size / average_voxel_size
 
-    cdef TissueClass check_point_c(self, double* point):
+    cdef TissueClass check_point_c(self, double* point) nogil:
         cdef:
-            double include_result, exclude_result
+            double include_result, exclude_result, num, den, p
             int include_err, exclude_err
 
         include_err = trilinear_interpolate4d_c(self.include_map[..., None],
@@ -269,15 +285,18 @@ cdef class CmcTissueClassifier(ConstrainedTissueClassifier):
         if include_err == -1 or exclude_err == -1:
             return OUTSIDEIMAGE
         elif include_err == -2 or exclude_err == -2:
-            raise ValueError("Point has wrong shape")
+            with gil:
+                raise ValueError("Point has wrong shape")
         elif include_err != 0:
             # This should never happen
-            raise RuntimeError("Unexpected interpolation error " +
-                               "(include_map - code:%i)" % include_err)
+            with gil:
+                raise RuntimeError("Unexpected interpolation error " +
+                                   "(include_map - code:%i)" % include_err)
         elif exclude_err != 0:
             # This should never happen
-            raise RuntimeError("Unexpected interpolation error " +
-                               "(exclude_map - code:%i)" % exclude_err)
+            with gil:
+                raise RuntimeError("Unexpected interpolation error " +
+                                   "(exclude_map - code:%i)" % exclude_err)
 
         # test if the tracking continues
         if include_result + exclude_result <= 0:
@@ -285,12 +304,12 @@ cdef class CmcTissueClassifier(ConstrainedTissueClassifier):
         num = max(0, (1 - include_result - exclude_result))
         den = num + include_result + exclude_result
         p = (num / den) ** self.correction_factor
-        if np.random.random() < p:
+        if random(&self.rng_state) < p:
             return TRACKPOINT
 
         # test if the tracking stopped in the include tissue map
         p = (include_result / (include_result + exclude_result))
-        if np.random.random() < p:
+        if random(&self.rng_state) < p:
             return ENDPOINT
 
         # the tracking stopped in the exclude tissue map
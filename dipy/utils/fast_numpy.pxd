@@ -22,3 +22,7 @@ cdef void copy_point(
 cdef void scalar_muliplication_point(
         double * a,
         double scalar) nogil
+
+# A uniform random number in [0, 1) from a splitmix64 generator whose state
+# is kept by the caller
+cdef double random(np.npy_uint64* state) nogil
@@ -45,3 +45,26 @@ cdef void scalar_muliplication_point(
         int i = 0
     for i in range(3):
         a[i] *= scalar
+
+
+cdef double random(np.npy_uint64* state) nogil:
+    """Sample a random number uniformly in [0, 1).
+
+    The generator is splitmix64, a counter-based generator whose state is a
+    single 64 bit integer. Each direction getter and tissue classifier keeps
+    its own state, so that it can be sampled without the GIL and from
+    several threads.
+
+    Parameters
+    ----------
+    state : pointer to uint64
+        The state of the generator, advanced by one step.
+    """
+    cdef np.npy_uint64 z
+    state[0] += <np.npy_uint64> 0x9E3779B97F4A7C15ULL
+    z = state[0]
+    z = (z ^ (z >> 30)) * <np.npy_uint64> 0xBF58476D1CE4E5B9ULL
+    z = (z ^ (z >> 27)) * <np.npy_uint64> 0x94D049BB133111EBULL
+    z = z ^ (z >> 31)
+    # The 53 high bits give a double with full precision
+    return (z >> 11) * (1.0 / 9007199254740992.0)
@@ -324,67 +324,63 @@ class ReconstDtiFlow(Workflow):
                 save_metrics = ['fa', 'md', 'rd', 'ad', 'ga', 'rgb', 'mode',
                                 'evec', 'eval', 'tensor']
 
-            FA = fractional_anisotropy(tenfit.evals)
-            FA[np.isnan(FA)] = 0
-            FA = np.clip(FA, 0, 1)
+            # All the maps are computed in one pass over the tensors
+            metric_names = {'fa': 'fa', 'ga': 'ga', 'rgb': 'color_fa',
+                            'md': 'md', 'ad': 'ad', 'rd': 'rd',
+                            'mode': 'mode', 'evec': 'evecs',
+                            'eval': 'evals', 'tensor': 'lower_triangular'}
+            maps = tenfit.metrics([metric_names[name] for name in
+                                   save_metrics if name in metric_names],
+                                  dtype=np.float32)
 
             if 'tensor' in save_metrics:
-                tensor_vals = lower_triangular(tenfit.quadratic_form)
+                tensor_vals = maps['lower_triangular']
                 correct_order = [0, 1, 3, 2, 4, 5]
                 tensor_vals_reordered = tensor_vals[..., correct_order]
-                fiber_tensors = nib.Nifti1Image(tensor_vals_reordered.astype(
-                    np.float32), affine)
+                fiber_tensors = nib.Nifti1Image(tensor_vals_reordered,
+                                                affine)
                 nib.save(fiber_tensors, otensor)
 
             if 'fa' in save_metrics:
-                fa_img = nib.Nifti1Image(FA.astype(np.float32),
-                                         affine)
+                FA = maps['fa']
+                FA[np.isnan(FA)] = 0
+                FA = np.clip(FA, 0, 1, out=FA)
+                fa_img = nib.Nifti1Image(FA, affine)
                 nib.save(fa_img, ofa)
 
             if 'ga' in save_metrics:
-                GA = geodesic_anisotropy(tenfit.evals)
-                ga_img = nib.Nifti1Image(GA.astype(np.float32),
-                                         affine)
+                ga_img = nib.Nifti1Image(maps['ga'], affine)
                 nib.save(ga_img, oga)
 
             if 'rgb' in save_metrics:
-                RGB = color_fa(FA, tenfit.evecs)
+                RGB = maps['color_fa']
+                RGB[np.isnan(RGB)] = 0
                 rgb_img = nib.Nifti1Image(np.array(255 * RGB, 'uint8'),
                                           affine)
                 nib.save(rgb_img, orgb)
 
             if 'md' in save_metrics:
-                MD = mean_diffusivity(tenfit.evals)
-                md_img = nib.Nifti1Image(MD.astype(np.float32),
-                                         affine)
+                md_img = nib.Nifti1Image(maps['md'], affine)
                 nib.save(md_img, omd)
 
             if 'ad' in save_metrics:
-                AD = axial_diffusivity(tenfit.evals)
-                ad_img = nib.Nifti1Image(AD.astype(np.float32),
-                                         affine)
+                ad_img = nib.Nifti1Image(maps['ad'], affine)
                 nib.save(ad_img, oad)
 
             if 'rd' in save_metrics:
-                RD = radial_diffusivity(tenfit.evals)
-                rd_img = nib.Nifti1Image(RD.astype(np.float32),
-                                         affine)
+                rd_img = nib.Nifti1Image(maps['rd'], affine)
                 nib.save(rd_img, orad)
 
             if 'mode' in save_metrics:
-                MODE = get_mode(tenfit.quadratic_form)
-                mode_img = nib.Nifti1Image(MODE.astype(np.float32),
-                                           affine)
+                mode_img = nib.Nifti1Image(maps['mode'], affine)
                 nib.save(mode_img, omode)
 
             if 'evec' in save_metrics:
-                evecs_img = nib.Nifti1Image(tenfit.evecs.astype(np.float32),
-                                            affine)
+                evecs_img = nib.Nifti1Image(maps['evecs'], affine)
                 nib.save(evecs_img, oevecs)
 
             if 'eval' in save_metrics:
-                evals_img = nib.Nifti1Image(tenfit.evals.astype(np.float32),
-                                            affine)
+                evals_img = nib.Nifti1Image(maps['evals'], affine)
                 nib.save(evals_img, oevals)
 
             dname_ = os.path.dirname(oevals)
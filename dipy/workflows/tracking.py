@@ -2,13 +2,11 @@
 from __future__ import division
 
 import logging
-import numpy as np
-
-from nibabel.streamlines import save, Tractogram
 
 from dipy.direction import DeterministicMaximumDirectionGetter
 from dipy.io.image import load_nifti
 from dipy.io.peaks import load_peaks
+from dipy.io.streamline import StreamlineWriter
 from dipy.tracking import utils
 from dipy.tracking.local import (ThresholdTissueClassifier,
                                  LocalTracking)
@@ -42,8 +40,9 @@ class GenericTrackFlow(Workflow):
                                     seeds, affine, step_size=.5)
         logging.info('LocalTracking initiated')
 
-        tractogram = Tractogram(streamlines, affine_to_rasmm=np.eye(4))
-        save(tractogram, out_tract)
+        # The streamlines are written as they are tracked
+        with StreamlineWriter(out_tract) as writer:
+            writer.write(streamlines)
 
         logging.info('Saved {0}'.format(out_tract))
 